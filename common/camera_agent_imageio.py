@@ -1,15 +1,26 @@
 import carla
 import threading
-import imageio
 import numpy as np
 import time
 import datetime
 from carla import ColorConverter as cc
 import os
+import functools
 from packaging import version
 
+from MS_fuzz.common.video_encoder import VideoEncoder, PreTriggerBuffer
+from MS_fuzz.ms_utils.stage_profiler import get_stage_profiler
+
 # import pygame
 
+# recording profiles selectable by Config.recorder_profile: (cameras,
+# resolution of each camera), 'off' spawns no recorder at all
+RECORDING_PROFILES = {
+    'top': (('top',), (832, 468)),
+    'quad': (('top', 'tpp', 'fpp', 'back'), (832, 468)),
+    'preview': (('top', 'tpp', 'fpp', 'back'), (320, 180)),
+}
+
 
 class ScenarioRecorder:
     def __init__(self, world: carla.World,
@@ -17,7 +28,11 @@ class ScenarioRecorder:
                  save_floder_path,
                  resolution=(832, 468),
                  frame_rate=24.0,
-                 server_version=None):
+                 server_version=None,
+                 encoder_slots=8,
+                 pre_trigger_seconds=0,
+                 downscale=1,
+                 cameras=('top', 'tpp', 'fpp', 'back')):
         """
         Initializes the ScenarioRecorder class to record scenarios in the CARLA simulator.
 
@@ -35,6 +50,14 @@ class ScenarioRecorder:
                 and those larger then 1280x720
             ].
         - frame_rate (float): Recording frame rate in frames per second, default 24.0.
+        - encoder_slots (int): Stitched frames buffered for the encoder process, frames
+            are dropped when they are all waiting to be encoded.
+        - pre_trigger_seconds (float): If > 0, frames are only kept in memory for the last
+            pre_trigger_seconds and encoded by stop_recording(save_video=True), segments
+            stopped with save_video=False cost no encoding. 0 encodes every recording.
+        - downscale (int): Keep one pixel out of downscale in each direction of the cameras.
+        - cameras (tuple): Cameras to stitch, among 'top', 'tpp', 'fpp' and 'back'. They are
+            spawned by the first start_recording, see RECORDING_PROFILES.
         """
         self.world = world
         self.ego_vehicle = ego_vehicle
@@ -56,34 +79,50 @@ class ScenarioRecorder:
         self.back_cam_tf = carla.Transform(carla.Location(x=-0.8, y=0.0, z=1.8),
                                            carla.Rotation(pitch=0, yaw=-180, roll=0))
 
-        self.top_cam = self.create_camera(self.top_cam_tf, 'recorder_top_cam')
-        self.tpp_cam = None
+        tpp_attachment = carla.AttachmentType.Rigid
         if server_version and version.parse(server_version) >= version.parse('0.9.14'):
-            self.tpp_cam = self.create_camera(self.tpp_cam_tf,
-                                              'recorder_tpp_cam',
-                                              carla.AttachmentType.SpringArmGhost)
-        else:
-            self.tpp_cam = self.create_camera(self.tpp_cam_tf,
-                                              'recorder_tpp_cam')
-        self.fpp_cam = self.create_camera(self.fpp_cam_tf, 'recorder_fpp_cam')
-        self.back_cam = self.create_camera(
-            self.back_cam_tf, 'recorder_back_cam')
+            tpp_attachment = carla.AttachmentType.SpringArmGhost
+        self.cam_specs = {
+            'top': (self.top_cam_tf, carla.AttachmentType.Rigid),
+            'tpp': (self.tpp_cam_tf, tpp_attachment),
+            'fpp': (self.fpp_cam_tf, carla.AttachmentType.Rigid),
+            'back': (self.back_cam_tf, carla.AttachmentType.Rigid),
+        }
+        self.cam_names = list(cameras)
+        # spawned lazily, a recorder never started costs no rendering
+        self.cams = []
 
-        self.video_writer = None
         self.stop_event = threading.Event()  # Initialize the stop event
         self.recording_thread: threading.Thread = None
 
         self.width, self.height = self.sub_fig_res
-        # [top_frame, tpp_frame, fpp_frame, back_frame]
-        self.sensor_frame = [None, None, None, None]
-        self.recording_frame = np.zeros(
-            (self.height * 2, self.width * 2, 3), dtype=np.uint8)
-        
-        
-        self.top_cam.listen(self.top_img_callback)
-        self.tpp_cam.listen(self.tpp_img_callback)
-        self.fpp_cam.listen(self.fpp_img_callback)
-        self.back_cam.listen(self.back_img_callback)
+        # size of a camera in the stitched frame
+        self.downscale = downscale
+        self.tile_width = -(-self.width // downscale)
+        self.tile_height = -(-self.height // downscale)
+        # camera images by simulation frame id, in cam_names order
+        self.pending_frames = {}
+        # latest complete set: (frame id, timestamp, images)
+        self.ready_frame = None
+        self.frame_cond = threading.Condition()
+        # (row, col) of each camera in the stitched frame, 2x2 for four
+        # cameras filled column by column: top, tpp / fpp, back
+        rows = 1 if len(self.cam_names) == 1 else 2
+        cols = -(-len(self.cam_names) // rows)
+        self.tile_offsets = [((i % rows) * self.tile_height,
+                              (i // rows) * self.tile_width)
+                             for i in range(len(self.cam_names))]
+        frame_shape = (self.tile_height * rows, self.tile_width * cols, 3)
+
+        # libx264 runs in its own process, fed through shared memory
+        self.encoder = VideoEncoder(frame_shape, slots=encoder_slots)
+
+        # deferred encoding, see stop_recording
+        self.pre_trigger_buffer: PreTriggerBuffer = None
+        if pre_trigger_seconds > 0:
+            self.pre_trigger_buffer = PreTriggerBuffer(
+                int(np.ceil(pre_trigger_seconds * frame_rate)), frame_shape)
+        self.video_path = None
 
     def create_camera(self, transform, role_name, attachment_type=carla.AttachmentType.Rigid):
         cam_bp = self.world.get_blueprint_library().find('sensor.camera.rgb')
@@ -96,23 +135,31 @@ class ScenarioRecorder:
         self.world.wait_for_tick()
         return camera
 
-    def top_img_callback(self, image):
-        self.sensor_frame[0] = image
-
-    def tpp_img_callback(self, image):
-        self.sensor_frame[1] = image
-
-    def fpp_img_callback(self, image):
-        self.sensor_frame[2] = image
-
-    def back_img_callback(self, image):
-        self.sensor_frame[3] = image
+    def spawn_cams(self):
+        if self.cams:
+            return
+        for index, name in enumerate(self.cam_names):
+            transform, attachment_type = self.cam_specs[name]
+            cam = self.create_camera(transform, f'recorder_{name}_cam',
+                                     attachment_type)
+            cam.listen(functools.partial(self.on_image, index))
+            self.cams.append(cam)
+
+    def on_image(self, index, image):
+        with self.frame_cond:
+            images = self.pending_frames.setdefault(image.frame,
+                                                    [None] * len(self.cam_names))
+            images[index] = image
+            if any(img is None for img in images):
+                return
+            # sets older than a complete one will never complete
+            for frame_id in [f for f in self.pending_frames if f <= image.frame]:
+                del self.pending_frames[frame_id]
+            self.ready_frame = (image.frame, image.timestamp, images)
+            self.frame_cond.notify()
 
     def start_recording(self, save_path=None):
-        self.recording_frame = np.zeros(
-            (self.height * 2, self.width * 2, 3), dtype=np.uint8)
-        width, height = self.sub_fig_res
-        final_frame_size = (width * 2, height * 2)
+        self.spawn_cams()
 
         if save_path == None:
             if not os.path.exists(self.save_path):
@@ -121,84 +168,110 @@ class ScenarioRecorder:
             save_path = os.path.join(
                 self.save_path, f'recording-{curr_datetime}.mp4')
 
-        # Create video writer for the final stitched video
-        self.video_writer = imageio.get_writer(
-            save_path, fps=self.frame_rate, codec='libx264', quality=8)
+        self.video_path = save_path
+        if self.pre_trigger_buffer is not None:
+            self.pre_trigger_buffer.clear()
+        else:
+            # Open the final stitched video in the encoder process
+            self.encoder.open(save_path, self.frame_rate)
 
+        with self.frame_cond:
+            self.ready_frame = None
         self.stop_event.clear()
         self.recording_thread = threading.Thread(
             target=self.recording_thread_handler)
         self.recording_thread.start()
 
     def recording_thread_handler(self):
-        self.stop_event.clear()
+        start_timestamp = None
+        video_frame_num = 0
         while not self.stop_event.is_set():
-            if any(frame == None for frame in self.sensor_frame):
+            # wakes up when the four cameras delivered the same frame
+            with self.frame_cond:
+                if self.ready_frame is None:
+                    self.frame_cond.wait(timeout=0.5)
+                ready_frame, self.ready_frame = self.ready_frame, None
+            if ready_frame is None:
                 continue
 
-            if any(cam.is_listening == False for cam in [self.top_cam,
-                                                         self.tpp_cam,
-                                                         self.fpp_cam,
-                                                         self.back_cam]):
+            if any(cam.is_listening == False for cam in self.cams):
                 break
 
-            start_time = time.time()
-
-            record_array = np.empty(
-                (4, self.height, self.width, 3), dtype=np.uint8)
-
-            for index, frame in enumerate(self.sensor_frame):
-                # print(f'{frame.width}x{frame.height}')
-                array = np.frombuffer(frame.raw_data, dtype=np.dtype(
-                    "uint8")).reshape((frame.height, frame.width, 4))
-                # Convert image to an array for video recording
-                record_array[index] = array[:, :, :3][:, :, ::-1]
-
-            self.recording_frame[:self.height,
-                                 :self.width, :] = record_array[0]
-            self.recording_frame[self.height:self.height
-                                 * 2, :self.width, :] = record_array[1]
-            self.recording_frame[:self.height,
-                                 self.width:self.width * 2, :] = record_array[2]
-            self.recording_frame[self.height:self.height * 2,
-                                 self.width:self.width * 2, :] = record_array[3]
-
-            self.video_writer.append_data(self.recording_frame)
-
-            elapsed_time = time.time() - start_time
-            sleep_time = max(0, (1.0 / self.frame_rate) - elapsed_time)
-            time.sleep(sleep_time)
+            # video time follows simulation time: a frame is repeated when
+            # the simulation runs slower than frame_rate, skipped when faster
+            _, timestamp, images = ready_frame
+            if start_timestamp is None:
+                start_timestamp = timestamp
+            repeat = int((timestamp - start_timestamp) * self.frame_rate) \
+                + 1 - video_frame_num
+            if repeat <= 0:
+                continue
 
-    def stop_recording(self):
+            with get_stage_profiler().stage('recorder'):
+                slot = None
+                if self.pre_trigger_buffer is not None:
+                    recording_frame = self.pre_trigger_buffer.next_frame()
+                else:
+                    slot, recording_frame = self.encoder.acquire_frame()
+                    if slot is None:
+                        # dropped, the next frame is repeated to fill the gap
+                        continue
+                step = self.downscale
+                for index, image in enumerate(images):
+                    array = np.frombuffer(image.raw_data, dtype=np.dtype(
+                        "uint8")).reshape((image.height, image.width, 4))
+                    # BGRA to RGB, straight into the tile
+                    row, col = self.tile_offsets[index]
+                    recording_frame[row:row + self.tile_height,
+                                    col:col + self.tile_width] = array[::step, ::step, 2::-1]
+                if slot is None:
+                    self.pre_trigger_buffer.commit(repeat)
+                else:
+                    self.encoder.submit_frame(slot, repeat)
+            video_frame_num += repeat
+
+    def stop_recording(self, save_video=True):
+        '''
+            save_video: with a pre-trigger buffer, encode the buffered frames
+                to the video path, otherwise drop them without writing a file
+        '''
         self.stop_event.set()
+        with self.frame_cond:
+            self.frame_cond.notify()
         if self.recording_thread:
             self.recording_thread.join()
-        if self.video_writer:
-            self.video_writer.close()
-            
-        self.recording_frame = np.zeros(
-            (self.height * 2, self.width * 2, 3), dtype=np.uint8)
+        if self.pre_trigger_buffer is None:
+            self.encoder.close_video()
+            return
+        if save_video and self.video_path and len(self.pre_trigger_buffer):
+            self.encode_pre_trigger(self.video_path)
+        self.pre_trigger_buffer.clear()
+
+    def encode_pre_trigger(self, save_path, timeout=30):
+        self.encoder.open(save_path, self.frame_rate)
+        for frame, repeat in self.pre_trigger_buffer:
+            slot, slot_frame = self.encoder.acquire_frame(timeout=timeout)
+            if slot is None:
+                continue
+            slot_frame[:] = frame
+            self.encoder.submit_frame(slot, repeat)
+        self.encoder.close_video(timeout=timeout)
 
     def __del__(self):
         self.rm_cams()
     
     def rm_cams(self):
-        if self.top_cam.is_listening:
-            self.top_cam.stop()
-        if self.tpp_cam.is_listening:
-            self.tpp_cam.stop()
-        if self.fpp_cam.is_listening:
-            self.fpp_cam.stop()
-        if self.back_cam.is_listening:
-            self.back_cam.stop()
+        for cam in self.cams:
+            if cam.is_listening:
+                cam.stop()
         try:
-            self.top_cam.destroy()
-            self.tpp_cam.destroy()
-            self.fpp_cam.destroy()
-            self.back_cam.destroy()
+            for cam in self.cams:
+                cam.destroy()
         except Exception as e:
             print("Removing Cams", e)
+        self.cams = []
         print("Camera already destroyed")
+        self.encoder.shutdown()
 
 if __name__ == '__main__':
     client = carla.Client("172.17.0.1", 5000)
@@ -0,0 +1,144 @@
+import numpy as np
+import carla
+
+from typing import List
+
+
+class FrameBuffer(object):
+    '''
+        Columnar per-frame record of a local scenario.
+
+        Every tick `append()` copies what evaluation and result saving need
+        out of the world snapshot into preallocated arrays, so no
+        carla.ActorSnapshot is kept alive. Arrays grow by `chunk_size`
+        frames, read them through the trimmed views (e.g. `buf.ego_pos`).
+        With `retain_frames=False` only the latest frame is kept, for runs
+        that evaluate fitness but do not save results.
+
+        Values coming from the simulator are float32 on the server side and
+        are stored as float32, so they are exactly the values the snapshots
+        would have returned.
+    '''
+
+    def __init__(self, npc_vehicle_num: int, chunk_size: int = 256,
+                 retain_frames=True):
+        self.npc_num = npc_vehicle_num
+        self.retain_frames = retain_frames
+        self.chunk_size = chunk_size if retain_frames else 1
+        self.size = 0
+        self.capacity = 0
+
+        n = self.npc_num
+        self._columns = {
+            # per frame
+            'timestamp': ((), np.float64),
+            'frame': ((), np.int64),
+            'min_dis': ((), np.float64),
+            'unsmooth_acc': ((), np.float64),
+            'walker_in_road': ((), np.int32),
+            # ego, rotation is (pitch, yaw, roll)
+            'ego_pos': ((3,), np.float32),
+            'ego_rot': ((3,), np.float32),
+            'ego_vel': ((3,), np.float32),
+            'ego_acc': ((3,), np.float32),
+            # npc vehicles, slot i is the i-th spawned vehicle of the scenario
+            'npc_valid': ((n,), bool),
+            'npc_pos': ((n, 3), np.float32),
+            'npc_vel': ((n, 3), np.float32),
+            'npc_acc': ((n, 3), np.float32),
+            'npc_yaw': ((n,), np.float32),
+            # filled by metrics.predict_frame_collisions
+            'npc_will_collide': ((n,), bool),
+        }
+        self._data = {name: np.zeros((0,) + shape, dtype=dtype)
+                      for name, (shape, dtype) in self._columns.items()}
+        self._grow()
+
+        # (frame count, SegmentMetrics), see metrics.get_segment_metrics
+        self.metrics_cache = (-1, None)
+
+    def __len__(self):
+        return self.size
+
+    def __getattr__(self, name):
+        # trimmed views of the columns: buf.ego_pos, buf.npc_valid, ...
+        data = self.__dict__.get('_data')
+        if data is not None and name in data:
+            return data[name][:self.size]
+        raise AttributeError(name)
+
+    def _grow(self):
+        new_capacity = self.capacity + self.chunk_size
+        for name, (shape, dtype) in self._columns.items():
+            new_arr = np.zeros((new_capacity,) + shape, dtype=dtype)
+            new_arr[:self.size] = self._data[name][:self.size]
+            self._data[name] = new_arr
+        self.capacity = new_capacity
+
+    def frozen_copy(self) -> 'FrameBuffer':
+        '''
+            Trimmed read-only copy of the recorded frames, safe to hand to
+            another thread (e.g. the ResultWriter) while this buffer keeps
+            being appended to.
+        '''
+        frozen = FrameBuffer.__new__(FrameBuffer)
+        frozen.npc_num = self.npc_num
+        frozen.retain_frames = self.retain_frames
+        frozen.chunk_size = self.chunk_size
+        frozen.size = self.size
+        frozen.capacity = self.size
+        frozen._columns = self._columns
+        frozen._data = {}
+        for name, arr in self._data.items():
+            frozen_arr = arr[:self.size].copy()
+            frozen_arr.flags.writeable = False
+            frozen._data[name] = frozen_arr
+        frozen.metrics_cache = (-1, None)
+        return frozen
+
+    def append(self, timestamp: float, frame: int,
+               min_dis: float, unsmooth_acc: float, walker_in_road: int,
+               ego_ss: carla.ActorSnapshot,
+               npc_vehicles_ss: List[carla.ActorSnapshot]) -> int:
+        '''
+            Record one frame, `npc_vehicles_ss` holds one entry (or None when
+            the actor is missing from the snapshot) per npc slot.
+            return: the index of the recorded frame
+        '''
+        if not self.retain_frames:
+            self.size = 0
+        if self.size == self.capacity:
+            self._grow()
+        i = self.size
+        d = self._data
+        d['npc_valid'][i] = False
+        d['npc_will_collide'][i] = False
+
+        d['timestamp'][i] = timestamp
+        d['frame'][i] = frame
+        d['min_dis'][i] = min_dis
+        d['unsmooth_acc'][i] = unsmooth_acc
+        d['walker_in_road'][i] = walker_in_road
+
+        tf = ego_ss.get_transform()
+        vel = ego_ss.get_velocity()
+        acc = ego_ss.get_acceleration()
+        d['ego_pos'][i] = (tf.location.x, tf.location.y, tf.location.z)
+        d['ego_rot'][i] = (tf.rotation.pitch, tf.rotation.yaw, tf.rotation.roll)
+        d['ego_vel'][i] = (vel.x, vel.y, vel.z)
+        d['ego_acc'][i] = (acc.x, acc.y, acc.z)
+
+        for j, npc_ss in enumerate(npc_vehicles_ss[:self.npc_num]):
+            if npc_ss is None:
+                continue
+            tf = npc_ss.get_transform()
+            vel = npc_ss.get_velocity()
+            acc = npc_ss.get_acceleration()
+            d['npc_valid'][i, j] = True
+            d['npc_pos'][i, j] = (tf.location.x, tf.location.y, tf.location.z)
+            d['npc_vel'][i, j] = (vel.x, vel.y, vel.z)
+            d['npc_acc'][i, j] = (acc.x, acc.y, acc.z)
+            d['npc_yaw'][i, j] = tf.rotation.yaw
+
+        self.size += 1
+        return i
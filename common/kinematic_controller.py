@@ -0,0 +1,146 @@
+import math
+from typing import List
+
+import numpy as np
+
+
+# target speeds (km/h) per agent type, about what BehaviorAgent drives on the
+# 30 km/h roads of the towns (speed limit minus its speed_lim_dist)
+KINEMATIC_SPEEDS = {
+    'cautious': 24,
+    'normal': 27,
+    'aggressive': 30,
+}
+
+
+class KinematicController(object):
+    '''
+        Scripted-trajectory control of many vehicles at once: pure pursuit
+        on a precomputed waypoint route for the steering and a PI loop on
+        the speed, all vehicles in one set of array operations per tick.
+
+        Unlike BehaviorAgent it ignores traffic lights and other actors, the
+        NPCs follow their genes' routes and nothing else.
+
+        Vehicles are added with `add_vehicle()`, the returned index is their
+        row in the arrays given to and returned by `step()`.
+    '''
+
+    def __init__(self, lookahead=6.0, window=20, k_p=0.5, k_i=0.05,
+                 max_steer_deg=70.0, max_throttle=0.75, delta=0.05):
+        self.lookahead = lookahead
+        # route points searched ahead of the progress index for the closest
+        self.window = window
+        self.k_p = k_p
+        self.k_i = k_i
+        self.max_steer = math.radians(max_steer_deg)
+        self.max_throttle = max_throttle
+        self.delta = delta
+
+        self.routes: List[np.ndarray] = []
+        self.target_speed = np.zeros(0)
+        self.wheelbase = np.zeros(0)
+        self.progress = np.zeros(0, dtype=np.int64)
+        self.integral = np.zeros(0)
+        # (V, max route length, 2) padded with the last point of each route
+        self.route_points = np.zeros((0, 1, 2))
+        self.route_len = np.zeros(0, dtype=np.int64)
+        # no route found, the vehicle is held with the brake
+        self.route_empty = np.zeros(0, dtype=bool)
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.routes)
+
+    def add_vehicle(self, route_xy: np.ndarray, target_speed, wheelbase) -> int:
+        '''
+            route_xy: (N, 2) route points, about evenly spaced
+            target_speed: m/s
+        '''
+        self.routes.append(np.asarray(route_xy, dtype=np.float64).reshape(-1, 2))
+        self.target_speed = np.append(self.target_speed, target_speed)
+        self.wheelbase = np.append(self.wheelbase, wheelbase)
+        self.progress = np.append(self.progress, 0)
+        self.integral = np.append(self.integral, 0.0)
+        self.dirty = True
+        return len(self.routes) - 1
+
+    def set_route(self, index, route_xy: np.ndarray):
+        self.routes[index] = np.asarray(route_xy, dtype=np.float64).reshape(-1, 2)
+        self.progress[index] = 0
+        self.dirty = True
+
+    def pack_routes(self):
+        self.route_len = np.array([max(len(route), 1) for route in self.routes],
+                                  dtype=np.int64)
+        self.route_empty = np.array([len(route) == 0 for route in self.routes],
+                                    dtype=bool)
+        max_len = int(self.route_len.max()) if len(self.routes) else 1
+        self.route_points = np.zeros((len(self.routes), max_len, 2))
+        for i, route in enumerate(self.routes):
+            if len(route) == 0:
+                continue
+            self.route_points[i, :len(route)] = route
+            self.route_points[i, len(route):] = route[-1]
+        self.dirty = False
+
+    def step(self, poses: np.ndarray, speeds: np.ndarray, active: np.ndarray):
+        '''
+            poses: (V, 3) x, y, yaw in degrees
+            speeds: (V,) m/s
+            active: (V,) bool, inactive vehicles keep their state and get a
+                zero control
+            return: (throttle, steer, brake, done), (V,) arrays, done when
+                the end of the route is reached or the route is empty
+        '''
+        if self.dirty:
+            self.pack_routes()
+        vehicle_num = len(self.routes)
+        rows = np.arange(vehicle_num)
+        last = self.route_len - 1
+
+        # closest route point in the window ahead of the progress index
+        window_index = np.minimum(self.progress[:, None] + np.arange(self.window),
+                                  last[:, None])
+        window_points = self.route_points[rows[:, None], window_index]
+        diff = window_points - poses[:, None, :2]
+        dist = np.hypot(diff[..., 0], diff[..., 1])
+        closest = window_index[rows, np.argmin(dist, axis=1)]
+        self.progress = np.where(active, closest, self.progress)
+
+        # first point at least `lookahead` away, or the route end
+        ahead = np.minimum(self.progress[:, None] + np.arange(self.window),
+                           last[:, None])
+        ahead_points = self.route_points[rows[:, None], ahead]
+        ahead_diff = ahead_points - poses[:, None, :2]
+        ahead_dist = np.hypot(ahead_diff[..., 0], ahead_diff[..., 1])
+        far_enough = ahead_dist >= self.lookahead
+        target_col = np.where(far_enough.any(axis=1),
+                              np.argmax(far_enough, axis=1), self.window - 1)
+        target = ahead_diff[rows, target_col]
+        target_dist = np.maximum(ahead_dist[rows, target_col], 1e-3)
+
+        # pure pursuit, in the vehicle frame (x forward, y right)
+        yaw = np.radians(poses[:, 2])
+        local_x = np.cos(yaw) * target[:, 0] + np.sin(yaw) * target[:, 1]
+        local_y = -np.sin(yaw) * target[:, 0] + np.cos(yaw) * target[:, 1]
+        alpha = np.arctan2(local_y, local_x)
+        steer_angle = np.arctan2(2 * self.wheelbase * np.sin(alpha), target_dist)
+        steer = np.clip(steer_angle / self.max_steer, -1, 1)
+
+        done = self.route_empty | ((self.progress >= last - 1) & (
+            np.hypot(*(self.route_points[rows, last] - poses[:, :2]).T) < 2.0))
+
+        # PI on the speed
+        error = self.target_speed - speeds
+        self.integral = np.where(active & ~done,
+                                 np.clip(self.integral + error * self.delta, -10, 10),
+                                 0)
+        command = self.k_p * error + self.k_i * self.integral
+        throttle = np.clip(command, 0, self.max_throttle)
+        brake = np.clip(-command, 0, 1)
+
+        throttle = np.where(active & ~done, throttle, 0)
+        brake = np.where(done, 1.0, np.where(active, brake, 0))
+        steer = np.where(active & ~done, steer, 0)
+        return throttle, steer, brake, done
@@ -0,0 +1,110 @@
+import numpy as np
+
+from MS_fuzz.ms_utils import predict_collisions
+from MS_fuzz.common.frame_buffer import FrameBuffer
+
+
+def predict_frame_collisions(buf: FrameBuffer, index: int) -> np.ndarray:
+    '''
+        Predict collisions between the ego and every npc of one recorded
+        frame, store them in `buf.npc_will_collide` and return that row.
+    '''
+    valid = buf.npc_valid[index]
+    will_collide = buf.npc_will_collide[index]
+    if valid.any():
+        will_collide[valid], _ = predict_collisions(buf.ego_pos[index],
+                                                    buf.ego_vel[index],
+                                                    buf.ego_acc[index],
+                                                    buf.npc_pos[index][valid],
+                                                    buf.npc_vel[index][valid],
+                                                    buf.npc_acc[index][valid])
+    return will_collide
+
+
+class MetricsAccumulator(object):
+    '''
+        Running fitness metrics of a segment, updated once per tick so that
+        `Evaluate_Object.evaluate()` does not depend on the segment length.
+    '''
+
+    def __init__(self):
+        self.frame_num = 0
+        self.min_dis = 0
+        self.max_unsmooth_acc = 0
+        self.walker_in_road_count = 0
+        self.vehicle_may_collide = 0
+        self.will_collide_frame_cnt = 0
+
+    def update(self, min_dis, unsmooth_acc, walker_in_road, will_collide: np.ndarray):
+        if self.frame_num == 0 or min_dis < self.min_dis:
+            self.min_dis = min_dis
+        if self.frame_num == 0 or unsmooth_acc > self.max_unsmooth_acc:
+            self.max_unsmooth_acc = unsmooth_acc
+        self.frame_num += 1
+        self.walker_in_road_count += walker_in_road
+        collide_num = int(np.count_nonzero(will_collide))
+        self.vehicle_may_collide += collide_num
+        self.will_collide_frame_cnt += 1 if collide_num else 0
+
+    @property
+    def f_distance(self):
+        return self.min_dis
+
+    @property
+    def f_smooth(self):
+        return self.max_unsmooth_acc
+
+    @property
+    def f_crossing_time(self):
+        return self.walker_in_road_count / self.frame_num
+
+    @property
+    def f_interaction_rate(self):
+        return self.vehicle_may_collide / self.frame_num
+
+
+class SegmentMetrics(object):
+    '''
+        Per-frame metrics of a recorded segment for result.json, computed in
+        one pass over a FrameBuffer from the collisions predicted at record
+        time. Get it through `get_segment_metrics()`.
+    '''
+
+    def __init__(self, buf: FrameBuffer):
+        self.frame_num = len(buf)
+
+        # predicted collisions of every (ego, npc) pair, shape (frames, npcs)
+        self.will_collide = buf.npc_will_collide
+        self.collide_per_frame = self.will_collide.sum(axis=1)
+        self.will_collide_frame_cnt = int(np.count_nonzero(self.collide_per_frame))
+        self.interaction_rate_per_frame = self.collide_per_frame / buf.npc_num \
+            if buf.npc_num else np.zeros(self.frame_num)
+
+        # odometer, float32 math as carla.Vector3D.length()/distance()
+        ego_pos = buf.ego_pos
+        ego_vel = buf.ego_vel
+        self.speed = np.sqrt(ego_vel[:, 0] * ego_vel[:, 0]
+                             + ego_vel[:, 1] * ego_vel[:, 1]
+                             + ego_vel[:, 2] * ego_vel[:, 2])
+        delta = ego_pos[1:] - ego_pos[:-1]
+        delta_dis = np.sqrt(delta[:, 0] * delta[:, 0]
+                            + delta[:, 1] * delta[:, 1]
+                            + delta[:, 2] * delta[:, 2])
+        cum_dis = np.cumsum(delta_dis.astype(np.float64))
+        # distance run before reaching each frame
+        self.run_distance = np.concatenate(([0.0, 0.0], cum_dis[:-1]))[:self.frame_num]
+        self.total_distance = float(cum_dis[-1]) if len(cum_dis) else 0.0
+
+
+def get_segment_metrics(buf: FrameBuffer) -> SegmentMetrics:
+    '''
+        Metrics of the frames recorded so far, cached on the buffer until a
+        new frame is appended. Returns None for an empty buffer.
+    '''
+    if buf is None or len(buf) == 0:
+        return None
+    cached_size, metrics = buf.metrics_cache
+    if cached_size != len(buf):
+        metrics = SegmentMetrics(buf)
+        buf.metrics_cache = (len(buf), metrics)
+    return metrics
@@ -2,31 +2,34 @@ import carla
 import time
 import os
 import json
+import copy
+import functools
+import numpy as np
+from loguru import logger
 
 from datetime import timedelta
 
 from MS_fuzz.common.unsafe_detector import *
-from MS_fuzz.ms_utils import predict_collision
+from MS_fuzz.common.frame_buffer import FrameBuffer
+from MS_fuzz.common.metrics import get_segment_metrics
+from MS_fuzz.common.result_writer import ResultWriter
 
 
 class ResultSaver(object):
-    def __init__(self, save_floder_path=''):
+    def __init__(self, save_floder_path='', result_writer: ResultWriter = None,
+                 result_format='json'):
 
         self.result_to_save = {}
+
+        # 'json': per-frame records in result.json, 'npz': in trace.npz
+        self.result_format = result_format
+
+        # writes result.json in background, synchronous when None
+        self.result_writer: ResultWriter = result_writer
         
-        self.frames_record = []
-        '''
-            frame_record = {
-                'timestamp': time.time(),
-                'frame': frame:int,
-                'min_dis': min_dis:float,
-                'unsmooth_acc': unsmooth_acc,
-                'walker_in_road': walker_in_road:int,
-                'npc_vehicles_ss': npc_vehicles_ss:List[carla.ActorSnapshot],
-                'ego_ss': ego_ss:carla.ActorSnapshot
-            }
-        '''
-        
+        # the frame buffer of the scenario being recorded, see FrameBuffer
+        self.frame_buffer: FrameBuffer = None
+
         self.sce_result_path = save_floder_path
         
         self.clear_result()
@@ -50,11 +53,11 @@ class ResultSaver(object):
             'video_path': None,
             'Odometer': None,
         }
-        
-        self.frames_record = []
-    
-    def add_frame(self, frame: dict):
-        self.frames_record.append(frame)
+
+        self.frame_buffer = None
+
+    def set_frame_buffer(self, frame_buffer: FrameBuffer):
+        self.frame_buffer = frame_buffer
         
     def add_minor_unsafe(self,
                           unsafe_type: UNSAFE_TYPE,
@@ -151,89 +154,154 @@ class ResultSaver(object):
         self.result_to_save['run_time'] = now - \
             self.result_to_save['start_time']
 
-        if not self.frames_record or len(self.frames_record) == 0:
-            self.result_to_save['interaction'] = None
-            self.result_to_save['Odometer'] = None
+        # snapshot the segment, the writer must not see later changes
+        result_to_save = copy.deepcopy(self.result_to_save)
+        buf = self.frame_buffer.frozen_copy() if self.frame_buffer else None
+        job = functools.partial(write_result, result_to_save, buf,
+                                self.sce_result_path, save_video,
+                                self.result_format)
+        if self.result_writer:
+            self.result_writer.submit(job)
         else:
-            ego_pos_l = []
-            run_distance = 0.0
-            interaction_per_frame = []
-            total_frame_num = len(self.frames_record)
-
-            will_collide_frame_cnt = 0
-
-            pre_frame = None
-
-            # final_frame_time = self.frames_record[-1]['timestamp']
-            for frame in self.frames_record:
-                ego_ss = frame['ego_ss']
-                npcs_ss = frame['npc_vehicles_ss']
-                ego_pos_l.append({
-                    'timestamp': frame['timestamp'],
-                    'frame_num': frame['frame'],
-                    'x': ego_ss.get_transform().location.x,
-                    'y': ego_ss.get_transform().location.y,
-                    'z': ego_ss.get_transform().location.z,
-                    'yaw': ego_ss.get_transform().rotation.yaw,
-                    'pitch': ego_ss.get_transform().rotation.pitch,
-                    'roll': ego_ss.get_transform().rotation.roll,
-                    'speed': ego_ss.get_velocity().length(),
-                    'run_distance': round(run_distance, 2)
-                })
+            try:
+                job()
+            except Exception as e:
+                logger.error(f'[ResultSaver] fail to save result: {e}')
+
+
+# per-frame columns of trace.npz, see write_result(result_format='npz')
+TRACE_COLUMNS = ('timestamp', 'frame_num', 'ego_pos', 'ego_rot', 'speed',
+                 'run_distance', 'npc_valid', 'npc_pos', 'will_collide',
+                 'interaction_rate')
+TRACE_FILE = 'trace.npz'
+
+
+def get_trace_columns(buf: FrameBuffer, metrics) -> dict:
+    return {
+        'timestamp': buf.timestamp,
+        'frame_num': buf.frame,
+        'ego_pos': buf.ego_pos,
+        'ego_rot': buf.ego_rot,
+        'speed': metrics.speed,
+        'run_distance': metrics.run_distance,
+        'npc_valid': buf.npc_valid,
+        'npc_pos': buf.npc_pos,
+        'will_collide': metrics.will_collide,
+        'interaction_rate': metrics.interaction_rate_per_frame,
+    }
+
+
+def get_frame_records(trace: dict):
+    '''
+        Build the per-frame lists of result.json from trace columns.
+        return: (Odometer pos_per_frame, interaction per_frame)
+    '''
+    total_frame_num = len(trace['timestamp'])
+    npc_num = trace['npc_valid'].shape[1]
+    timestamps = trace['timestamp'].tolist()
+    frame_nums = trace['frame_num'].tolist()
+    run_distance_l = trace['run_distance'].tolist()
+
+    ego_pos_l = []
+    for i, (pos, rot, speed) in enumerate(zip(trace['ego_pos'].tolist(),
+                                              trace['ego_rot'].tolist(),
+                                              trace['speed'].tolist())):
+        ego_pos_l.append({
+            'timestamp': timestamps[i],
+            'frame_num': frame_nums[i],
+            'x': pos[0],
+            'y': pos[1],
+            'z': pos[2],
+            'yaw': rot[1],
+            'pitch': rot[0],
+            'roll': rot[2],
+            'speed': speed,
+            'run_distance': round(run_distance_l[i], 2)
+        })
+
+    interaction_per_frame = []
+    npc_pos = trace['npc_pos'].tolist()
+    valid_l = trace['npc_valid'].tolist()
+    will_collide_l = trace['will_collide'].tolist()
+    rate_l = trace['interaction_rate'].tolist() if npc_num \
+        else [0] * total_frame_num
+    for i in range(total_frame_num):
+        npcs_pos = []
+        for j in range(npc_num):
+            if not valid_l[i][j]:
+                continue
+            npcs_pos.append({
+                'x': npc_pos[i][j][0],
+                'y': npc_pos[i][j][1],
+                'z': npc_pos[i][j][2],
+                'will_collide': will_collide_l[i][j]
+            })
+
+        interaction_per_frame.append({
+            'timestamp': timestamps[i],
+            'frame_num': frame_nums[i],
+            'interaction_rate': rate_l[i],
+            'npcs_pos': npcs_pos
+        })
+    return ego_pos_l, interaction_per_frame
+
+
+def write_result(result_to_save: dict, buf: FrameBuffer,
+                 sce_result_path: str, save_video=True,
+                 result_format='json'):
+    '''
+        Fill the per-frame records of `buf` into `result_to_save` and write
+        it to `sce_result_path`/result.json, removes the video unless
+        `save_video`. Runs on the ResultWriter thread when there is one.
+
+        With result_format 'npz' the per-frame records go to trace.npz and
+        result.json only keeps the summary, read it back with load_result().
+    '''
+    metrics = get_segment_metrics(buf)
+    trace = None
+    if metrics is None:
+        result_to_save['interaction'] = None
+        result_to_save['Odometer'] = None
+    else:
+        trace = get_trace_columns(buf, metrics)
+        result_to_save['Odometer'] = {
+            'total_distance': round(metrics.total_distance, 2)
+        }
+        result_to_save['interaction'] = {
+            'interact_frame_rate': metrics.will_collide_frame_cnt / len(buf)
+        }
+        if result_format == 'npz':
+            result_to_save['trace_path'] = TRACE_FILE
+        else:
+            ego_pos_l, interaction_per_frame = get_frame_records(trace)
+            result_to_save['Odometer']['pos_per_frame'] = ego_pos_l
+            result_to_save['interaction']['per_frame'] = interaction_per_frame
+    # errors go to the caller, ResultWriter.run_job logs and counts them
+    if result_format == 'npz' and trace is not None:
+        np.savez(os.path.join(sce_result_path, TRACE_FILE), **trace)
+    resule_str = json.dumps(result_to_save, indent=4)
+    result_path = os.path.join(sce_result_path, 'result.json')
+    with open(result_path, 'w') as f:
+        f.write(resule_str)
+    if not save_video:
+        if result_to_save['video_path'] and \
+                os.path.isfile(result_to_save['video_path']):
+            os.remove(result_to_save['video_path'])
+            result_to_save['video_path'] = 'deleted'
 
-                if pre_frame:
-                    pre_ego_ss = pre_frame['ego_ss']
-                    delta_dis = abs(ego_ss.get_transform().location.distance(
-                        pre_ego_ss.get_transform().location))
-                    run_distance += delta_dis
-
-                pre_colli_cunt = 0
-                this_frame_has_colli = False
-                npcs_pos = []
-                for npc_ss in npcs_ss:
-                    if npc_ss == None:
-                        continue
-                    will_collide, t = predict_collision(ego_ss, npc_ss)
-                    pre_colli_cunt += 1 if will_collide else 0
-                    if will_collide:
-                        this_frame_has_colli = True
-                    npc_loc = npc_ss.get_transform().location
-                    npcs_pos.append({
-                        'x': npc_loc.x,
-                        'y': npc_loc.y,
-                        'z': npc_loc.z,
-                        'will_collide': will_collide
-                    })
-
-                will_collide_frame_cnt += 1 if this_frame_has_colli else 0
-                will_collide_rate = pre_colli_cunt / \
-                    len(npcs_ss) if npcs_ss else 0
-
-                interaction_per_frame.append({
-                    'timestamp': frame['timestamp'],
-                    'frame_num': frame['frame'],
-                    'interaction_rate': will_collide_rate,
-                    'npcs_pos':npcs_pos
-                })
 
-                pre_frame = frame
-
-            self.result_to_save['Odometer'] = {
-                'total_distance': round(run_distance, 2),
-                'pos_per_frame': ego_pos_l
-            }
-            self.result_to_save['interaction'] = {
-                'interact_frame_rate': will_collide_frame_cnt / total_frame_num,
-                'per_frame': interaction_per_frame
-            }
-        try:
-            resule_str = json.dumps(self.result_to_save, indent=4)
-            result_path = os.path.join(self.sce_result_path, 'result.json')
-            with open(result_path, 'w') as f:
-                f.write(resule_str)
-            if not save_video:
-                if os.path.isfile(self.result_to_save['video_path']):
-                    os.remove(self.result_to_save['video_path'])
-                    self.result_to_save['video_path'] = 'deleted'
-        except Exception as e:
-            print(e)
+def load_result(sce_result_path: str) -> dict:
+    '''
+        Read the result.json of a scenario folder, in the layout written by
+        result_format 'json' whichever format it was saved with.
+    '''
+    with open(os.path.join(sce_result_path, 'result.json'), 'r') as f:
+        result = json.load(f)
+    trace_file = result.pop('trace_path', None)
+    if trace_file:
+        with np.load(os.path.join(sce_result_path, trace_file)) as data:
+            trace = {name: data[name] for name in TRACE_COLUMNS}
+        ego_pos_l, interaction_per_frame = get_frame_records(trace)
+        result['Odometer']['pos_per_frame'] = ego_pos_l
+        result['interaction']['per_frame'] = interaction_per_frame
+    return result
@@ -0,0 +1,99 @@
+import queue
+import threading
+import time
+
+from loguru import logger
+
+
+class ResultWriter(object):
+    '''
+        Background stage that runs result saving jobs (building result.json,
+        writing it, removing videos) off the simulation loop.
+
+        Jobs are callables taking no argument. The queue is bounded: when
+        `max_pending` jobs are waiting `submit()` blocks until the worker
+        catches up, so a slow disk throttles the simulation instead of
+        growing memory. `close()` writes every pending job before returning.
+    '''
+
+    def __init__(self, max_pending=4, logger=logger):
+        self.logger = logger
+        self.job_queue = queue.Queue(maxsize=max_pending)
+        self.worker_thread: threading.Thread = None
+        self.closed = False
+
+        self.written = 0
+        self.failed = 0
+
+    def start(self):
+        if self.worker_thread and self.worker_thread.is_alive():
+            return
+        self.closed = False
+        self.worker_thread = threading.Thread(target=self.worker_handler,
+                                              name='result_writer',
+                                              daemon=True)
+        self.worker_thread.start()
+
+    def submit(self, job):
+        if self.closed or not self.worker_thread:
+            # no worker, write in the caller
+            self.run_job(job)
+            return
+        try:
+            self.job_queue.put_nowait(job)
+        except queue.Full:
+            self.logger.warning('[ResultWriter] queue full, waiting for the writer')
+            start_time = time.time()
+            self.job_queue.put(job)
+            self.logger.warning(
+                f'[ResultWriter] waited {time.time() - start_time:.2f}s')
+
+    def run_job(self, job):
+        try:
+            job()
+            self.written += 1
+        except Exception as e:
+            self.failed += 1
+            self.logger.error(f'[ResultWriter] fail to save result: {e}')
+
+    def worker_handler(self):
+        while True:
+            job = self.job_queue.get()
+            try:
+                if job is None:
+                    return
+                self.run_job(job)
+            finally:
+                self.job_queue.task_done()
+
+    def pending(self):
+        return self.job_queue.unfinished_tasks
+
+    def flush(self, timeout=None) -> bool:
+        '''
+            Wait until every submitted job is written.
+            return: False if `timeout` expired first
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.job_queue.all_tasks_done:
+            while self.job_queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.job_queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=None) -> bool:
+        if self.closed:
+            return True
+        flushed = self.flush(timeout)
+        self.closed = True
+        if self.worker_thread:
+            if flushed:
+                self.job_queue.put(None)
+                self.worker_thread.join()
+            self.worker_thread = None
+        if not flushed:
+            self.logger.warning(
+                f'[ResultWriter] closed with {self.pending()} results unsaved')
+        return flushed
@@ -17,9 +17,14 @@ from MS_fuzz.ga_engine.gene import *
 from agents.navigation.behavior_agent import BehaviorAgent
 from MS_fuzz.ga_engine.scene_segmentation import Segment
 from MS_fuzz.ms_utils import calc_relative_loc, calc_relative_loc_dict
-from MS_fuzz.ms_utils import get_crosswalk_list, is_point_in_any_crosswalk
+from MS_fuzz.ms_utils import CrosswalkIndex
+from MS_fuzz.ms_utils.map_catalog import MapCatalog, get_map_catalog, get_route_planner
+from MS_fuzz.ms_utils.stage_profiler import StageProfiler, get_stage_profiler
 from MS_fuzz.ga_engine.gene import GeneNpcWalkerList, GeneNpcVehicleList
 from MS_fuzz.common.evaluate import Evaluate_Object
+from MS_fuzz.common.frame_buffer import FrameBuffer
+from MS_fuzz.common.metrics import predict_frame_collisions
+from MS_fuzz.common.kinematic_controller import KinematicController, KINEMATIC_SPEEDS
 
 
 class NpcBase(object):
@@ -70,6 +75,10 @@ class NpcVehicle(NpcBase):
         self.vehicle: carla.Vehicle = None  # the actor object
         self.vehicle_id: str = vehicle_id
         self.start_speed: float = start_speed
+        # row in LocalScenario.kinematic, npc_controller 'kinematic' only
+        self.controller_index: int = None
+        # last LocalScenario.refresh_id the control thread has stepped
+        self.refresh_id = 0
 
 
 class NpcWalker(NpcBase):
@@ -101,7 +110,8 @@ class LocalScenario(object):
             1. add npcs into npc list by `add_npc_vehicle()` or `add_npc_walker()`
             2. spawn npcs by `spawn_all_npcs()`
             3. start running by `scenario_start()`
-            4. tick the scenario repeatedly by `npc_refresh()`
+            4. tick the scenario repeatedly by `npc_refresh()`, then send
+               the npc controls by `pop_npc_commands()` and `client.apply_batch`
             5. stop all running walkers & vehicles by `stop_all_npcs()`
             6. remove all of them from the scenario by `remove_all_npcs()`
 
@@ -111,13 +121,24 @@ class LocalScenario(object):
     def __init__(self,
                  carla_world: carla.World,
                  ego_vhicle: carla.Vehicle,
-                 logger=logger):
+                 logger=logger,
+                 retain_frames=True,
+                 npc_controller='agent',
+                 carla_client: carla.Client = None):
+        '''
+            npc_controller: 'agent', a BehaviorAgent per npc vehicle, or
+                'kinematic', all npc vehicles follow their routes with one
+                KinematicController stepped in npc_refresh()
+            carla_client: npc controls are queued for `pop_npc_commands()`
+                when given, applied one by one otherwise
+        '''
         self.id = ''
         self.scen_seg: Segment = None
         self.logger = logger
         self.ego: carla.Vehicle = ego_vhicle
         self.carla_world: carla.World = carla_world
-        self.carla_map: carla.Map = self.carla_world.get_map()
+        self.map_catalog: MapCatalog = get_map_catalog(self.carla_world)
+        self.carla_map: carla.Map = self.map_catalog.carla_map
 
         self.scenario_start_time: carla.Timestamp = self.carla_world.get_snapshot().timestamp
 
@@ -150,8 +171,27 @@ class LocalScenario(object):
         self.running: bool = False
 
         self.evaluate_obj: Evaluate_Object = None
-        self.crosswalk_list = get_crosswalk_list(
-            self.carla_map.get_crosswalks())
+        self.frame_buffer: FrameBuffer = None
+        # keep every frame for the result saver, or only the latest one
+        self.retain_frames = retain_frames
+        self.crosswalk_list = self.map_catalog.crosswalk_list
+        self.crosswalk_index: CrosswalkIndex = self.map_catalog.crosswalk_index
+
+        self.carla_client: carla.Client = carla_client
+        self.npc_controller = npc_controller
+        self.kinematic: KinematicController = None
+        self.kinematic_lock = threading.Lock()
+
+        # npc controls of the current tick, see pop_npc_commands()
+        self.refresh_id = 0
+        self.command_condition = threading.Condition()
+        self.pending_velocities = []
+        self.pending_controls = []
+
+        self.profiler: StageProfiler = get_stage_profiler()
+        if self.npc_controller == 'kinematic':
+            self.kinematic = KinematicController(
+                delta=self.carla_world.get_settings().fixed_delta_seconds or 0.05)
 
     def attach_segment(self, segment: Segment):
         self.scen_seg = segment
@@ -394,11 +434,32 @@ class LocalScenario(object):
             # is a parked vehicle
             return
 
+        if self.kinematic is not None:
+            route_xy = self.get_route_xy(vehicle.start_loc.location,
+                                         vehicle.end_loc.location)
+            if len(route_xy) == 0:
+                logger.warning(f'No route for vehicle {vehicle.vehicle_id}, '
+                               f'held with the brake')
+            # wheelbase of the usual cars, about 60% of their length
+            wheelbase = 1.2 * vehicle.vehicle.bounding_box.extent.x
+            with self.kinematic_lock:
+                vehicle.controller_index = self.kinematic.add_vehicle(
+                    route_xy, KINEMATIC_SPEEDS[vehicle.agent_type] / 3.6, wheelbase)
+            return
+
+        # the map and the route graph are shared by all agents
         vehicle.agent = BehaviorAgent(vehicle.vehicle,
-                                      behavior=vehicle.agent_type)
+                                      behavior=vehicle.agent_type,
+                                      map_inst=self.carla_map,
+                                      grp_inst=get_route_planner(self.carla_map))
         vehicle.agent.set_destination(vehicle.end_loc.location)
         return
 
+    def get_route_xy(self, start: carla.Location, end: carla.Location) -> np.ndarray:
+        route = get_route_planner(self.carla_map).trace_route(start, end)
+        return np.array([(wp.transform.location.x, wp.transform.location.y)
+                         for wp, _ in route]).reshape(-1, 2)
+
     def spawn_a_walker_handler(self, walker: NpcWalker):
         walker.walker = self.carla_world.try_spawn_actor(walker.blueprint,
                                                          walker.start_loc)
@@ -455,6 +516,9 @@ class LocalScenario(object):
                 continue
             if vehicle.vehicle == None:
                 continue
+            if vehicle.controller_index is not None:
+                # driven by kinematic_step()
+                continue
             vehicle.close_event = threading.Event()
             vehicle.control_thread = threading.Thread(
                 target=self.vehicle_control_handler,
@@ -484,47 +548,51 @@ class LocalScenario(object):
 
     def vehicle_control_handler(self, vehicle: NpcVehicle):
         while not vehicle.close_event.is_set():
+            # wait for a refresh this vehicle has not stepped yet, the lock
+            # is only held to read it, agents step concurrently
             with self.refresh_condition:
-                self.refresh_condition.wait()
-                if vehicle.close_event.is_set():
-                    break
-                # 1. wait until vehicle can run
-                if (not vehicle.is_running and
-                    not vehicle.close_event.is_set()
-                    ):
-                    # Check if it's time for this vehicle to run
-                    curr_time = self.carla_world.get_snapshot().timestamp
-                    time_passed = curr_time.elapsed_seconds - \
-                        self.scenario_start_time.elapsed_seconds
-                    if time_passed >= vehicle.start_time:
-                        if vehicle.behavior_type == 0:
-                            forward_vector = vehicle.vehicle.get_transform().rotation.get_forward_vector()
-                            start_velocity = forward_vector * vehicle.start_speed
-                            vehicle.vehicle.set_target_velocity(start_velocity)
-                        vehicle.is_running = True
-                if vehicle.close_event.is_set():
-                    break
-
-                # 2. Once the vehicle starts running, wait for refresh signal from main thread
-                elif (vehicle.is_running and
-                      not vehicle.close_event.is_set()):
-
-                    # Apply control to the vehicle
-                    ctrl = vehicle.agent.run_step(debug=True)
-                    vehicle.vehicle.apply_control(ctrl)
-
-                    # print(f"Controlling {vehicle.vehicle_id}, at {vehicle.agent}")
-
-                    if vehicle.agent.done():
-                        if not vehicle.free_roam:
-                            # finished, close the thread
-                            vehicle.reached_destination = True
-                            vehicle.is_running = False
-                            return
-                        else:
-                            new_dest = random.choice(
-                                self.carla_map.get_spawn_points())
-                            vehicle.agent.set_destination(new_dest.location)
+                self.refresh_condition.wait_for(
+                    lambda: self.refresh_id != vehicle.refresh_id
+                    or vehicle.close_event.is_set())
+                refresh_id = self.refresh_id
+            if vehicle.close_event.is_set():
+                break
+            # 1. wait until vehicle can run
+            if not vehicle.is_running:
+                # Check if it's time for this vehicle to run
+                curr_time = self.carla_world.get_snapshot().timestamp
+                time_passed = curr_time.elapsed_seconds - \
+                    self.scenario_start_time.elapsed_seconds
+                if time_passed >= vehicle.start_time:
+                    if vehicle.behavior_type == 0:
+                        forward_vector = vehicle.vehicle.get_transform().rotation.get_forward_vector()
+                        start_velocity = forward_vector * vehicle.start_speed
+                        self.queue_npc_command(vehicle, velocity=start_velocity)
+                    vehicle.is_running = True
+            if vehicle.close_event.is_set():
+                break
+
+            # 2. Once the vehicle starts running, step it once per refresh
+            elif vehicle.is_running:
+
+                # Apply control to the vehicle
+                ctrl = vehicle.agent.run_step(debug=True)
+                self.queue_npc_command(vehicle, control=ctrl)
+
+                # print(f"Controlling {vehicle.vehicle_id}, at {vehicle.agent}")
+
+                if vehicle.agent.done():
+                    if not vehicle.free_roam:
+                        # finished, close the thread
+                        vehicle.reached_destination = True
+                        vehicle.is_running = False
+                        self.vehicle_stepped(vehicle, refresh_id)
+                        return
+                    else:
+                        new_dest = random.choice(
+                            self.map_catalog.spawn_points)
+                        vehicle.agent.set_destination(new_dest.location)
+            self.vehicle_stepped(vehicle, refresh_id)
 
         # If close_event is set, stop the vehicle
         vehicle.vehicle.apply_control(vehicle.agent.emergency_stop())
@@ -606,24 +674,143 @@ class LocalScenario(object):
         '''
             refresh all npc control, called every time you tick the world
         '''
-        with self.refresh_condition:
-            self.refresh_condition.notify_all()
+        with self.profiler.stage('npc_refresh'):
+            with self.refresh_condition:
+                self.refresh_id += 1
+                self.refresh_condition.notify_all()
+        if self.kinematic is not None and len(self.kinematic):
+            with self.profiler.stage('kinematic_step'):
+                self.kinematic_step()
+
+    def queue_npc_command(self, vehicle: NpcVehicle, control: carla.VehicleControl = None,
+                          velocity: carla.Vector3D = None):
+        if self.carla_client is None:
+            if velocity is not None:
+                vehicle.vehicle.set_target_velocity(velocity)
+            if control is not None:
+                vehicle.vehicle.apply_control(control)
+            return
+        with self.command_condition:
+            if velocity is not None:
+                self.pending_velocities.append((vehicle, velocity))
+            if control is not None:
+                self.pending_controls.append((vehicle, control))
+
+    def vehicle_stepped(self, vehicle: NpcVehicle, refresh_id):
+        # called by the control threads once per refresh they step
+        with self.command_condition:
+            vehicle.refresh_id = refresh_id
+            self.command_condition.notify_all()
+
+    def pop_npc_commands(self, deadline=None) -> List[carla.command.ApplyVehicleControl]:
+        '''
+            The npc commands queued since the last call, for one
+            `client.apply_batch` of all scenarios per tick.
+            deadline: time.monotonic() until which to wait for the control
+                threads to step the last `npc_refresh()`, None takes what is
+                queued without waiting; a late control goes with the next tick
+        '''
+        def all_stepped():
+            return all(vehicle.refresh_id == self.refresh_id
+                       for vehicle in self.npc_vehicle_list
+                       if vehicle.control_thread and vehicle.control_thread.is_alive()
+                       and not vehicle.reached_destination)
+
+        with self.profiler.stage('npc_wait'), self.command_condition:
+            if deadline is not None:
+                self.command_condition.wait_for(
+                    all_stepped, max(deadline - time.monotonic(), 0))
+            velocities, self.pending_velocities = self.pending_velocities, []
+            controls, self.pending_controls = self.pending_controls, []
+        commands = [carla.command.ApplyTargetVelocity(vehicle.vehicle.id, velocity)
+                    for vehicle, velocity in velocities]
+        commands += [carla.command.ApplyVehicleControl(vehicle.vehicle.id, control)
+                     for vehicle, control in controls]
+        return commands
+
+    def kinematic_step(self):
+        '''
+            One KinematicController step over all npc vehicles of the
+            scenario, states read from the latest world snapshot.
+        '''
+        world_ss = self.carla_world.get_snapshot()
+        # spawn_a_vehicle_handler adds vehicles from other threads
+        with self.kinematic_lock:
+            time_passed = world_ss.timestamp.elapsed_seconds - \
+                self.scenario_start_time.elapsed_seconds
+            vehicle_num = len(self.kinematic)
+            poses = np.zeros((vehicle_num, 3))
+            speeds = np.zeros(vehicle_num)
+            active = np.zeros(vehicle_num, dtype=bool)
+            vehicles: List[NpcVehicle] = []
+            for vehicle in self.npc_vehicle_list:
+                if vehicle.controller_index is None:
+                    continue
+                vehicle_ss = world_ss.find(vehicle.vehicle.id)
+                if vehicle_ss is None:
+                    continue
+                transform = vehicle_ss.get_transform()
+                if not vehicle.is_running and not vehicle.reached_destination \
+                        and time_passed >= vehicle.start_time:
+                    vehicle.is_running = True
+                    if vehicle.behavior_type == 0:
+                        self.queue_npc_command(
+                            vehicle, velocity=transform.rotation.get_forward_vector()
+                            * vehicle.start_speed)
+                if not vehicle.is_running:
+                    continue
+                velocity = vehicle_ss.get_velocity()
+                row = vehicle.controller_index
+                poses[row] = (transform.location.x, transform.location.y,
+                              transform.rotation.yaw)
+                speeds[row] = math.hypot(velocity.x, velocity.y)
+                active[row] = True
+                vehicles.append(vehicle)
+
+            throttle, steer, brake, done = self.kinematic.step(poses, speeds, active)
+
+            for vehicle in vehicles:
+                row = vehicle.controller_index
+                if done[row]:
+                    if vehicle.free_roam:
+                        new_dest = random.choice(self.map_catalog.spawn_points)
+                        route_xy = self.get_route_xy(
+                            carla.Location(poses[row, 0], poses[row, 1], 0),
+                            new_dest.location)
+                        # without a route it keeps braking, another destination
+                        # is tried next tick
+                        if len(route_xy):
+                            self.kinematic.set_route(row, route_xy)
+                    else:
+                        vehicle.reached_destination = True
+                        vehicle.is_running = False
+                self.queue_npc_command(vehicle, control=carla.VehicleControl(
+                    throttle=float(throttle[row]), steer=float(steer[row]),
+                    brake=float(brake[row])))
 
     def refresh_blueprint(self, world: carla.World):
-        self.world_blueprint = world.get_blueprint_library()
-        self.vehicle_blueprint = self.world_blueprint.filter('vehicle')
-        self.walker_blueprint = self.world_blueprint.filter('walker')
-
-        self.vehicle_car_bps = [bp for bp in self.vehicle_blueprint if bp.get_attribute(
-            'base_type') == "car"]
-        self.vehicle_truck_bps = [bp for bp in self.vehicle_blueprint if bp.get_attribute(
-            'base_type') == "truck"]
-        self.vehicle_van_bps = [bp for bp in self.vehicle_blueprint if bp.get_attribute(
-            'base_type') == "van"]
-        self.vehicle_motorcycle_bps = [bp for bp in self.vehicle_blueprint if bp.get_attribute(
-            'base_type') == "motorcycle"]
-        self.vehicle_bycicle_bps = [bp for bp in self.vehicle_blueprint if bp.get_attribute(
-            'base_type') == "bycicle"]
+        # blueprints are fetched once per world load and shared, see MapCatalog
+        catalog = get_map_catalog(world)
+        self.world_blueprint = catalog.world_blueprint
+        self.vehicle_blueprint = catalog.vehicle_blueprint
+        self.walker_blueprint = catalog.walker_blueprint
+
+        self.vehicle_car_bps = catalog.get_vehicle_bps("car")
+        self.vehicle_truck_bps = catalog.get_vehicle_bps("truck")
+        self.vehicle_van_bps = catalog.get_vehicle_bps("van")
+        self.vehicle_motorcycle_bps = catalog.get_vehicle_bps("motorcycle")
+        self.vehicle_bycicle_bps = catalog.get_vehicle_bps("bycicle")
+
+    def get_frame_buffer(self) -> FrameBuffer:
+        '''
+            The frame buffer read by the result saver, created on first use
+            with one npc slot per spawned vehicle.
+        '''
+        if self.frame_buffer is None:
+            self.frame_buffer = FrameBuffer(
+                len([v for v in self.npc_vehicle_list if v.vehicle]),
+                retain_frames=self.retain_frames)
+        return self.frame_buffer
 
     def evaluate_snapshot_record(self, world_snapshot: carla.WorldSnapshot):
         '''
@@ -635,6 +822,9 @@ class LocalScenario(object):
                 f_crossing_time : Time taken to cross the road
             3. for npc_vehicles:s
                 f_interaction_rate: the rate at which vehicles interact with the ego vehicle
+
+            return: the index of the recorded frame in `frame_buffer`,
+                    None if the ego is not in the snapshot
         '''
         frame = world_snapshot.frame
         ego_ss = world_snapshot.find(self.ego.id)
@@ -651,41 +841,32 @@ class LocalScenario(object):
                 continue
             npc_walkers_ss.append(world_snapshot.find(walker.walker.id))
 
+        ego_loc = ego_ss.get_transform().location
         min_dis = 9999
         for npc in npc_vehicles_ss + npc_walkers_ss:
-            if ego_ss == None:
-                return None
             if npc == None:
                 continue
-            dis = ego_ss.get_transform().location.distance(npc.get_transform().location)
+            dis = ego_loc.distance(npc.get_transform().location)
             if dis < min_dis:
                 min_dis = dis
 
-        unsmooth_acc = 0 if (abs(ego_ss.get_acceleration().x) < 4) else (
-            abs(ego_ss.get_acceleration().x) - 4)
-
-        walker_in_road = 0
-        for walker in npc_walkers_ss:
-            if walker == None:
-                continue
-            if is_point_in_any_crosswalk(walker.get_transform().location, self.crosswalk_list):
-                walker_in_road += 1
-
-        frame_record = {
-            'timestamp': time.time(),
-            'frame': frame,
-            'min_dis': min_dis,
-            'unsmooth_acc': unsmooth_acc,
-            'walker_in_road': walker_in_road,
-            'npc_vehicles_ss': npc_vehicles_ss,
-            'ego_ss': ego_ss
-        }
+        ego_acc_x = ego_ss.get_acceleration().x
+        unsmooth_acc = 0 if (abs(ego_acc_x) < 4) else (abs(ego_acc_x) - 4)
+
+        walker_in_road = self.crosswalk_index.count_in_crosswalk(
+            [walker.get_transform().location for walker in npc_walkers_ss
+             if walker != None])
+
+        buf = self.get_frame_buffer()
+        index = buf.append(timestamp=time.time(),
+                           frame=frame,
+                           min_dis=min_dis,
+                           unsmooth_acc=unsmooth_acc,
+                           walker_in_road=walker_in_road,
+                           ego_ss=ego_ss,
+                           npc_vehicles_ss=npc_vehicles_ss)
+        will_collide = predict_frame_collisions(buf, index)
         if self.evaluate_obj:
-            self.evaluate_obj.frame_recorded.append(frame_record)
-        return frame_record
-        # caculate later
-        # vehicle_may_collide = 0
-        # for vehicle in npc_vehicles_ss:
-        #     collision, c_t = self.predict_collision(vehicle, ego_ss)
-        #     if collision:
-        #         vehicle_may_collide += 1
+            self.evaluate_obj.record_frame(min_dis, unsmooth_acc,
+                                           walker_in_road, will_collide)
+        return index
@@ -1,4 +1,5 @@
 import os
+import json
 import carla
 import time
 import numpy as np
@@ -15,17 +16,23 @@ from multiprocessing import Queue
 
 from MS_fuzz.fuzz_config.Config import Config
 from MS_fuzz.ms_utils import calc_relative_loc
+from MS_fuzz.ms_utils.map_catalog import MapCatalog, get_map_catalog, invalidate_map_catalog
+from MS_fuzz.ms_utils.map_catalog import get_route_cache_stats
+from MS_fuzz.ms_utils.stage_profiler import StageProfiler, get_stage_profiler
 from carla_bridge.apollo_carla_bridge import CarlaCyberBridge
 from carla_bridge.utils.transforms import carla_transform_to_cyber_pose
 from carla_bridge.utils.logurus import init_log
 from carla_bridge.dreamview_carla import dreamview
 
 from MS_fuzz.common.scenario import LocalScenario
-from MS_fuzz.common.camera_agent_imageio import ScenarioRecorder
+from MS_fuzz.common.camera_agent_imageio import ScenarioRecorder, RECORDING_PROFILES
 from MS_fuzz.common.unsafe_detector import UNSAFE_TYPE, UnsafeDetector
 from MS_fuzz.common.evaluate import Evaluate_Object, Evaluate_Transfer
 from MS_fuzz.ga_engine.scene_segmentation import SceneSegment
+from MS_fuzz.ga_engine.route_planner import select_route
 from MS_fuzz.common.result_saver import ResultSaver
+from MS_fuzz.common.result_writer import ResultWriter
+from MS_fuzz.common.tick_driver import TickDriver
 
 import pdb
 
@@ -63,13 +70,22 @@ class Simulator(object):
 
     def __init__(self, cfgs: Config,
                  eva_req_queue: Queue = None,
-                 eva_res_queue: Queue = None):
+                 eva_res_queue: Queue = None,
+                 coverage_queue: Queue = None):
         self.carla_client = None
         self.carla_world = None
         self.carla_map = None
+        self.map_catalog: MapCatalog = None
         self.ego_vehicle = None
 
         self.destination = None
+        # route planned offline to self.destination, see select_valid_dest
+        self.planned_route = None
+        # set once Apollo's routing has confirmed or replaced the segments
+        self.route_checked = threading.Event()
+        # Apollo drives other roads than the planned route, see apply_route_check
+        self.route_mismatch = False
+        self.route_check_thread: threading.Thread = None
 
         self.carla_bridge_thread = None
         self.cfgs: Config = cfgs
@@ -100,6 +116,8 @@ class Simulator(object):
         # self.ga_lib: Dict[str, CEGA] = ga_lib
         self.eva_req_queue = eva_req_queue
         self.eva_res_queue = eva_res_queue
+        # GA_LIB replies to get_coverage here, see get_ga_coverage
+        self.coverage_queue = coverage_queue
 
         self.close_event = threading.Event()
         self.closing = False
@@ -107,12 +125,34 @@ class Simulator(object):
 
         self.recorder: ScenarioRecorder = None
         self.unsafe_detector: UnsafeDetector = None
-        self.result_saver: ResultSaver = ResultSaver()
+        self.result_writer: ResultWriter = ResultWriter(
+            max_pending=self.cfgs.result_queue_size)
+        self.result_writer.start()
+        # CARLA recorder log of the current segment, recorder_profile 'replay'
+        self.carla_log_path = None
+        # logs of safe segments to remove, carla_log_retention 'unsafe'
+        self.safe_carla_logs = []
+        self.result_saver: ResultSaver = ResultSaver(
+            result_writer=self.result_writer,
+            result_format=self.cfgs.result_format)
         self.is_recording = False
 
         self.on_unsafe_lock = False
         self.start_unsafe_callback = False
 
+        self.fixed_delta_seconds = 0.05
+        # per tick wait for the npc agents to step on the new frame
+        self.npc_command_wait = 0.1
+        # ticks the world when cfgs.tick_driver, the bridge does otherwise
+        self.tick_driver: TickDriver = None
+        # held while prev / curr / next scenarios change, the tick driver
+        # skips their npc step and recording meanwhile
+        self.scenario_lock = threading.RLock()
+
+        # stage timings, dumped to profile.json per scenario
+        self.profiler: StageProfiler = get_stage_profiler()
+        self.profiler.set_enabled(self.cfgs.profile_stages)
+
     def carla_bridge_handler(self, ego_spawn_point: dict = None):
         try:
             parameters = {
@@ -120,10 +160,10 @@ class Simulator(object):
                     'host': self.cfgs.sim_host,
                     'port': self.cfgs.sim_port,
                     'timeout': self.cfgs.load_world_timeout,
-                    'passive': False,
+                    'passive': self.tick_driver != None,
                     'synchronous_mode': True,
                     'synchronous_mode_wait_for_vehicle_control_command': False,
-                    'fixed_delta_seconds': 0.05,
+                    'fixed_delta_seconds': self.fixed_delta_seconds,
                     'register_all_sensors': True,
                     'town': self.cfgs.carla_map,
                     'ego_vehicle': {
@@ -135,6 +175,9 @@ class Simulator(object):
             self.carla_bridge.initialize_bridge(self.carla_world,
                                                 parameters,
                                                 logger)
+            if self.tick_driver != None:
+                # a passive bridge only hooks on_tick, keep it until closing
+                self.close_event.wait()
 
         except (IOError, RuntimeError) as e:
             logger.error(f"[Bridge] Error: {e}")
@@ -202,7 +245,9 @@ class Simulator(object):
                                                      (self.cfgs.carla_map + '_Opt').lower()]:
                 self.carla_world = self.carla_client.load_world(
                     self.cfgs.carla_map)
-            self.carla_map = self.carla_world.get_map()
+                invalidate_map_catalog()
+            self.map_catalog = get_map_catalog(self.carla_world)
+            self.carla_map = self.map_catalog.carla_map
 
         except Exception as e:
             logger.error(f'[Simulator] Connect Carla wrong: {e}')
@@ -216,6 +261,8 @@ class Simulator(object):
     def init_environment(self) -> bool:
         self.connect_carla()
 
+        if self.cfgs.tick_driver:
+            self.start_tick_driver()
         self.load_carla_bridge(ego_spawn_loc=self.ego_spawn_loc)
         time.sleep(2)
         retry_times = 0
@@ -245,6 +292,65 @@ class Simulator(object):
         time.sleep(2)
         return True
 
+    def start_tick_driver(self):
+        self.tick_driver = TickDriver(self.carla_world,
+                                      fixed_delta_seconds=self.fixed_delta_seconds,
+                                      real_time_factor=self.cfgs.real_time_factor,
+                                      profiler=self.profiler if self.profiler.enabled else None)
+        # the bridge publishes from its on_tick callback right after the tick
+        self.tick_driver.add_stage('npc', self.step_npcs)
+        self.tick_driver.add_stage('record', self.record_frame)
+        self.tick_driver.add_stage('unsafe', self.check_unsafe)
+        self.tick_driver.start()
+        logger.info(f'[Simulator] Tick driver started, real time factor '
+                    f'{self.cfgs.real_time_factor}')
+
+    def wait_for_frame(self) -> carla.WorldSnapshot:
+        with self.profiler.stage('wait_for_tick'):
+            if self.tick_driver != None:
+                return self.tick_driver.wait_for_frame(timeout=self.cfgs.load_world_timeout)
+            return self.carla_world.wait_for_tick()
+
+    def record_snapshot(self, world_ss: carla.WorldSnapshot):
+        with self.profiler.stage('snapshot_record'):
+            self.curr_local_scenario.evaluate_snapshot_record(world_ss)
+
+    def running_scenarios(self):
+        scenarios = []
+        for scenario in [self.prev_local_scenario,
+                         self.curr_local_scenario,
+                         self.next_local_scenario]:
+            if scenario != None and scenario.running and \
+                    all(scenario is not s for s in scenarios):
+                scenarios.append(scenario)
+        return scenarios
+
+    def step_npcs(self, world_ss: carla.WorldSnapshot = None):
+        if not self.scenario_lock.acquire(blocking=False):
+            return
+        try:
+            for scenario in self.running_scenarios():
+                scenario.npc_refresh()
+            self.apply_npc_commands()
+        finally:
+            self.scenario_lock.release()
+
+    def record_frame(self, world_ss: carla.WorldSnapshot):
+        if not self.is_recording:
+            return
+        if not self.scenario_lock.acquire(blocking=False):
+            return
+        try:
+            if self.curr_local_scenario != None and self.curr_local_scenario.running:
+                self.record_snapshot(world_ss)
+        finally:
+            self.scenario_lock.release()
+
+    def check_unsafe(self, world_ss: carla.WorldSnapshot):
+        unsafe_detector = self.unsafe_detector
+        if unsafe_detector != None and unsafe_detector.frame_driven:
+            unsafe_detector.check_frame(world_ss)
+
     def initialization(self):
         now = datetime.now()
         date_time = now.strftime("%Y%m%d_%H%M%S")
@@ -264,9 +370,17 @@ class Simulator(object):
         if not os.path.exists(self.result_path):
             os.makedirs(self.result_path)
 
-        self.recorder = ScenarioRecorder(self.carla_world,
-                                         self.ego_vehicle,
-                                         self.result_path)
+        if self.cfgs.recorder_profile in RECORDING_PROFILES:
+            cameras, resolution = RECORDING_PROFILES[self.cfgs.recorder_profile]
+            self.recorder = ScenarioRecorder(self.carla_world,
+                                             self.ego_vehicle,
+                                             self.result_path,
+                                             resolution=resolution,
+                                             pre_trigger_seconds=self.cfgs.recorder_pre_trigger,
+                                             downscale=self.cfgs.recorder_downscale,
+                                             cameras=cameras)
+        else:
+            logger.info(f'[Simulator] recorder profile {self.cfgs.recorder_profile}, no video')
 
         self.unsafe_detector = UnsafeDetector(self.carla_world,
                                               self.ego_vehicle)
@@ -279,13 +393,23 @@ class Simulator(object):
         self.scene_segmentation = SceneSegment(self.carla_world,
                                                self.ego_vehicle,
                                                logger=logger,
-                                               debug=False)
+                                               debug=False,
+                                               cache_dir=self.cfgs.cache_dir)
 
         self.scene_segmentation.routing_listener.start()
 
         times = 0
         success = False
+        self.route_checked.clear()
+        self.route_mismatch = False
         self.destination = self.select_valid_dest(min_radius=100, max_radius=9999)
+        if self.planned_route:
+            # the segments are known before Apollo routes, its routing
+            # response only confirms them, see check_planned_route
+            self.scene_segmentation.set_planned_segments(self.planned_route)
+            logger.info(f'[Simulator] Gained {len(self.scene_segmentation.segments)} '
+                        f'planned segs')
+            self.scene_segmentation.strat_vehicle_pos_listening()
         logger.info('[Simulator] setting up apollo')
         while times < 3:
             try:
@@ -317,6 +441,31 @@ class Simulator(object):
         logger.info(f"[Simulator] World is set to {synchronous_mode_str} mode")
         logger.info(f"[Simulator] Running ...")
 
+        if self.planned_route:
+            # handle_segs loads the first scenarios meanwhile, it starts them
+            # once the route is checked
+            self.route_check_thread = threading.Thread(
+                target=self.check_planned_route, args=(route_req_time,),
+                name='route_check')
+            self.route_check_thread.start()
+        else:
+            if not self.wait_for_apollo_route(route_req_time):
+                self.close()
+
+            self.scene_segmentation.get_segments(self.cfgs.scenario_length,
+                                                 self.cfgs.scenario_width)
+            logger.info('[Simulator] Scene Segmentation Initialized')
+            logger.info(f'[Simulator] Gained {len(self.scene_segmentation.segments)} segs')
+            self.scene_segmentation.routing_listener.stop()
+
+            self.scene_segmentation.strat_vehicle_pos_listening()
+            self.route_checked.set()
+
+        self.unsafe_detector.start_detection(frame_driven=self.tick_driver != None)
+        
+        logger.info('[Simulator] Simulation Initialized')
+
+    def wait_for_apollo_route(self, route_req_time) -> bool:
         # Define the timeout period and retry attempts
         timeout_period = 15
         retry_attempts = 6
@@ -328,28 +477,95 @@ class Simulator(object):
         for attempt in range(retry_attempts):
             if not self.scene_segmentation.wait_for_route(
                     route_req_time, wait_from_req_time=True, timeout=timeout_period):
+                if self.close_event.is_set():
+                    return False
                 logger.warning(
                     f"[Simulator] Apollo failed to find the route, retry {attempt + 1}")
                 self.dv.set_destination_tranform(self.destination)
             else:
                 logger.info("[Simulator] Apollo found the route")
-                break
+                return True
+        logger.warning(
+            "[Simulator] Apollo failed to find the route, give up")
+        return False
+
+    def check_planned_route(self, route_req_time):
+        '''
+            Compare Apollo's routing with the planned route the segments were
+            built from, see apply_route_check for a mismatch.
+        '''
+        if not self.wait_for_apollo_route(route_req_time):
+            if not self.close_event.is_set():
+                self.close()
+            return
+        self.route_mismatch = not self.scene_segmentation.matches_routing(
+            self.planned_route)
+        if self.route_mismatch:
+            logger.warning('[Simulator] Apollo routing differs from the planned route')
         else:
-            logger.warning(
-                "[Simulator] Apollo failed to find the route, give up")
-            self.close()
+            logger.info('[Simulator] Apollo routing matches the planned route')
+        # the routing stays readable for get_segments
+        self.scene_segmentation.routing_listener.stop()
+        self.route_checked.set()
 
+    def apply_route_check(self) -> bool:
+        '''
+            Replace the planned segments by segments of Apollo's routing when
+            the check found they differ. Runs on the handle_segs thread, the
+            one reading the segments.
+            return: False if the segments were replaced
+        '''
+        if not self.route_checked.is_set() or not self.route_mismatch:
+            return True
+        self.route_mismatch = False
+        self.scene_segmentation.stop_vehicle_listening()
         self.scene_segmentation.get_segments(self.cfgs.scenario_length,
                                              self.cfgs.scenario_width)
-        logger.info('[Simulator] Scene Segmentation Initialized')
-        logger.info(f'[Simulator] Gained {len(self.scene_segmentation.segments)} segs')
-        self.scene_segmentation.routing_listener.stop()
-
+        logger.info(f'[Simulator] Gained {len(self.scene_segmentation.segments)} '
+                    f'segs from the Apollo routing')
         self.scene_segmentation.strat_vehicle_pos_listening()
+        return False
 
-        self.unsafe_detector.start_detection()
-        
-        logger.info('[Simulator] Simulation Initialized')
+    def wait_for_route_check(self) -> bool:
+        '''
+            Blocks until Apollo's routing has been checked against the
+            planned segments.
+            return: False if they were replaced, or on close; the scenarios
+                loaded for them are stale then
+        '''
+        while not self.route_checked.wait(0.1):
+            if self.close_event.is_set():
+                return False
+        return self.apply_route_check()
+
+    def drop_loaded_scenarios(self):
+        '''
+            Unload the scenarios loaded for replaced segments, their
+            individuals go back to the GA unevaluated.
+        '''
+        with self.scenario_lock:
+            scenarios = [self.curr_local_scenario, self.next_local_scenario]
+            self.prev_local_scenario = None
+            self.curr_local_scenario = None
+            self.next_local_scenario = None
+        for scenario in scenarios:
+            if scenario == None:
+                continue
+            scenario.remove_all_npcs()
+            if scenario.evaluate_obj != None:
+                self.feedback_eva(scenario.evaluate_obj)
+
+    def wait_for_first_segment(self) -> bool:
+        logger.info('waitting until the vehicle reach the first segment')
+        # wait until the vehicle reach first segment
+        while (self.scene_segmentation.curr_seg_index < 0):
+            if self.close_event.is_set():
+                return False
+            self.apply_route_check()
+            self.wait_for_frame()
+        logger.info(
+            f'scene_segmentation.curr_seg_index={self.scene_segmentation.curr_seg_index}')
+        return True
 
     def feedback_eva(self, eva_result: Evaluate_Object):
         eva_result_t = Evaluate_Transfer(eva_result.res_id,
@@ -385,11 +601,12 @@ class Simulator(object):
                 self.result_saver.result_to_save['unsafe_type'] = UNSAFE_TYPE.type_str[type]
                 logger.info('reload')
                 self.stop_record_and_save(save_video=True)
-                if self.curr_local_scenario is not None:
-                    if self.curr_local_scenario.running:
-                        eva_result = self.curr_local_scenario.scenario_end()
-                        if eva_result != None:
-                            self.feedback_eva(eva_result)
+                with self.scenario_lock:
+                    if self.curr_local_scenario is not None:
+                        if self.curr_local_scenario.running:
+                            eva_result = self.curr_local_scenario.scenario_end()
+                            if eva_result != None:
+                                self.feedback_eva(eva_result)
                 self.close()
                 logger.info('closed')
         elif type in [UNSAFE_TYPE.LANE_CHANGE,
@@ -412,7 +629,8 @@ class Simulator(object):
                 logger.info('Stucked, try start next scenario')
                 if not self.next_local_scenario.running:
                     # try start next scenario
-                    self.next_local_scenario.scenario_start()
+                    with self.scenario_lock:
+                        self.next_local_scenario.scenario_start()
                     self.on_unsafe_lock = False
                     return
             logger.info(f'[Unsafe Detected]: {message}')
@@ -420,11 +638,12 @@ class Simulator(object):
             self.result_saver.result_to_save['unsafe_type'] = UNSAFE_TYPE.type_str[type]
             logger.info('reload')
             self.stop_record_and_save(save_video=True)
-            if self.curr_local_scenario is not None:
-                if self.curr_local_scenario.running:
-                    eva_result = self.curr_local_scenario.scenario_end()
-                    if eva_result != None:
-                        self.feedback_eva(eva_result)
+            with self.scenario_lock:
+                if self.curr_local_scenario is not None:
+                    if self.curr_local_scenario.running:
+                        eva_result = self.curr_local_scenario.scenario_end()
+                        if eva_result != None:
+                            self.feedback_eva(eva_result)
             self.close()
         self.on_unsafe_lock = False
         return
@@ -446,7 +665,8 @@ class Simulator(object):
 
         self.result_saver.set_save_path(sce_result_path)
 
-        self.result_saver.result_to_save['video_path'] = sce_video_path
+        if self.recorder:
+            self.result_saver.result_to_save['video_path'] = sce_video_path
 
         curr_loc = self.ego_vehicle.get_location()
         self.result_saver.result_to_save['start_loc'] = {
@@ -462,7 +682,19 @@ class Simulator(object):
 
         self.result_saver.result_to_save['start_time'] = time.time()
 
-        self.recorder.start_recording(save_path=sce_video_path)
+        if self.curr_local_scenario != None:
+            self.result_saver.set_frame_buffer(
+                self.curr_local_scenario.get_frame_buffer())
+
+        if self.recorder:
+            self.recorder.start_recording(save_path=sce_video_path)
+        elif self.cfgs.recorder_profile == 'replay':
+            # server side log, rendered offline by ms_utils.replay_render
+            log_dir = self.cfgs.carla_log_dir or sce_result_path
+            self.carla_log_path = os.path.join(
+                log_dir, f'{os.path.basename(sce_result_path)}.log')
+            self.carla_client.start_recorder(self.carla_log_path, True)
+            self.result_saver.result_to_save['carla_log'] = self.carla_log_path
 
         self.is_recording = True
         self.recorder_start_time = time.time()
@@ -474,11 +706,47 @@ class Simulator(object):
             return
         self.is_recording = False
         self.start_unsafe_callback = False
-        if save_video:
-            time.sleep(1)
-        self.recorder.stop_recording()
-        curr_loc = self.ego_vehicle.get_location()
-        self.result_saver.save_result(curr_loc, save_video)
+        if self.recorder:
+            if save_video:
+                time.sleep(1)
+            self.recorder.stop_recording(save_video)
+        safe_carla_log = None
+        if self.carla_log_path:
+            if save_video:
+                time.sleep(1)
+            self.carla_client.stop_recorder()
+            if not save_video and self.cfgs.carla_log_retention == 'unsafe':
+                safe_carla_log = self.carla_log_path
+                self.result_saver.result_to_save['carla_log'] = 'deleted'
+            self.carla_log_path = None
+        if self.profiler.enabled:
+            self.profiler.dump(os.path.join(self.sce_result_path, 'profile.json'))
+        # without save_result frames were not retained, fitness is fed back
+        # by scenario_end
+        if self.cfgs.save_result:
+            curr_loc = self.ego_vehicle.get_location()
+            self.result_saver.save_result(curr_loc, save_video)
+        # the server may still be writing the log it just stopped, it is
+        # removed with the next segment's
+        self.remove_safe_carla_logs()
+        if safe_carla_log:
+            self.safe_carla_logs.append(safe_carla_log)
+
+    def remove_safe_carla_logs(self):
+        '''
+            Remove the CARLA logs of the segments found safe so far, a log
+            still busy is tried again next time.
+        '''
+        busy = []
+        for path in self.safe_carla_logs:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # already gone, or carla_log_dir is not visible from here
+                pass
+            except PermissionError:
+                busy.append(path)
+        self.safe_carla_logs = busy
 
     def freeze_and_set_green_all_tls(self):
         traffic_lights = self.carla_world.get_actors().filter('traffic.traffic_light')
@@ -523,43 +791,45 @@ class Simulator(object):
 
     def handle_segs(self):
         self.carla_world.set_pedestrians_cross_factor(0.1)
-        logger.info('waitting until the vehicle reach the first segment')
-        # wait until the vehicle reach first segment
-        while (self.scene_segmentation.curr_seg_index < 0):
-            if self.close_event.is_set():
-                return
-            self.carla_world.wait_for_tick()
-        logger.info(
-            f'scene_segmentation.curr_seg_index={self.scene_segmentation.curr_seg_index}')
+        if not self.wait_for_first_segment():
+            return
 
         while self.sim_status and not self.close_event.is_set():
             curr_index = self.scene_segmentation.curr_seg_index
 
             if self.scene_segmentation.belongs_to_two_index == (False, False):
                 # just move ego forward until reaching next seg
-                self.carla_world.wait_for_tick()
+                self.wait_for_frame()
                 continue
 
             if curr_index == 0:
                 # if it's the first seg, curr need to be loaded
                 self.curr_local_scenario = LocalScenario(self.carla_world,
                                                          self.ego_vehicle,
-                                                         logger)
+                                                         logger,
+                                                         retain_frames=self.cfgs.save_result,
+                                                         npc_controller=self.cfgs.npc_controller,
+                                                         carla_client=self.carla_client)
                 self.curr_local_scenario.id = str(curr_index)
                 if self.close_event.is_set():
                     return
                 self.load_scenario(self.curr_local_scenario,
                                    curr_index)
 
-                self.prev_local_scenario = None
+                with self.scenario_lock:
+                    self.prev_local_scenario = None
             else:
-                self.prev_local_scenario = self.curr_local_scenario
-                self.curr_local_scenario = self.next_local_scenario
+                with self.scenario_lock:
+                    self.prev_local_scenario = self.curr_local_scenario
+                    self.curr_local_scenario = self.next_local_scenario
 
             if curr_index != (len(self.scene_segmentation.segments) - 1):
                 # if not the final seg load next
                 self.next_local_scenario = LocalScenario(
-                    self.carla_world, self.ego_vehicle, logger)
+                    self.carla_world, self.ego_vehicle, logger,
+                    retain_frames=self.cfgs.save_result,
+                    npc_controller=self.cfgs.npc_controller,
+                    carla_client=self.carla_client)
                 self.next_local_scenario.id = str(curr_index + 1)
 
                 if self.close_event.is_set():
@@ -567,10 +837,20 @@ class Simulator(object):
                 self.load_scenario(self.next_local_scenario,
                                    curr_index + 1)
 
+                if not self.wait_for_route_check():
+                    if self.close_event.is_set():
+                        return
+                    # loaded for the planned segments, Apollo drives others
+                    self.drop_loaded_scenarios()
+                    if not self.wait_for_first_segment():
+                        return
+                    continue
+
                 # run curr
                 if self.curr_local_scenario != None:
                     if not self.curr_local_scenario.running:
-                        self.curr_local_scenario.scenario_start()
+                        with self.scenario_lock:
+                            self.curr_local_scenario.scenario_start()
 
                 if self.curr_local_scenario != None and \
                         self.curr_local_scenario.evaluate_obj != None:
@@ -580,39 +860,41 @@ class Simulator(object):
                 self.start_record(id=log_id)
 
                 while curr_index != self.scene_segmentation.finished_index:
-                    world_ss = self.carla_world.wait_for_tick()
+                    world_ss = self.wait_for_frame()
                     if not self.sim_status or self.close_event.is_set():
                         return
-                    if self.prev_local_scenario != None:
-                        if self.prev_local_scenario.running:
-                            self.prev_local_scenario.npc_refresh()
-                    if self.curr_local_scenario != None:
-                        if self.curr_local_scenario.running:
-                            self.curr_local_scenario.npc_refresh()
-                    if self.next_local_scenario != None:
-                        if self.next_local_scenario.running:
-                            self.next_local_scenario.npc_refresh()
-                    frame_record = self.curr_local_scenario.evaluate_snapshot_record(
-                        world_ss)
-                    self.result_saver.frames_record.append(frame_record)
+                    if self.tick_driver == None:
+                        # otherwise the tick driver's stages do it
+                        self.step_npcs(world_ss)
+                        self.record_snapshot(world_ss)
                     # self.check_modules()
                     if self.scene_segmentation.belongs_to_two_index == (True, True):
                         if not self.next_local_scenario.running:
-                            self.next_local_scenario.scenario_start()
+                            with self.scenario_lock:
+                                self.next_local_scenario.scenario_start()
                 self.stop_record_and_save(save_video=False)
-                eva_result = self.curr_local_scenario.scenario_end()
+                with self.scenario_lock:
+                    eva_result = self.curr_local_scenario.scenario_end()
                 if eva_result != None:
                     self.feedback_eva(eva_result)
             else:
                 # aleady the final seg
                 if self.close_event.is_set():
                     return
+                if not self.wait_for_route_check():
+                    if self.close_event.is_set():
+                        return
+                    self.drop_loaded_scenarios()
+                    if not self.wait_for_first_segment():
+                        return
+                    continue
                 if not self.curr_local_scenario.running:
-                    self.curr_local_scenario.scenario_start()
+                    with self.scenario_lock:
+                        self.curr_local_scenario.scenario_start()
                 log_id = f'{self.curr_local_scenario.evaluate_obj.id}'
                 self.start_record(id=log_id)
                 while self.sim_status and not self.close_event.isSet():
-                    world_ss = self.carla_world.wait_for_tick()
+                    world_ss = self.wait_for_frame()
                     if not self.sim_status or self.close_event.isSet():
                         break
                     if self.check_if_ego_close_dest(10):
@@ -620,23 +902,35 @@ class Simulator(object):
                             print('\r')
                             print('reach des')
                             self.stop_record_and_save(save_video=False)
-                            eva_result = self.curr_local_scenario.scenario_end()
+                            with self.scenario_lock:
+                                eva_result = self.curr_local_scenario.scenario_end()
                             if eva_result != None:
                                 self.feedback_eva(eva_result)
                             self.close()
-                    if self.prev_local_scenario != None:
-                        if self.prev_local_scenario.running:
-                            self.prev_local_scenario.npc_refresh()
-                    if self.curr_local_scenario != None:
-                        if self.curr_local_scenario.running:
-                            self.curr_local_scenario.npc_refresh()
-                    frame_record = self.curr_local_scenario.evaluate_snapshot_record(
-                        world_ss)
-                    self.result_saver.frames_record.append(frame_record)
+                    if self.tick_driver == None:
+                        self.step_npcs(world_ss)
+                        self.record_snapshot(world_ss)
 
         self.close()
         logger.info('[Simulator] === Simulation End === ')
 
+    def apply_npc_commands(self):
+        '''
+            Send the npc controls of prev / curr / next scenario of this tick
+            in one batch, instead of one RPC per npc.
+        '''
+        # the agents' controls of this frame are waited for, all scenarios
+        # together within one deadline, so that they reach the server on the
+        # tick they were computed for as with a direct apply_control; a slow
+        # agent's control goes with the next batch
+        deadline = time.monotonic() + self.npc_command_wait
+        commands = []
+        for scenario in self.running_scenarios():
+            commands += scenario.pop_npc_commands(deadline)
+        if commands:
+            with self.profiler.stage('npc_commands'):
+                self.carla_client.apply_batch(commands)
+
     def load_scenario(self,
                       scenario_2_load: LocalScenario,
                       seg_index,
@@ -705,13 +999,53 @@ class Simulator(object):
             logger.warning('[Simulator] Module is closed: '
                            + module + ' ==> maybe not affect')
 
+    def get_ga_coverage(self, timeout=2.0) -> dict:
+        '''
+            Evaluation effort per segment type from GA_LIB, None when it
+            does not answer in time.
+        '''
+        if self.eva_req_queue is None or self.coverage_queue is None:
+            return None
+        # drop the late reply of a request that timed out
+        while True:
+            try:
+                self.coverage_queue.get_nowait()
+            except queue.Empty:
+                break
+        self.eva_req_queue.put({'cmd': 'get_coverage'})
+        try:
+            return self.coverage_queue.get(timeout=timeout)
+        except queue.Empty:
+            logger.warning('[Simulator] no coverage from GA_LIB')
+            return None
+
     def select_valid_dest(self, min_radius=100, max_radius=150) -> carla.Transform:
         '''
             Select a destination outside the specified radius from current position
         '''
         ego_curr_point = self.ego_vehicle.get_transform()
         valid_destination = False
-        sps = self.carla_map.get_spawn_points()
+        sps = self.map_catalog.spawn_points
+
+        # prefer the routes planned offline, their segments are known
+        self.planned_route = None
+        if self.cfgs.use_planned_routes:
+            routes = [route for route in
+                      self.scene_segmentation.get_planned_routes(ego_curr_point.location)
+                      if min_radius <= ego_curr_point.location.distance(
+                          sps[route['dest']].location) <= max_radius]
+            if routes:
+                coverage = self.get_ga_coverage() \
+                    if self.cfgs.coverage_guided_dest else None
+                if coverage is not None:
+                    self.planned_route = select_route(routes, coverage)
+                else:
+                    self.planned_route = random.choice(routes)
+                logger.info(f'[Simulator] planned route to spawn point '
+                            f'{self.planned_route["dest"]}, '
+                            f'{len(self.planned_route["types"])} segments')
+                return sps[self.planned_route['dest']]
+
         while not valid_destination:
             des_transform = random.choice(sps)
             des_wp = self.carla_map.get_waypoint(des_transform.location,
@@ -740,6 +1074,9 @@ class Simulator(object):
                 return False
 
     def pause_world(self, pause: bool = True):
+        if self.tick_driver != None:
+            self.tick_driver.pause(pause)
+            return
         if self.carla_bridge.pause_event == None:
             return
         if pause:
@@ -760,6 +1097,10 @@ class Simulator(object):
                 sys.exit()
         self.closing = True
         logger.warning("Into Simulation Shutting down Program.")
+        for planner, stats in get_route_cache_stats().items():
+            logger.info(f'[Simulator] NPC route cache {planner}: '
+                        f'{stats["hits"]} hits / {stats["misses"]} misses '
+                        f'({stats["hit_rate"]:.0%}), {stats["size"]} routes')
 
         def exit_program():
             logger.warning("Force Exiting program due to timeout.")
@@ -772,6 +1113,13 @@ class Simulator(object):
 
         if self.is_recording:
             self.stop_record_and_save()
+        self.remove_safe_carla_logs()
+
+        # write pending results before anything else can hang the shutdown
+        if self.result_writer:
+            if self.result_writer.close(timeout=self.cfgs.result_flush_timeout):
+                logger.warning("[Shutdown] Results flushed")
+            self.result_writer = None
 
         if self.recorder:
             self.recorder.rm_cams()
@@ -792,17 +1140,38 @@ class Simulator(object):
         logger.warning(f'[Shutdown] cls, {self.curr_local_scenario}')
         if self.curr_local_scenario != None:
             if self.curr_local_scenario.running:
-                self.curr_local_scenario.scenario_end()
+                with self.scenario_lock:
+                    self.curr_local_scenario.scenario_end()
             logger.warning("[Shutdown] Current scenario unloaded")
             self.curr_local_scenario = None
 
         logger.warning(f'[Shutdown] nls, {self.next_local_scenario}')
         if self.next_local_scenario:
             if self.next_local_scenario.running:
-                self.next_local_scenario.scenario_end()
+                with self.scenario_lock:
+                    self.next_local_scenario.scenario_end()
             logger.warning("[Shutdown] Next scenario unloaded")
             self.next_local_scenario = None
 
+        if self.profiler.enabled:
+            logger.info('[Simulator] Stage timings:\n' + self.profiler.format_summary())
+            try:
+                with open(os.path.join(self.result_path, 'profile_summary.json'), 'w') as f:
+                    json.dump(self.profiler.summary(), f, indent=1)
+            except (AttributeError, OSError) as e:
+                logger.warning(f'[Shutdown] profile summary not saved: {e}')
+
+        if self.tick_driver != None:
+            stats = self.tick_driver.get_stats()
+            logger.info(f'[Simulator] Tick driver: {stats["frames"]} frames, '
+                        f'{stats["speed"]:.2f}x real time')
+            for name, timing in stats['stages'].items():
+                logger.info(f'[Simulator]   {name}: {timing["mean_ms"]:.2f} ms mean, '
+                            f'{timing["max_ms"]:.2f} ms max')
+            self.tick_driver.stop()
+            self.tick_driver = None
+            logger.warning("[Shutdown] Tick driver stopped")
+
         logger.warning(f'[Shutdown] dv, {self.dv}')
         if self.dv:
             self.dv.disable_apollo()
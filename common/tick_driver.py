@@ -0,0 +1,157 @@
+import threading
+import time
+from typing import Callable, List, Tuple
+
+import carla
+from loguru import logger
+
+from MS_fuzz.ms_utils.stage_profiler import StageProfiler
+
+
+class TickDriver(object):
+    '''
+        Runs a synchronous-mode world from one thread: every frame is one
+        `world.tick()` followed by the registered stages, in the order they
+        were added, each given the snapshot of the new frame.
+
+        The bridge must be passive, it then publishes from its own on_tick
+        callback after every tick instead of ticking the world itself.
+
+        real_time_factor: simulated seconds per wall second the driver aims
+            for, 0 ticks as fast as the stages allow
+        profiler: where the tick and the stages are timed, its own one by
+            default
+    '''
+
+    def __init__(self, world: carla.World, fixed_delta_seconds=0.05,
+                 real_time_factor=1.0, tick_timeout=10.0,
+                 profiler: StageProfiler = None):
+        self.world = world
+        self.fixed_delta_seconds = fixed_delta_seconds
+        self.real_time_factor = real_time_factor
+        self.tick_timeout = tick_timeout
+
+        self.stages: List[Tuple[str, Callable[[carla.WorldSnapshot], None]]] = []
+        self.profiler = profiler if profiler else StageProfiler()
+
+        self.frame_condition = threading.Condition()
+        self.world_ss: carla.WorldSnapshot = None
+        self.frame_count = 0
+        self.start_time = None
+        self.sim_start_time = None
+
+        self.pause_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread: threading.Thread = None
+        self.original_settings: carla.WorldSettings = None
+
+    def add_stage(self, name, callback: Callable[[carla.WorldSnapshot], None]):
+        self.stages.append((name, callback))
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.original_settings = self.world.get_settings()
+        settings = self.world.get_settings()
+        settings.synchronous_mode = True
+        settings.fixed_delta_seconds = self.fixed_delta_seconds
+        self.world.apply_settings(settings)
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='tick_driver')
+        self.thread.start()
+
+    def stop(self, restore_settings=True):
+        self.stop_event.set()
+        self.pause_event.clear()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        if restore_settings and self.original_settings:
+            # nobody ticks anymore, let the server run on its own
+            settings = self.world.get_settings()
+            settings.synchronous_mode = self.original_settings.synchronous_mode
+            settings.fixed_delta_seconds = self.original_settings.fixed_delta_seconds
+            self.world.apply_settings(settings)
+        with self.frame_condition:
+            self.frame_condition.notify_all()
+
+    def pause(self, pause: bool = True):
+        if pause:
+            self.pause_event.set()
+        else:
+            self.pause_event.clear()
+
+    def wait_for_frame(self, timeout=None) -> carla.WorldSnapshot:
+        '''
+            Blocks until the stages of the next frame have run, the
+            counterpart of `world.wait_for_tick()`.
+            return: its snapshot, None on timeout or once stopped
+        '''
+        with self.frame_condition:
+            frame_count = self.frame_count
+            if not self.frame_condition.wait_for(
+                    lambda: self.frame_count != frame_count or self.stop_event.is_set(),
+                    timeout):
+                return None
+            if self.stop_event.is_set():
+                return None
+            return self.world_ss
+
+    def run(self):
+        self.start_time = time.perf_counter()
+        frame_period = self.fixed_delta_seconds / self.real_time_factor \
+            if self.real_time_factor > 0 else 0
+        next_frame_time = self.start_time
+        while not self.stop_event.is_set():
+            if self.pause_event.is_set():
+                time.sleep(0.01)
+                next_frame_time = time.perf_counter()
+                continue
+
+            try:
+                with self.profiler.stage('tick'):
+                    self.world.tick(self.tick_timeout)
+                    world_ss = self.world.get_snapshot()
+            except RuntimeError as e:
+                logger.warning(f'[TickDriver] tick failed: {e}')
+                continue
+            if self.sim_start_time is None:
+                self.sim_start_time = world_ss.timestamp.elapsed_seconds
+
+            for name, callback in self.stages:
+                try:
+                    with self.profiler.stage(name):
+                        callback(world_ss)
+                except Exception as e:  # pylint: disable=W0718
+                    logger.error(f'[TickDriver] stage {name}: {e}')
+
+            with self.frame_condition:
+                self.world_ss = world_ss
+                self.frame_count += 1
+                self.frame_condition.notify_all()
+
+            if frame_period:
+                next_frame_time += frame_period
+                delay = next_frame_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # behind, do not try to catch up
+                    next_frame_time = time.perf_counter()
+
+    def get_stats(self) -> dict:
+        '''
+            return: frames run, simulated / wall time ratio and the timing of
+                the tick and of every stage
+        '''
+        wall_time = time.perf_counter() - self.start_time if self.start_time else 0
+        sim_time = self.world_ss.timestamp.elapsed_seconds - self.sim_start_time \
+            if self.world_ss is not None else 0
+        return {
+            'frames': self.frame_count,
+            'sim_time': sim_time,
+            'wall_time': wall_time,
+            'speed': sim_time / wall_time if wall_time else 0,
+            'stages': self.profiler.summary(),
+        }
@@ -3,6 +3,9 @@ import time
 # from enum import Enum
 from threading import Thread, Lock, Event
 
+from MS_fuzz.ms_utils.map_catalog import MapCatalog, get_map_catalog
+from MS_fuzz.ms_utils.stage_profiler import get_stage_profiler
+
 
 class UNSAFE_TYPE():
     COLLISION = 1
@@ -23,7 +26,8 @@ class UnsafeDetector(object):
     def __init__(self, world: carla.World, vehicle: carla.Vehicle):
         self.world = world
         self.vehicle = vehicle
-        self.map = self.world.get_map()
+        self.map_catalog: MapCatalog = get_map_catalog(self.world)
+        self.map = self.map_catalog.carla_map
         self.lane_change_detector = None
         self.collision_detector = None
         self.imu_sensor = None  # Add IMU sensor attribute
@@ -40,33 +44,44 @@ class UnsafeDetector(object):
 
         self.acceleration_threshold = 5.0
 
+        # stuck and lane occupation checked by check_frame() on simulation
+        # time instead of by timer threads, see start_detection
+        self.frame_driven = False
+        self.stuck_start_time = None
+        # uid: (road_id, section_id, start time)
+        self.lane_occupations = {}
+
     def register_callback(self, callback):
         self.callbacks.append(callback)
 
     def init_sensors(self):
         # Setup the lane invasion and collision sensors
-        lane_invasion_bp = self.world.get_blueprint_library().find(
+        lane_invasion_bp = self.map_catalog.find_blueprint(
             'sensor.other.lane_invasion')
         self.lane_change_detector = self.world.spawn_actor(lane_invasion_bp,
                                                            carla.Transform(),
                                                            attach_to=self.vehicle)
 
-        collision_bp = self.world.get_blueprint_library().find('sensor.other.collision')
+        collision_bp = self.map_catalog.find_blueprint('sensor.other.collision')
         self.collision_detector = self.world.spawn_actor(collision_bp,
                                                          carla.Transform(),
                                                          attach_to=self.vehicle)
         # Setup IMU sensor
-        imu_bp = self.world.get_blueprint_library().find('sensor.other.imu')
+        imu_bp = self.map_catalog.find_blueprint('sensor.other.imu')
         self.imu_sensor = self.world.spawn_actor(
             imu_bp, carla.Transform(), attach_to=self.vehicle)
 
-    def start_detection(self):
-        """Starts the detection of unsafe situations."""
+    def start_detection(self, frame_driven=False):
+        """Starts the detection of unsafe situations.
+        frame_driven: `check_frame()` is called every frame (TickDriver),
+            the time based checks then run on simulation time"""
+        self.frame_driven = frame_driven
         self.lane_change_detector.listen(self.on_lane_invasion)
         self.collision_detector.listen(self.on_collision)
         self.imu_sensor.listen(self.on_imu_data)  # Add IMU data listener
 
-        self.start_stuck_monitor(self.stuck_timeout)
+        if not self.frame_driven:
+            self.start_stuck_monitor(self.stuck_timeout)
 
     def stop_detection(self):
         """Stops the detection of unsafe situations."""
@@ -138,6 +153,12 @@ class UnsafeDetector(object):
         uid = f"{waypoint.road_id}_{waypoint.section_id}"
 
         with self.timers_lock:
+            if self.frame_driven:
+                if uid not in self.lane_occupations:
+                    self.lane_occupations[uid] = (waypoint.road_id,
+                                                  waypoint.section_id,
+                                                  event.timestamp)
+                return
             if uid not in self.active_timers:
                 # print(f'timer {uid}, started')
                 stop_event = Event()
@@ -157,14 +178,15 @@ class UnsafeDetector(object):
                 round(acceleration_magnitude, 2)
             )
 
-    def crossing_two_lane(self):
+    def crossing_two_lane(self, vehicle_transform: carla.Transform = None):
         bounding_box = self.vehicle.bounding_box
-        vehicle_transform = self.vehicle.get_transform()
+        if vehicle_transform is None:
+            vehicle_transform = self.vehicle.get_transform()
         corners = bounding_box.get_world_vertices(vehicle_transform)[2:6]
 
         road_ids, section_ids, lane_ids = set(), set(), set()
         for corner in corners:
-            waypoint = self.world.get_map().get_waypoint(corner, project_to_road=False)
+            waypoint = self.map.get_waypoint(corner, project_to_road=False)
             if not waypoint:
                 continue
             road_ids.add(waypoint.road_id)
@@ -208,10 +230,65 @@ class UnsafeDetector(object):
         uid = f"{road_id}_{section_id}"
         del self.active_timers[uid]
 
+    def check_frame(self, world_ss: carla.WorldSnapshot):
+        """The checks of monitor_stuck and lane_occupation_timer for one
+        frame, on the simulation time of `world_ss`."""
+        ego_ss = world_ss.find(self.vehicle.id)
+        if ego_ss is None:
+            return
+        now = world_ss.timestamp.elapsed_seconds
+        triggered = []
+
+        if ego_ss.get_velocity().length() < self.velocity_threshold:
+            if self.stuck_start_time is None:
+                self.stuck_start_time = now
+            elif now - self.stuck_start_time >= self.stuck_timeout:
+                triggered.append((UNSAFE_TYPE.STUCK,
+                                  "Vehicle has been static for too long."))
+                self.stuck_start_time = None
+        else:
+            self.stuck_start_time = None
+
+        with self.timers_lock:
+            occupations = list(self.lane_occupations.items())
+        if occupations:
+            self.check_lane_occupations(ego_ss, now, occupations, triggered)
+
+        if triggered:
+            # the callbacks may end the scenario, which waits for ticks, so
+            # they run in their own thread as they did from the timers
+            Thread(target=self.trigger_all, args=(triggered,)).start()
+
+    def check_lane_occupations(self, ego_ss: carla.ActorSnapshot, now,
+                               occupations, triggered):
+        vehicle_transform = ego_ss.get_transform()
+        waypoint = self.map.get_waypoint(vehicle_transform.location,
+                                         project_to_road=False)
+        crossing = self.crossing_two_lane(vehicle_transform)
+        for uid, (road_id, section_id, start_time) in occupations:
+            if crossing and not waypoint:
+                continue
+            if not crossing or road_id != waypoint.road_id \
+                    or section_id != waypoint.section_id:
+                # no more crossing two lane, or left this area
+                with self.timers_lock:
+                    del self.lane_occupations[uid]
+                continue
+            if now - start_time >= self.threshold_time:
+                triggered.append((UNSAFE_TYPE.LANE_CHANGE,
+                                  'Long time between lanes'))
+                with self.timers_lock:
+                    self.lane_occupations[uid] = (road_id, section_id, now)
+
+    def trigger_all(self, triggered):
+        for type, message in triggered:
+            self.trigger_callbacks(type, message)
+
     def trigger_callbacks(self, type, message, data=None):
         # Call registered callback functions
-        for callback in self.callbacks:
-            callback(type, message, data)
+        with get_stage_profiler().stage('unsafe_callback'):
+            for callback in self.callbacks:
+                callback(type, message, data)
 
     def cleanup(self):
         # Clean up the sensors and stop all timers
@@ -222,6 +299,7 @@ class UnsafeDetector(object):
                     if thread.is_alive():
                         thread.join() #  Wait for the thread to finish
                 self.active_timers.clear()
+                self.lane_occupations.clear()
 
             if self.lane_change_detector:
                 self.lane_change_detector.stop()
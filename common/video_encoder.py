@@ -0,0 +1,210 @@
+import multiprocessing
+import os
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+import imageio
+from loguru import logger
+
+
+def encoder_process_handler(shm_name, slots, frame_shape, parent_pid,
+                            job_queue, free_queue, done_queue):
+    '''
+        Encoder process: appends the frames written by the simulator into
+        the shared memory ring to the current video, then gives the slot
+        back through `free_queue`.
+        jobs: ('open', path, fps), ('frame', slot, repeat), ('close',),
+              None to exit
+    '''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray((slots,) + tuple(frame_shape), dtype=np.uint8,
+                        buffer=shm.buf)
+    writer = None
+    encoded_frames = 0
+    try:
+        while True:
+            try:
+                job = job_queue.get(timeout=1)
+            except queue.Empty:
+                if os.getppid() != parent_pid:
+                    # simulator process killed, nobody will close the video
+                    break
+                continue
+            if job is None:
+                break
+            if job[0] == 'frame':
+                try:
+                    for _ in range(job[2] if writer else 0):
+                        writer.append_data(frames[job[1]])
+                        encoded_frames += 1
+                except Exception as e:
+                    print('[VideoEncoder] fail to encode frame:', e)
+                finally:
+                    free_queue.put(job[1])
+            elif job[0] == 'open':
+                _, path, fps = job
+                if writer:
+                    writer.close()
+                try:
+                    writer = imageio.get_writer(path, fps=fps,
+                                                codec='libx264', quality=8)
+                except Exception as e:
+                    print('[VideoEncoder] fail to open video:', e)
+                    writer = None
+                encoded_frames = 0
+            elif job[0] == 'close':
+                if writer:
+                    writer.close()
+                    writer = None
+                done_queue.put(encoded_frames)
+    finally:
+        if writer:
+            writer.close()
+        del frames
+        shm.close()
+
+
+class VideoEncoder(object):
+    '''
+        Encodes videos in a dedicated process so libx264 does not compete
+        with the tick loop for the GIL.
+
+        Frames go through a ring of `slots` frames in shared memory: the
+        producer takes a free slot with `acquire_frame()`, writes the image
+        into it in place and hands it over with `submit_frame()`. When the
+        encoder falls behind and no slot is free the frame is dropped and
+        counted in `dropped_frames`.
+    '''
+
+    def __init__(self, frame_shape, slots=8, logger=logger):
+        self.logger = logger
+        self.frame_shape = tuple(frame_shape)
+        self.slots = slots
+
+        frame_size = int(np.prod(self.frame_shape))
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=frame_size * slots)
+        self.frames = np.ndarray((slots,) + self.frame_shape, dtype=np.uint8,
+                                 buffer=self.shm.buf)
+
+        # spawn, forking the multi-threaded simulator process is not safe
+        ctx = multiprocessing.get_context('spawn')
+        self.job_queue = ctx.Queue()
+        self.free_queue = ctx.Queue()
+        self.done_queue = ctx.Queue()
+        # slots never handed to the encoder yet
+        self.local_free_slots = list(range(slots))
+
+        self.submitted_frames = 0
+        self.dropped_frames = 0
+        self.encoded_frames = 0
+
+        self.process = ctx.Process(target=encoder_process_handler,
+                                   args=(self.shm.name, slots,
+                                         self.frame_shape, os.getpid(),
+                                         self.job_queue, self.free_queue,
+                                         self.done_queue),
+                                   name='video_encoder',
+                                   daemon=True)
+        self.process.start()
+
+    def open(self, path, fps):
+        self.submitted_frames = 0
+        self.dropped_frames = 0
+        self.encoded_frames = 0
+        self.job_queue.put(('open', path, fps))
+
+    def acquire_frame(self, timeout=None):
+        '''
+            timeout: seconds to wait for a free slot, by default do not wait
+            return: (slot, frame array to write into), (None, None) and the
+                frame is counted as dropped when the ring is full
+        '''
+        if self.local_free_slots:
+            slot = self.local_free_slots.pop()
+        else:
+            try:
+                if timeout is None:
+                    slot = self.free_queue.get_nowait()
+                else:
+                    slot = self.free_queue.get(timeout=timeout)
+            except queue.Empty:
+                self.dropped_frames += 1
+                return None, None
+        return slot, self.frames[slot]
+
+    def submit_frame(self, slot, repeat=1):
+        '''
+            Hand a written slot to the encoder, appended `repeat` times.
+        '''
+        self.job_queue.put(('frame', slot, repeat))
+        self.submitted_frames += repeat
+
+    def close_video(self, timeout=10) -> bool:
+        '''
+            Finish the current video, waits until the file is complete.
+        '''
+        self.job_queue.put(('close',))
+        try:
+            self.encoded_frames = self.done_queue.get(timeout=timeout)
+        except queue.Empty:
+            self.logger.warning('[VideoEncoder] timeout closing video')
+            return False
+        if self.dropped_frames:
+            self.logger.warning(
+                f'[VideoEncoder] {self.dropped_frames} frames dropped, '
+                f'{self.encoded_frames}/{self.submitted_frames} encoded')
+        return True
+
+    def shutdown(self, timeout=5):
+        if self.process is None:
+            return
+        self.job_queue.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
+
+
+class PreTriggerBuffer(object):
+    '''
+        In-memory ring of the last `capacity` stitched frames with their
+        repeat counts, encoded only when something worth a video happened.
+    '''
+
+    def __init__(self, capacity, frame_shape):
+        self.capacity = capacity
+        self.frames = np.zeros((capacity,) + tuple(frame_shape), dtype=np.uint8)
+        self.repeats = np.zeros(capacity, dtype=np.int32)
+        self.next_index = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        # oldest first
+        start = (self.next_index - self.size) % self.capacity
+        for i in range(self.size):
+            index = (start + i) % self.capacity
+            yield self.frames[index], int(self.repeats[index])
+
+    def next_frame(self) -> np.ndarray:
+        '''
+            The entry to write the next frame into, overwrites the oldest
+            one when full. Call `commit()` once written.
+        '''
+        return self.frames[self.next_index]
+
+    def commit(self, repeat=1):
+        self.repeats[self.next_index] = repeat
+        self.next_index = (self.next_index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def clear(self):
+        self.next_index = 0
+        self.size = 0
@@ -35,6 +35,16 @@ class Config:
 
         # carla bridge config
         self.load_bridge = True
+        # tick the synchronous world from the fuzzer (common.tick_driver)
+        # with the bridge passive: npc step, recording and unsafe checks run
+        # once per frame in that order, timed per stage
+        self.tick_driver = False
+        # simulated seconds per wall second with the tick driver, 0 as fast
+        # as possible; above 1 only when Apollo keeps up with the sim clock
+        self.real_time_factor = 1.0
+        # time the stages of the simulation loop (ms_utils.stage_profiler),
+        # histograms in profile.json per scenario and summarized at shutdown
+        self.profile_stages = False
 
         # dreamview config
         self.dreamview_map = "Carla Town10hd"
@@ -71,6 +81,40 @@ class Config:
         self.num_mutation_car = 1
         self.density = 1
         self.no_traffic_lights = False
+        # how NPC vehicles drive: 'agent', a BehaviorAgent thread per vehicle,
+        # or 'kinematic', pure pursuit on their routes for all vehicles in one
+        # vectorized step per tick (common.kinematic_controller), much cheaper
+        # but blind to traffic lights and other actors
+        self.npc_controller = 'agent'
+        # write result.json per segment, if False per-frame records are
+        # dropped and only the running fitness metrics are kept
+        self.save_result = True
+        # segments waiting for the background result writer before the
+        # simulation blocks, and how long close() waits for them (s), must
+        # stay below the 15s force exit of Simulator.close
+        self.result_queue_size = 4
+        self.result_flush_timeout = 10
+        # 'json': per-frame records inside result.json, 'npz': in a compact
+        # trace.npz next to a summary result.json (see result_saver.load_result)
+        self.result_format = 'json'
+        # 0 encodes every segment whole (unsafe clips complete); > 0 keeps
+        # only the last seconds of camera frames in memory and encodes them
+        # for unsafe segments, opt-in as clips are truncated to that length
+        # and cost ~28MB of RAM per second at recorder_downscale 2
+        self.recorder_pre_trigger = 0
+        # keep one pixel out of recorder_downscale, 1 for full resolution
+        self.recorder_downscale = 1
+        # cameras recorded per segment: 'off', 'top', 'quad' (832x468 each)
+        # or 'preview' (quad at 320x180), see RECORDING_PROFILES; 'replay'
+        # records no camera but a CARLA recorder log per segment, rendered
+        # afterwards with `python -m MS_fuzz.ms_utils.replay_render`
+        self.recorder_profile = 'quad'
+        # where the CARLA server writes the logs, None for the scenario
+        # result folder (the server must see the same file system)
+        self.carla_log_dir = None
+        # 'unsafe': remove the logs of safe segments (when carla_log_dir is
+        # visible from here), 'all': keep every log
+        self.carla_log_retention = 'unsafe'
 
         # Fuzzing metadata
         self.town = None
@@ -84,6 +128,16 @@ class Config:
         self.cur_time = None
         self.determ_seed = None
         self.out_dir = '/apollo/data/MS_fuzz/result'
+        # parsed maps and scene segments reused across runs, None disables
+        self.cache_dir = '/apollo/data/MS_fuzz/cache'
+        # pick destinations among the routes planned offline into cache_dir
+        # (python -m MS_fuzz.ga_engine.route_planner) instead of random ones;
+        # their segments are ready before Apollo routes, its routing only
+        # confirms them
+        self.use_planned_routes = False
+        # among the planned routes, take the one covering the segment types
+        # the GA has evaluated least per km (ga_engine.route_planner.score_route)
+        self.coverage_guided_dest = False
         self.seed_dir = None
 
         # Target config
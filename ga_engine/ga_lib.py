@@ -18,7 +18,8 @@ class GA_LIB():
                  eva_req_queue: Queue,
                  eva_res_queue: Queue,
                  logger,
-                 ga_lib_floder_path=None):
+                 ga_lib_floder_path=None,
+                 coverage_queue: Queue = None):
 
         self.ga_lib: Dict[str, CEGA] = {}
 
@@ -31,12 +32,18 @@ class GA_LIB():
 
         self.req_queue = eva_req_queue
         self.res_queue = eva_res_queue
+        # replies to 'get_coverage', apart so they never mix with get_obj ones
+        self.coverage_queue = coverage_queue
 
         self.saved = False
         self.closing = False
         self.lock = threading.Lock()
 
         self.eva_res_list: Dict[str, Evaluate_Object] = {}
+        # res_id -> type_str of the objects handed out, and the number of
+        # feedbacks received per type_str, see get_coverage
+        self.eva_res_types: Dict[str, str] = {}
+        self.eva_count: Dict[str, int] = {}
 
     def load_from_path(self):
         if self.ga_lib_floder_path is None:
@@ -96,6 +103,25 @@ class GA_LIB():
 
         return obj_2_evaluate
 
+    def get_coverage(self) -> Dict[str, dict]:
+        '''
+            Evaluation effort per segment type, types without a CEGA yet are
+            absent. For each type_str:
+            - evaluations: feedbacks received in this run
+            - generation: current generation of its CEGA
+            - unevaluated: individuals of the generation still to evaluate
+        '''
+        coverage = {}
+        with self.lock:
+            for type_str, cega in self.ga_lib.items():
+                coverage[type_str] = {
+                    'evaluations': self.eva_count.get(type_str, 0),
+                    'generation': cega.generation,
+                    'unevaluated': len([obj for obj in list(cega.evaluate_list)
+                                        if not obj.is_evaluated]),
+                }
+        return coverage
+
     def close(self):
         if self.closing:
             return
@@ -208,6 +234,10 @@ class GA_LIB():
                     }
                     self.res_queue.put(res_dict)
                     self.eva_res_list[res_id] = obj_2_evaluate
+                    self.eva_res_types[res_id] = type_str
+                elif cmd == 'get_coverage':
+                    if self.coverage_queue is not None:
+                        self.coverage_queue.put(self.get_coverage())
                 elif cmd == 'feedback':
                     print('get a feedback')
                     eva_obj:Evaluate_Transfer = req_dic.get('eva_obj')
@@ -217,6 +247,9 @@ class GA_LIB():
                     target_eva_obj.vehicle_ind.fitness.values = eva_obj.vehicle_ind.fitness.values
                     target_eva_obj.is_evaluated = eva_obj.is_evaluated
                     target_eva_obj.is_in_queue = False
+                    type_str = self.eva_res_types.get(res_id)
+                    if type_str is not None and eva_obj.is_evaluated:
+                        self.eva_count[type_str] = self.eva_count.get(type_str, 0) + 1
             except queue.Empty:
                 continue
             except KeyboardInterrupt:
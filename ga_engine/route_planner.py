@@ -0,0 +1,200 @@
+'''
+    Routes between spawn points planned offline with the CARLA
+    GlobalRoutePlanner, with their segments and segment types, so the
+    Simulator can pick a destination whose segment composition is known
+    and has the segments before Apollo answers the routing request.
+    `select_route` ranks them by the segment types the GA needs most.
+
+    usage:
+        python -m MS_fuzz.ga_engine.route_planner [--town Town10HD]
+            [--dests 8] [--min-radius 100] [--max-radius 9999]
+            [--cache-dir /apollo/data/MS_fuzz/cache]
+'''
+import argparse
+import random
+import time
+from typing import List
+
+import carla
+from loguru import logger
+
+from agents.navigation.global_route_planner import GlobalRoutePlanner
+from MS_fuzz.fuzz_config.Config import Config
+from MS_fuzz.ms_utils.map_catalog import get_route_planner
+from MS_fuzz.ga_engine.scene_segmentation import SceneSegment, segment_to_dict
+
+
+class RoutePlanner(object):
+    '''
+        Plans routes in the layout of ApolloRoutingListener: one
+        'road_<road>_lane_<section>_<lane>_<start s>_<end s>' string and one
+        [start waypoint, end waypoint] pair per lane driven.
+    '''
+
+    def __init__(self, carla_map: carla.Map, sampling_resolution=2.0,
+                 grp: GlobalRoutePlanner = None):
+        self.carla_map = carla_map
+        self.grp = grp if grp else get_route_planner(carla_map,
+                                                     sampling_resolution)
+
+    def plan_routing(self, start: carla.Location, dest: carla.Location):
+        '''
+            return: (routing, routing_wps, route length in m)
+        '''
+        routing = []
+        routing_wps = []
+        s_ranges = []
+        length = 0
+        last_key = None
+        last_wp = None
+        for wp, _ in self.grp.trace_route(start, dest):
+            if last_wp is not None:
+                length += wp.transform.location.distance(last_wp.transform.location)
+            last_wp = wp
+            key = (wp.road_id, wp.section_id, wp.lane_id)
+            if key != last_key:
+                routing_wps.append([wp, wp])
+                s_ranges.append([wp.s, wp.s])
+                last_key = key
+                continue
+            routing_wps[-1][1] = wp
+            s_ranges[-1] = [min(s_ranges[-1][0], wp.s), max(s_ranges[-1][1], wp.s)]
+        for (wp, _), (start_s, end_s) in zip(routing_wps, s_ranges):
+            routing.append(f'road_{wp.road_id}_lane_{wp.section_id}_{wp.lane_id}'
+                           f'_{int(start_s)}_{int(end_s)}')
+        return routing, routing_wps, length
+
+
+def is_valid_dest(carla_map: carla.Map, start: carla.Location,
+                  dest: carla.Transform, min_radius, max_radius):
+    # same conditions as Simulator.select_valid_dest
+    distance = start.distance(dest.location)
+    if distance < min_radius or distance > max_radius:
+        return False
+    dest_wp = carla_map.get_waypoint(dest.location, project_to_road=False)
+    return dest_wp is not None and not dest_wp.is_junction
+
+
+def build_route_catalog(scene_segment: SceneSegment, planner: RoutePlanner,
+                        spawn_points: List[carla.Transform], length, width,
+                        dests_per_start=8, min_radius=100, max_radius=9999,
+                        seed=0) -> list:
+    '''
+        Plan up to `dests_per_start` routes from every spawn point.
+        return: route dicts, the start and dest spawn point indices, the
+            routing, the segments and their types (see get_seg_type)
+    '''
+    rng = random.Random(seed)
+    carla_map = scene_segment.carla_map
+    routes = []
+    for start_index, start_tf in enumerate(spawn_points):
+        candidates = [i for i, dest_tf in enumerate(spawn_points)
+                      if is_valid_dest(carla_map, start_tf.location, dest_tf,
+                                       min_radius, max_radius)]
+        for dest_index in rng.sample(candidates,
+                                     min(dests_per_start, len(candidates))):
+            try:
+                routing, routing_wps, route_length = planner.plan_routing(
+                    start_tf.location, spawn_points[dest_index].location)
+            except Exception as e:
+                logger.warning(f'[RoutePlanner] {start_index} -> {dest_index}: {e}')
+                continue
+            if not routing:
+                continue
+            scene_segment.compute_segments(routing, routing_wps, length, width)
+            segments = scene_segment.segments
+            start_loc = start_tf.location
+            routes.append({
+                'start': start_index,
+                'start_loc': [start_loc.x, start_loc.y, start_loc.z],
+                'dest': dest_index,
+                'routing': routing,
+                'length': round(route_length, 1),
+                'segments': [segment_to_dict(seg) for seg in segments],
+                'types': [scene_segment.get_seg_type(seg, (width, length))
+                          for seg in segments],
+            })
+    return routes
+
+
+def score_route(route: dict, coverage: dict, pending_bonus=0.5,
+                evaluation_weight=0.1) -> float:
+    '''
+        Expected GA progress per km of `route` given the GA_LIB coverage
+        (see GA_LIB.get_coverage). Each segment scores
+        - 1 when its type has no CEGA yet
+        - 1 / (1 + generation) of its CEGA otherwise, plus `pending_bonus`
+          while the CEGA waits for evaluations of its current generation,
+          divided by 1 + `evaluation_weight` * evaluations of this run
+        and the k-th repeat of a type within the route is divided by 1 + k.
+    '''
+    seen = {}
+    score = 0
+    for type_str in route['types']:
+        repeat = seen.get(type_str, 0)
+        seen[type_str] = repeat + 1
+        cega = coverage.get(type_str)
+        if cega is None:
+            gain = 1
+        else:
+            gain = 1 / (1 + cega['generation'])
+            if cega['unevaluated'] > 0:
+                gain += pending_bonus
+            gain /= 1 + evaluation_weight * cega['evaluations']
+        score += gain / (1 + repeat)
+    return score / max(route['length'] / 1000, 0.1)
+
+
+def select_route(routes: List[dict], coverage: dict) -> dict:
+    '''
+        The best scored route, ties broken at random.
+    '''
+    scores = [score_route(route, coverage) for route in routes]
+    best = max(scores)
+    return random.choice([route for route, score in zip(routes, scores)
+                          if score >= best - 1e-9])
+
+
+def main():
+    cfgs = Config()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--sim-host", default=cfgs.sim_host, type=str)
+    parser.add_argument("-p", "--sim-port", default=cfgs.sim_port, type=int)
+    parser.add_argument('--town', default=None, type=str,
+                        help='load this map first, the current one by default')
+    parser.add_argument('--dests', default=8, type=int,
+                        help='routes planned from each spawn point')
+    parser.add_argument('--min-radius', default=100, type=float)
+    parser.add_argument('--max-radius', default=9999, type=float)
+    parser.add_argument('--cache-dir', default=cfgs.cache_dir, type=str)
+    args = parser.parse_args()
+
+    client = carla.Client(args.sim_host, args.sim_port)
+    client.set_timeout(60.0)
+    world = client.get_world()
+    if args.town and not world.get_map().name.endswith(args.town):
+        world = client.load_world(args.town)
+
+    scene_segment = SceneSegment(world, None, logger=logger,
+                                 cache_dir=args.cache_dir)
+    map_name = scene_segment.map_catalog.map_name
+    start = time.time()
+    planner = RoutePlanner(scene_segment.carla_map)
+    logger.info(f'[RoutePlanner] {map_name}: graph built in {time.time() - start:.1f}s')
+
+    start = time.time()
+    routes = build_route_catalog(scene_segment, planner,
+                                 scene_segment.map_catalog.spawn_points,
+                                 cfgs.scenario_length, cfgs.scenario_width,
+                                 dests_per_start=args.dests,
+                                 min_radius=args.min_radius,
+                                 max_radius=args.max_radius)
+    scene_segment.segment_cache.save_routes(map_name, routes)
+    types = set(t for route in routes for t in route['types'])
+    logger.info(f'[RoutePlanner] {map_name}: {len(routes)} routes, '
+                f'{sum(len(route["types"]) for route in routes)} segments of '
+                f'{len(types)} types in {time.time() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,16 @@ import carla
 import math
 from typing import List
 import time
-import threading
 import signal
 import pdb
-import xml.etree.ElementTree as ET
 
 
 from MS_fuzz.ms_utils.apollo_routing_listener import ApolloRoutingListener
-from MS_fuzz.ms_utils import rotate_point
+from MS_fuzz.ms_utils.map_catalog import MapCatalog, get_map_catalog
+from MS_fuzz.ms_utils.stage_profiler import get_stage_profiler
+from MS_fuzz.ms_utils.xodr_tables import XodrTables, parse_xodr
+from MS_fuzz.ga_engine.segment_cache import SegmentCache
+from MS_fuzz.ga_engine.segment_tracker import SegmentTracker, SegmentGeometry
 
 
 class Segment(object):
@@ -31,34 +33,70 @@ class Segment(object):
             location, carla.Vector3D(self.length/2, self.width/2, 2))
 
 
+def segment_to_dict(seg: Segment) -> dict:
+    return {
+        'location': [seg.location.x, seg.location.y, seg.location.z],
+        'rotation': [seg.rotation.pitch, seg.rotation.yaw, seg.rotation.roll],
+        'length': seg.length,
+        'width': seg.width,
+        'is_junction': seg.is_junction,
+        'belongs_to_roadid': seg.belongs_to_roadid,
+    }
+
+
+def segment_from_dict(data: dict) -> Segment:
+    seg = Segment(carla.Location(*data['location']),
+                  carla.Rotation(*data['rotation']),
+                  data['length'], data['width'],
+                  is_junction=data['is_junction'])
+    seg.belongs_to_roadid = data['belongs_to_roadid']
+    return seg
+
+
+def get_road_sequence(routing: List[str]) -> List[str]:
+    '''
+        Road ids along a routing, e.g. ['road_12_lane_0_-1_0_35', ...]
+        -> ['12', ...], consecutive duplicates merged.
+    '''
+    roads = []
+    for road in routing:
+        road_id = road.split('_')[1]
+        if not roads or roads[-1] != road_id:
+            roads.append(road_id)
+    return roads
+
+
 class SceneSegment(object):
     def __init__(self, world: carla.World,
                  vehicle: carla.Vehicle,
                  logger=None,
-                 debug=False):
+                 debug=False,
+                 cache_dir=None):
         self.carla_world: carla.World = world
         self.ego_vehicle: carla.Vehicle = vehicle
-        self.carla_map: carla.Map = self.carla_world.get_map()
-        self.xodr_str = self.carla_map.to_opendrive()
-        self.xodr_root = ET.fromstring(self.xodr_str)
+        self.map_catalog: MapCatalog = get_map_catalog(self.carla_world)
+        self.carla_map: carla.Map = self.map_catalog.carla_map
         self.logger = logger
         self.debug = debug
 
-        self.map_roads = {}
-        self.map_junctions = {}
-        self.map_road_to_junctions = {}
+        # xodr tables and segment lists of previous runs, None to disable
+        self.segment_cache: SegmentCache = None
+        if cache_dir:
+            self.segment_cache = SegmentCache(cache_dir)
 
-        self.finished_index = -1
-        self.curr_seg_index = -1
-        self.belongs_to_two_index = (True, False)
+        # road / junction tables of the map, see XodrTables
+        self.xodr_tables: XodrTables = None
+
+        # ego position over self.segments, updated on every world tick
+        self.tracker = SegmentTracker()
+        self.on_tick_id = None
+        # belongs_to_two_index:
         # | normal: [ *] [ ];     | between: [ [*] ];       | neither: [ ]*[ ]         |
         # |         ↑             |          ↑              |          ↑               |
         # |         curr_index    |          curr_index     |          curr_index      |
         # |    (True, False)      |       (True, True)      |     (False, False)       |
 
-        self.phrase_xodr()
-        # print(self.map_roads)
-        # print(self.map_junctions)
+        self.load_xodr()
 
         self.routing_listener = ApolloRoutingListener(self.carla_world,
                                                       ego_vehicle=self.ego_vehicle,
@@ -71,126 +109,53 @@ class SceneSegment(object):
 
         self.segments: List[Segment] = []
 
-        self.vehicle_pos_listener_thread: threading.Thread = None
-
-        self.stop_vehicle_pos_listening = False
-
-    def phrase_xodr(self):
-        for road in self.xodr_root.findall('road'):
-            if road.get('junction') != '-1':
-                self.map_road_to_junctions[road.get(
-                    'id')] = road.get('junction')
-            # pdb.set_trace()
-            left_lane = [lan.get('id') for lan in (road.find('.//laneSection/left') or []).findall(
-                'lane') if lan.get('type') == 'driving'] if road.find('.//laneSection/left') is not None else []
-            right_lane = [lan.get('id') for lan in (road.find('.//laneSection/right') or []).findall(
-                'lane') if lan.get('type') == 'driving'] if road.find('.//laneSection/right') is not None else []
-
-            lane_count = len(left_lane) + len(right_lane)
-            self.map_roads[road.get('id')] = {'lane_num': lane_count, 'left_lane': left_lane,
-                                              'right_lane': right_lane}
-        for junction in self.xodr_root.findall('junction'):
-            connections = junction.findall('.//connection')
-            incoming_roads = set()
-            for connection in connections:
-                incoming_roads.add(connection.get('incomingRoad'))
-            self.map_junctions[junction.get('id')] = {'dir_count': len(
-                incoming_roads), 'incoming_roads': list(incoming_roads)}
 
-    def strat_vehicle_pos_listening(self):
-        self.vehicle_pos_listener_thread = threading.Thread(
-            target=self.listening_thread)
-        self.stop_vehicle_pos_listening = False
-        self.vehicle_pos_listener_thread.start()
+    def load_xodr(self):
+        if self.segment_cache:
+            tables = self.segment_cache.load_xodr_tables(self.map_catalog.map_name)
+            if tables:
+                self.xodr_tables = tables
+                return
+        self.xodr_tables = parse_xodr(self.carla_map.to_opendrive())
+        if self.segment_cache:
+            self.segment_cache.save_xodr_tables(self.map_catalog.map_name,
+                                                self.xodr_tables)
 
-    def stop_vehicle_listening(self):
-        self.stop_vehicle_pos_listening = True
-        if self.vehicle_pos_listener_thread:
-            self.vehicle_pos_listener_thread.join()
-
-    def listening_thread(self):
-        last_in_index = self.curr_seg_index - 1
-        while not self.stop_vehicle_pos_listening:
-            pos = self.ego_vehicle.get_location()
-
-            # have not yet gain segments from routing listener
-            if len(self.segments) == 0:
-                self.finished_index = -1
-                continue
+    @property
+    def curr_seg_index(self):
+        return self.tracker.curr_seg_index
 
-            # have finished all segments
-            if self.finished_index == len(self.segments) - 1:
-                self.curr_seg_index = len(self.segments) - 1
-                break
+    @property
+    def finished_index(self):
+        return self.tracker.finished_index
 
-            # have not yet reach the first segment
-            if self.curr_seg_index < 0:
-                self.finished_index = -1
-                # wait until reach the first segment
-                while not self.check_if_loc_in_segment(pos, self.segments[0]):
-                    pos = self.ego_vehicle.get_location()
-                    if self.stop_vehicle_pos_listening:
-                        break
-                # now reached the first segment
-                self.curr_seg_index = 0
-                last_in_index = self.curr_seg_index
-                continue
+    @property
+    def belongs_to_two_index(self):
+        return self.tracker.belongs_to_two_index
 
-            is_in_list = []
-            already_in_list = []
-            for index, seg in enumerate(self.segments):
-                is_in = self.check_if_loc_in_segment(pos, seg)
-                is_in_list.append(is_in)
-                if is_in:
-                    already_in_list.append(index)
-
-            if already_in_list != []:
-                self.curr_seg_index = already_in_list[0]
-                if self.curr_seg_index != last_in_index:
-                    self.finished_index = last_in_index
-                    last_in_index = self.curr_seg_index
-                if len(already_in_list) > 1:
-                    self.belongs_to_two_index = (True, True)
-                else:
-                    self.belongs_to_two_index = (True, False)
-            else:
-                self.belongs_to_two_index = (False, False)
-                if last_in_index == self.curr_seg_index:
-                    self.finished_index = self.curr_seg_index
-
-            # in_curr = self.check_if_loc_in_segment(
-            #     pos, self.segments[self.curr_seg_index])
-            # in_next = False
-            # if self.finished_index < len(self.segments) - 2:
-            #     in_next = self.check_if_loc_in_segment(
-            #         pos, self.segments[self.curr_seg_index + 1])
-            # self.belongs_to_two_index = (in_curr, in_next)
-            # if in_curr == last_in_curr:
-            #     if in_next and not in_curr:
-            #         # [ ] *[ ] ->[ ] [* ]
-            #         self.finished_index = self.curr_seg_index
-            #         self.curr_seg_index += 1
-            #         last_in_curr = in_next
-            #     continue
-            # else:
-            #     if in_curr and in_next:
-            #         # [ [*] ] -> [ []* ]
-            #         self.finished_index = self.curr_seg_index
-            #         self.curr_seg_index += 1
-            #         last_in_curr = in_next
-            #     if not in_curr and not in_next:
-            #         # [ *] [ ] -> [ ]* [ ]
-            #         self.finished_index = self.curr_seg_index
-            #     last_in_curr = in_curr
-            #     continue
+    def strat_vehicle_pos_listening(self):
+        self.tracker.reset(self.segments)
+        self.on_tick_id = self.carla_world.on_tick(self.on_world_tick)
+
+    def stop_vehicle_listening(self):
+        if self.on_tick_id is not None:
+            self.carla_world.remove_on_tick(self.on_tick_id)
+            self.on_tick_id = None
+
+    def on_world_tick(self, world_ss: carla.WorldSnapshot):
+        # the ego position comes with the snapshot, no get_location() RPC
+        ego_ss = world_ss.find(self.ego_vehicle.id)
+        if ego_ss is None:
+            return
+        try:
+            with get_stage_profiler().stage('segment_tracking'):
+                self.tracker.update(ego_ss.get_transform().location)
+        except Exception as e:
+            if self.logger != None:
+                self.logger.warning(f'[SceneSegment] tracking failed: {e}')
 
     def check_if_loc_in_segment(self, pos: carla.Location, seg: Segment):
-        dx = pos.x - seg.location.x
-        dy = pos.y - seg.location.y
-        local_x, local_y = rotate_point(dx, dy, -seg.rotation.yaw)
-        half_width = seg.width / 2
-        half_length = seg.length / 2
-        return (-half_length <= local_x <= half_length) and (-half_width <= local_y <= half_width)
+        return SegmentTracker.check_if_loc_in_segment(pos, seg)
 
     def interpolate_location(start, end, fraction):
         x = start.x + (end.x - start.x) * fraction
@@ -199,7 +164,7 @@ class SceneSegment(object):
         return carla.Location(x, y, z)
 
     def get_seg_type(self, seg: Segment, commmon_size=(30, 30)):
-        road_id = seg.belongs_to_roadid.split('_')[1]
+        road_id = int(seg.belongs_to_roadid.split('_')[1])
         if seg.is_junction:
             size = 'large'
             if seg.width <= commmon_size[0] and seg.length <= commmon_size[1]:
@@ -207,25 +172,24 @@ class SceneSegment(object):
             elif seg.width <= 2*commmon_size[0] and seg.length <= 2*commmon_size[1]:
                 size = 'medium'
 
-            if road_id not in self.map_road_to_junctions:
+            if road_id not in self.xodr_tables.road_junction:
                 return f'junction_{size}_-1_dir'
 
-            jun_index = self.map_road_to_junctions[road_id]
-            if jun_index not in self.map_junctions:
+            jun_index = self.xodr_tables.road_junction[road_id]
+            if jun_index not in self.xodr_tables.junction_incoming:
                 return f'junction_{size}_-1_dir'
 
             # for example 'junction_medium_3_dir'
-            return f"junction_{size}_{self.map_junctions[jun_index]['dir_count']}_dir"
+            return f"junction_{size}_{self.xodr_tables.get_junction_dir_count(jun_index)}_dir"
 
         else:
-            if road_id in self.map_roads:
+            if road_id in self.xodr_tables.road_lanes:
                 lan_dir = '2_way'
-                if len(self.map_roads[road_id]['left_lane']) == 0 or \
-                        len(self.map_roads[road_id]['right_lane']) == 0:
+                if self.xodr_tables.is_one_way(road_id):
                     lan_dir = '1_way'
 
                 # for example 'straight_2_way_8_lane'
-                return (f"straight_{lan_dir}_{self.map_roads[road_id]['lane_num']}_lane")
+                return (f"straight_{lan_dir}_{self.xodr_tables.get_lane_num(road_id)}_lane")
             else:
                 return ('straight_-1_way_-1_lane')
 
@@ -335,6 +299,39 @@ class SceneSegment(object):
                                 among_wp.transform.rotation, length, width))
         return segs
 
+    def get_planned_routes(self, start_loc: carla.Location,
+                           max_offset=5.0) -> List[dict]:
+        '''
+            Routes planned offline (see ga_engine.route_planner) from the
+            spawn point at `start_loc`, empty when there are none.
+        '''
+        if not self.segment_cache:
+            return []
+        routes = self.segment_cache.load_routes(self.map_catalog.map_name)
+        if not routes:
+            return []
+        return [route for route in routes
+                if start_loc.distance(carla.Location(*route['start_loc'])) <= max_offset]
+
+    def set_planned_segments(self, planned_route: dict):
+        '''
+            Use the segments of a route of `get_planned_routes`, available
+            before Apollo routes; check them with `matches_routing()` once it
+            has.
+        '''
+        self.segments = [segment_from_dict(seg)
+                         for seg in planned_route['segments']]
+        self.draw_segments()
+
+    def matches_routing(self, planned_route: dict) -> bool:
+        '''
+            return: True if Apollo's routing drives the roads of `planned_route`
+        '''
+        with self.routing_listener.lock:
+            routting_road = self.routing_listener.routing
+        return get_road_sequence(planned_route['routing']) == \
+            get_road_sequence(routting_road)
+
     def get_segments(self, length: float, width: float):
         self.segments = []
         routting_road = []
@@ -342,12 +339,37 @@ class SceneSegment(object):
             routting_road = self.routing_listener.routing
             routing_wps = self.routing_listener.routing_wps
         # pdb.set_trace()
+        # the start depends on the ego when it is not in the routing
+        start_wp_loc = None
         if routing_wps[0][0] == None:
             # we assume that the vehicle is stopped at the beginning of its planning road
             if self.ego_vehicle != None:
                 start_loc = self.ego_vehicle.get_transform().location
-                routing_wps[0][0] = self.carla_world.get_map(
-                ).get_waypoint(start_loc)
+                routing_wps[0][0] = self.carla_map.get_waypoint(start_loc)
+                wp_loc = routing_wps[0][0].transform.location
+                start_wp_loc = (wp_loc.x, wp_loc.y, wp_loc.z)
+
+        cache_key = None
+        if self.segment_cache:
+            cache_key = SegmentCache.route_key(routting_road, length, width,
+                                               start_wp_loc)
+            cached_segs = self.segment_cache.load_segments(
+                self.map_catalog.map_name, cache_key)
+            if cached_segs is not None:
+                self.segments = [segment_from_dict(seg) for seg in cached_segs]
+                self.draw_segments()
+                return
+
+        self.compute_segments(routting_road, routing_wps, length, width)
+        if self.segment_cache:
+            self.segment_cache.save_segments(
+                self.map_catalog.map_name, cache_key,
+                [segment_to_dict(seg) for seg in self.segments])
+        self.draw_segments()
+
+    def compute_segments(self, routting_road, routing_wps,
+                         length: float, width: float):
+        self.segments = []
 
         for i, route_wp in enumerate(routing_wps):
             if route_wp[0] is None:
@@ -405,15 +427,10 @@ class SceneSegment(object):
             self.segments += between_segs
 
         # delete those segs that are too close to each other
-        segs_temp = self.segments
-        for index in range(1, len(self.segments)):
-            if self.segments[index-1] == None:
-                continue
-            if self.segments[index].location.distance(
-                    self.segments[index - 1].location) < length*2/3:
-                segs_temp[index] = None
-        self.segments = [seg for seg in segs_temp if seg != None]
+        kept = SegmentGeometry(self.segments).get_spaced_indices(length*2/3)
+        self.segments = [self.segments[index] for index in kept]
 
+    def draw_segments(self):
         if self.debug:
             carla_db = self.carla_world.debug
             for i, seg in enumerate(self.segments):
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import threading
+
+from loguru import logger
+
+from MS_fuzz.ms_utils.xodr_tables import XodrTables
+
+
+class SegmentCache(object):
+    '''
+        On-disk cache of what SceneSegment derives from a map, shared by the
+        simulator processes of a campaign:
+        - xodr_<map>.v<VERSION>.npz: XodrTables parsed from the OpenDRIVE
+        - segments_<map>.json: segment lists keyed by the routing road
+          sequence (see `route_key`)
+        - routes_<map>.json: routes planned offline between spawn points,
+          see ga_engine.route_planner
+
+        Entries are keyed by map name, clear `cache_dir` when a map changes.
+    '''
+    VERSION = 2
+
+    def __init__(self, cache_dir: str, logger=logger):
+        self.cache_dir = cache_dir
+        self.logger = logger
+        self.lock = threading.Lock()
+        # map name -> {route key: segment dicts}, loaded once per process
+        self.segments: dict = {}
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def get_path(self, kind, map_name, ext='json'):
+        map_name = map_name.split('/')[-1]
+        return os.path.join(self.cache_dir, f'{kind}_{map_name}.{ext}')
+
+    def read_json(self, path):
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f'[SegmentCache] ignore broken {path}: {e}')
+            return None
+        if data.get('version') != self.VERSION:
+            return None
+        return data
+
+    def write_json(self, path, data):
+        # write then rename, a reader never sees a partial file
+        data['version'] = self.VERSION
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def load_xodr_tables(self, map_name) -> XodrTables:
+        path = self.get_path('xodr', map_name, f'v{self.VERSION}.npz')
+        if not os.path.isfile(path):
+            return None
+        try:
+            return XodrTables.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning(f'[SegmentCache] ignore broken {path}: {e}')
+            return None
+
+    def save_xodr_tables(self, map_name, tables: XodrTables):
+        path = self.get_path('xodr', map_name, f'v{self.VERSION}.npz')
+        # np.savez appends .npz to names without it
+        tmp_path = f'{path[:-4]}.{os.getpid()}.tmp.npz'
+        tables.save(tmp_path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def route_key(routing, length, width, start_loc=None):
+        '''
+            routing: road strings of the routing listener, e.g.
+                'road_12_lane_0_-1_0_35'
+            start_loc: (x, y, z) of the start waypoint when it does not come
+                from the routing (ego position)
+        '''
+        key = {'routing': list(routing), 'length': length, 'width': width}
+        if start_loc is not None:
+            key['start'] = [round(v, 1) for v in start_loc]
+        return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+    def get_map_segments(self, map_name):
+        if map_name not in self.segments:
+            data = self.read_json(self.get_path('segments', map_name))
+            self.segments[map_name] = data['routes'] if data else {}
+        return self.segments[map_name]
+
+    def load_segments(self, map_name, key):
+        with self.lock:
+            return self.get_map_segments(map_name).get(key)
+
+    def save_segments(self, map_name, key, segments):
+        with self.lock:
+            routes = self.get_map_segments(map_name)
+            # merge what other processes saved meanwhile
+            data = self.read_json(self.get_path('segments', map_name))
+            if data:
+                routes.update(data['routes'])
+            routes[key] = segments
+            self.write_json(self.get_path('segments', map_name),
+                            {'routes': routes})
+
+    def load_routes(self, map_name):
+        data = self.read_json(self.get_path('routes', map_name))
+        return data['routes'] if data else None
+
+    def save_routes(self, map_name, routes):
+        self.write_json(self.get_path('routes', map_name), {'routes': routes})
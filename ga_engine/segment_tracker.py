@@ -0,0 +1,176 @@
+import math
+from typing import List
+
+import numpy as np
+import carla
+
+from MS_fuzz.ms_utils import rotate_point
+
+
+class SegmentGeometry(object):
+    '''
+        Oriented boxes of a segment list as arrays, for containment queries
+        over all segments in one call. Same arithmetic as
+        `SegmentTracker.check_if_loc_in_segment`, same results.
+    '''
+
+    def __init__(self, segments: List):
+        self.segment_num = len(segments)
+        self.centers = np.array([(seg.location.x, seg.location.y, seg.location.z)
+                                 for seg in segments],
+                                dtype=np.float64).reshape(-1, 3)
+        # rotate_point(dx, dy, -yaw), cos / sin from math as it does
+        radians = [math.radians(-seg.rotation.yaw) for seg in segments]
+        self.cos = np.array([math.cos(r) for r in radians], dtype=np.float64)
+        self.sin = np.array([math.sin(r) for r in radians], dtype=np.float64)
+        self.half_length = np.array([seg.length / 2 for seg in segments],
+                                    dtype=np.float64)
+        self.half_width = np.array([seg.width / 2 for seg in segments],
+                                   dtype=np.float64)
+
+    def contains(self, points: np.ndarray, start=0, end=None) -> np.ndarray:
+        '''
+            points: (N, 2) array of x, y
+            return: (N, end - start) bool array, True if point n is in
+                segment start + s
+        '''
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        seg_slice = slice(start, end)
+        dx = points[:, 0:1] - self.centers[seg_slice, 0]
+        dy = points[:, 1:2] - self.centers[seg_slice, 1]
+        cos = self.cos[seg_slice]
+        sin = self.sin[seg_slice]
+        local_x = dx * cos - dy * sin
+        local_y = dx * sin + dy * cos
+        half_length = self.half_length[seg_slice]
+        half_width = self.half_width[seg_slice]
+        return (-half_length <= local_x) & (local_x <= half_length) & \
+            (-half_width <= local_y) & (local_y <= half_width)
+
+    def containing(self, pos: carla.Location, start=0, end=None) -> np.ndarray:
+        '''
+            return: sorted indices of the segments in [start, end) containing
+                `pos`
+        '''
+        return np.flatnonzero(self.contains((pos.x, pos.y), start, end)[0]) + start
+
+    def get_spaced_indices(self, min_distance) -> np.ndarray:
+        '''
+            Indices kept by the overlap pruning of `SceneSegment.compute_segments`:
+            a segment closer than `min_distance` to the previous one is dropped
+            unless the previous one was dropped already.
+        '''
+        if self.segment_num == 0:
+            return np.zeros(0, dtype=np.int64)
+        # carla.Location.distance works in float32
+        centers = self.centers.astype(np.float32)
+        diff = centers[1:] - centers[:-1]
+        distance = np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1]
+                           + diff[:, 2] * diff[:, 2])
+        close = np.concatenate(([False], distance.astype(np.float64) < min_distance))
+        # in a run of close segments every other one is dropped, starting
+        # with the first of the run
+        indices = np.arange(self.segment_num)
+        run_first = close & ~np.concatenate(([False], close[:-1]))
+        run_start = np.maximum.accumulate(np.where(run_first, indices, 0))
+        dropped = close & ((indices - run_start) % 2 == 0)
+        return np.flatnonzero(~dropped)
+
+
+class SegmentTracker(object):
+    '''
+        Follows the ego along the ordered segments of a route, one `update()`
+        per world snapshot.
+
+        Only the `window` segments from the current one on are checked each
+        update, the route is driven in order so the cursor never goes back.
+        When the ego is in none of them (segments skipped, or between two
+        segments) all later segments are checked in one SegmentGeometry
+        query.
+
+        Unlike the former listening thread, which checked every segment from
+        the first on, re-entering an earlier segment that overlaps the
+        current one does not move back to it: where it went from segment 4
+        back to 3 and reported (curr 3, finished 4), the tracker stays at
+        (curr 4, finished 3). Otherwise the states are the same, see
+        `ms_utils/selfcheck.py check_tracking`.
+
+        State, read by the Simulator:
+        - curr_seg_index: segment the ego is in, -1 before the first one
+        - finished_index: last segment the ego left
+        - belongs_to_two_index: see SceneSegment
+    '''
+
+    def __init__(self, window=3):
+        self.window = window
+        self.reset([])
+
+    def reset(self, segments: List):
+        self.segments = segments
+        self.geometry = SegmentGeometry(segments)
+        self.curr_seg_index = -1
+        self.finished_index = -1
+        self.belongs_to_two_index = (True, False)
+        self.last_in_index = -2
+        self.finished = False
+
+    @staticmethod
+    def check_if_loc_in_segment(pos: carla.Location, seg):
+        dx = pos.x - seg.location.x
+        dy = pos.y - seg.location.y
+        local_x, local_y = rotate_point(dx, dy, -seg.rotation.yaw)
+        half_width = seg.width / 2
+        half_length = seg.length / 2
+        return (-half_length <= local_x <= half_length) and (-half_width <= local_y <= half_width)
+
+    def find_containing_segments(self, pos: carla.Location) -> List[int]:
+        '''
+            return: sorted indices of the segments containing `pos`, from the
+                current segment on
+        '''
+        start = max(self.curr_seg_index, 0)
+        end = min(start + self.window, len(self.segments))
+        # a few scalar checks are cheaper than one array query
+        found = [index for index in range(start, end)
+                 if self.check_if_loc_in_segment(pos, self.segments[index])]
+        if found and found[-1] < end - 1:
+            return found
+        # none found, or the last of the window may overlap the next ones
+        return found + self.geometry.containing(pos, end).tolist()
+
+    def update(self, pos: carla.Location):
+        # have not yet gain segments from routing listener
+        if len(self.segments) == 0:
+            self.finished_index = -1
+            return
+
+        if self.finished:
+            return
+        # have finished all segments
+        if self.finished_index == len(self.segments) - 1:
+            self.curr_seg_index = len(self.segments) - 1
+            self.finished = True
+            return
+
+        # have not yet reach the first segment
+        if self.curr_seg_index < 0:
+            self.finished_index = -1
+            if not self.check_if_loc_in_segment(pos, self.segments[0]):
+                return
+            self.curr_seg_index = 0
+            self.last_in_index = self.curr_seg_index
+
+        already_in_list = self.find_containing_segments(pos)
+        if already_in_list != []:
+            self.curr_seg_index = already_in_list[0]
+            if self.curr_seg_index != self.last_in_index:
+                self.finished_index = self.last_in_index
+                self.last_in_index = self.curr_seg_index
+            if len(already_in_list) > 1:
+                self.belongs_to_two_index = (True, True)
+            else:
+                self.belongs_to_two_index = (True, False)
+        else:
+            self.belongs_to_two_index = (False, False)
+            if self.last_in_index == self.curr_seg_index:
+                self.finished_index = self.curr_seg_index
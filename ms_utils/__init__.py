@@ -107,6 +107,137 @@ def is_point_in_any_crosswalk(point: carla.Location, crosswalk_list: List[List[c
     return any(is_point_in_crosswalk(point, crosswalk) for crosswalk in crosswalk_list)
 
 
+class CrosswalkIndex(object):
+    '''
+        Batch version of `is_point_in_any_crosswalk` over a fixed crosswalk set.
+        All polygons are padded into (polygon, edge) arrays once, queries
+        prefilter the (point, polygon) pairs by bounding box and run the same
+        ray casting as `is_point_in_crosswalk` on all remaining pairs at once.
+    '''
+
+    def __init__(self, crosswalk_list: List[List[carla.Location]]):
+        self.polygon_num = len(crosswalk_list)
+        max_vertex_num = max((len(cw) for cw in crosswalk_list), default=0)
+        shape = (self.polygon_num, max_vertex_num)
+        # edge i goes from vertex i to vertex (i + 1) % n, padded edges are
+        # horizontal (y1 == y2) and can never be crossed
+        self.x1 = np.zeros(shape)
+        self.y1 = np.zeros(shape)
+        self.x2 = np.zeros(shape)
+        self.y2 = np.zeros(shape)
+        for i, crosswalk in enumerate(crosswalk_list):
+            n = len(crosswalk)
+            xs = np.array([loc.x for loc in crosswalk], dtype=np.float64)
+            ys = np.array([loc.y for loc in crosswalk], dtype=np.float64)
+            self.x1[i, :n] = xs
+            self.y1[i, :n] = ys
+            self.x2[i, :n] = np.roll(xs, -1)
+            self.y2[i, :n] = np.roll(ys, -1)
+
+        if self.polygon_num > 0:
+            valid = np.arange(max_vertex_num)[None, :] < np.array(
+                [len(cw) for cw in crosswalk_list])[:, None]
+            self.min_x = np.where(valid, self.x1, np.inf).min(axis=1)
+            self.max_x = np.where(valid, self.x1, -np.inf).max(axis=1)
+            self.min_y = np.where(valid, self.y1, np.inf).min(axis=1)
+            self.max_y = np.where(valid, self.y1, -np.inf).max(axis=1)
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        '''
+            points: (N, 2) array of x, y
+            return: (N,) bool array, True if the point is in any crosswalk
+        '''
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        result = np.zeros(len(points), dtype=bool)
+        if self.polygon_num == 0 or len(points) == 0:
+            return result
+        x = points[:, 0:1]
+        y = points[:, 1:2]
+        in_bbox = (x >= self.min_x) & (x <= self.max_x) & \
+            (y >= self.min_y) & (y <= self.max_y)
+        point_ids, polygon_ids = np.nonzero(in_bbox)
+        if len(point_ids) == 0:
+            return result
+
+        px = points[point_ids, 0:1]
+        py = points[point_ids, 1:2]
+        x1 = self.x1[polygon_ids]
+        y1 = self.y1[polygon_ids]
+        x2 = self.x2[polygon_ids]
+        y2 = self.y2[polygon_ids]
+
+        dy = np.where(y1 != y2, y2 - y1, 1.0)
+        xinters = (py - y1) * (x2 - x1) / dy + x1
+        crossing = (py > np.minimum(y1, y2)) & (py <= np.maximum(y1, y2)) & \
+            (px <= np.maximum(x1, x2)) & ((x1 == x2) | (px <= xinters))
+        inside = (np.count_nonzero(crossing, axis=1) % 2) == 1
+        result[point_ids[inside]] = True
+        return result
+
+    def contains_locations(self, locs: List[carla.Location]) -> np.ndarray:
+        return self.contains([(loc.x, loc.y) for loc in locs])
+
+    def count_in_crosswalk(self, locs: List[carla.Location]) -> int:
+        if not locs:
+            return 0
+        return int(np.count_nonzero(self.contains_locations(locs)))
+
+
+def snapshot_kinematics(snapshots: List[carla.ActorSnapshot]):
+    '''
+        Stack position, velocity and acceleration of actor snapshots
+        (or actors) into three (K, 3) arrays.
+    '''
+    pos = np.empty((len(snapshots), 3))
+    vel = np.empty((len(snapshots), 3))
+    acc = np.empty((len(snapshots), 3))
+    for i, ss in enumerate(snapshots):
+        loc = ss.get_transform().location
+        v = ss.get_velocity()
+        a = ss.get_acceleration()
+        pos[i] = (loc.x, loc.y, loc.z)
+        vel[i] = (v.x, v.y, v.z)
+        acc[i] = (a.x, a.y, a.z)
+    return pos, vel, acc
+
+
+def predict_collisions(pos1: np.ndarray, vel1: np.ndarray, acc1: np.ndarray,
+                       pos2: np.ndarray, vel2: np.ndarray, acc2: np.ndarray,
+                       prediction_time=1,
+                       time_step=0.05,
+                       collision_distance=2.0):
+    '''
+        Vectorized `predict_collision` for any number of actor pairs.
+
+        Inputs are arrays of shape (..., 3), e.g. (frames, npcs, 3), each pair
+        moves under constant acceleration and is checked at the same time
+        steps as the scalar version.
+        return: (collide, t), bool and float arrays of shape (...),
+                t is nan where no collision is predicted.
+    '''
+    pos1, vel1, acc1, pos2, vel2, acc2 = np.broadcast_arrays(
+        *[np.asarray(arr, dtype=np.float64)
+          for arr in (pos1, vel1, acc1, pos2, vel2, acc2)])
+    lead_shape = pos1.shape[:-1]
+    ts = np.arange(0, prediction_time, time_step)
+    if ts.size == 0 or pos1.size == 0:
+        return np.zeros(lead_shape, dtype=bool), np.full(lead_shape, np.nan)
+
+    # (..., T, 3); rounded to float32 like the carla.Location of the loop
+    t = ts[:, None]
+    future_pos1 = (pos1[..., None, :] + (vel1[..., None, :] * t)
+                   + 0.5 * acc1[..., None, :] * t**2).astype(np.float32).astype(np.float64)
+    future_pos2 = (pos2[..., None, :] + (vel2[..., None, :] * t)
+                   + 0.5 * acc2[..., None, :] * t**2).astype(np.float32).astype(np.float64)
+    diff = future_pos1 - future_pos2
+    dist = np.sqrt(diff[..., 0]**2 + diff[..., 1]**2 + diff[..., 2]**2)
+
+    close = dist < collision_distance
+    collide = close.any(axis=-1)
+    first = np.argmax(close, axis=-1)
+    return collide, np.where(collide, ts[first], np.nan)
+
+
 def predict_collision(actor1: carla.ActorSnapshot,
                       actor2: carla.ActorSnapshot,
                       prediction_time=1,
@@ -114,42 +245,11 @@ def predict_collision(actor1: carla.ActorSnapshot,
                       collision_distance=2.0):
     if actor1 is None or actor2 is None:
         return False, None
-    # Initial conditions
-    position1 = actor1.get_transform().location
-    velocity1 = actor1.get_velocity()
-    acceleration1 = actor1.get_acceleration()
-
-    position2 = actor2.get_transform().location
-    velocity2 = actor2.get_velocity()
-    acceleration2 = actor2.get_acceleration()
-
-    for t in np.arange(0, prediction_time, time_step):
-        # Update positions
-        future_pos1 = carla.Location(
-            x=position1.x + (velocity1.x * t) + 0.5
-            * acceleration1.x * t**2,
-            y=position1.y + (velocity1.y * t) + 0.5
-            * acceleration1.y * t**2,
-            z=position1.z + (velocity1.z * t) + 0.5
-            * acceleration1.z * t**2
-        )
-
-        future_pos2 = carla.Location(
-            x=position2.x + (velocity2.x * t) + 0.5
-            * acceleration2.x * t**2,
-            y=position2.y + (velocity2.y * t) + 0.5
-            * acceleration2.y * t**2,
-            z=position2.z + (velocity2.z * t) + 0.5
-            * acceleration2.z * t**2
-        )
-
-        # Calculate distance between future positions
-        dist = math.sqrt((future_pos1.x - future_pos2.x)**2
-                         + (future_pos1.y - future_pos2.y)**2
-                         + (future_pos1.z - future_pos2.z)**2)
-
-        # Check for potential collision
-        if dist < collision_distance:
-            return True, t
-
-    return False, None
+    collide, t = predict_collisions(*snapshot_kinematics([actor1]),
+                                    *snapshot_kinematics([actor2]),
+                                    prediction_time=prediction_time,
+                                    time_step=time_step,
+                                    collision_distance=collision_distance)
+    if not collide[0]:
+        return False, None
+    return True, t[0]
@@ -0,0 +1,552 @@
+'''
+    Micro benchmarks of the hot paths of the simulation loop.
+
+    usage:
+        python -m MS_fuzz.ms_utils.benchmark crosswalk [--town Town10HD]
+        python -m MS_fuzz.ms_utils.benchmark collision [--frames 600 --npcs 8]
+        python -m MS_fuzz.ms_utils.benchmark metrics [--frames 600 --npcs 8]
+        python -m MS_fuzz.ms_utils.benchmark result [--frames 2400 --npcs 8]
+        python -m MS_fuzz.ms_utils.benchmark recorder [--ticks 400 --profiles off,top,quad]
+        python -m MS_fuzz.ms_utils.benchmark xodr [--towns Town01,Town10HD | --xodr-dir <dir>]
+        python -m MS_fuzz.ms_utils.benchmark tracking [--segments 200 --seconds 10 --routes 300]
+        python -m MS_fuzz.ms_utils.benchmark segments [--segments 200,500 --points 2000]
+        python -m MS_fuzz.ms_utils.benchmark agents [--town Town10HD --npcs 10]
+
+    The equivalence checks without a server are in selfcheck.py.
+'''
+import argparse
+import math
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import carla
+
+from MS_fuzz.ms_utils import get_crosswalk_list, is_point_in_any_crosswalk
+from MS_fuzz.ms_utils import CrosswalkIndex, predict_collisions
+from MS_fuzz.common.frame_buffer import FrameBuffer
+from MS_fuzz.common.metrics import predict_frame_collisions
+from MS_fuzz.common.metrics import MetricsAccumulator, get_segment_metrics
+from MS_fuzz.common.result_saver import write_result, load_result
+from MS_fuzz.common.result_saver import get_trace_columns, get_frame_records
+from MS_fuzz.common.camera_agent_imageio import ScenarioRecorder, RECORDING_PROFILES
+from MS_fuzz.ms_utils.xodr_tables import XodrTables, parse_xodr
+from MS_fuzz.ms_utils.map_catalog import get_route_planner, get_route_cache_stats
+from MS_fuzz.ga_engine.scene_segmentation import Segment
+from MS_fuzz.ga_engine.segment_tracker import SegmentTracker, SegmentGeometry
+from MS_fuzz.ms_utils.selfcheck import _FakeSnapshot, predict_collision_loop
+from MS_fuzz.ms_utils.selfcheck import get_collision_data, check_collision
+from MS_fuzz.ms_utils.selfcheck import get_recorded_frames, check_metrics
+from MS_fuzz.ms_utils.selfcheck import evaluate_loop, result_records_loop
+from MS_fuzz.ms_utils.selfcheck import check_tracking
+
+
+def timeit(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def connect(args) -> carla.World:
+    client = carla.Client(args.sim_host, args.sim_port)
+    client.set_timeout(20.0)
+    world = client.get_world()
+    if args.town and not world.get_map().name.lower().endswith(args.town.lower()):
+        world = client.load_world(args.town)
+    return world
+
+
+def bench_crosswalk(args):
+    world = connect(args)
+    crosswalk_list = get_crosswalk_list(world.get_map().get_crosswalks())
+    index = CrosswalkIndex(crosswalk_list)
+    print(f'{len(crosswalk_list)} crosswalks, '
+          f'{sum(len(cw) for cw in crosswalk_list)} vertices')
+
+    # half of the points around crosswalks, half anywhere on the map
+    rng = random.Random(0)
+    all_vertices = [loc for cw in crosswalk_list for loc in cw]
+    xs = [loc.x for loc in all_vertices]
+    ys = [loc.y for loc in all_vertices]
+    points = []
+    for i in range(args.points):
+        if i % 2 == 0:
+            ref = rng.choice(all_vertices)
+            points.append(carla.Location(ref.x + rng.uniform(-3, 3),
+                                         ref.y + rng.uniform(-3, 3), 0))
+        else:
+            points.append(carla.Location(rng.uniform(min(xs), max(xs)),
+                                         rng.uniform(min(ys), max(ys)), 0))
+
+    expected = np.array([is_point_in_any_crosswalk(p, crosswalk_list)
+                         for p in points])
+    result = index.contains_locations(points)
+    assert (expected == result).all(), 'CrosswalkIndex differs from reference'
+
+    # a tick queries every walker of the scenario at once
+    batches = [points[i:i + args.batch]
+               for i in range(0, len(points), args.batch)]
+    t_loop = timeit(lambda: [sum(is_point_in_any_crosswalk(p, crosswalk_list)
+                                 for p in batch) for batch in batches])
+    t_index = timeit(lambda: [index.count_in_crosswalk(batch)
+                              for batch in batches])
+    print(f'{len(batches)} ticks x {args.batch} walkers')
+    print(f'  ray casting loop : {t_loop / len(batches) * 1e6:9.1f} us/tick')
+    print(f'  CrosswalkIndex   : {t_index / len(batches) * 1e6:9.1f} us/tick')
+    print(f'  speedup          : {t_loop / t_index:9.1f}x')
+
+
+def bench_collision(args):
+    ego, npc, ego_ss, npc_ss = get_collision_data(args.frames, args.npcs)
+    collisions = check_collision(args.frames, args.npcs)
+    print(f'{args.frames} frames x {args.npcs} npcs, '
+          f'{collisions} predicted collisions, results identical')
+
+    def run_loop():
+        return [[predict_collision_loop(npc_ss[f][n], ego_ss[f])
+                 for n in range(args.npcs)] for f in range(args.frames)]
+
+    def run_vectorized():
+        return predict_collisions(*npc, *ego)
+
+    t_loop = timeit(run_loop, repeat=1)
+    t_vec = timeit(run_vectorized)
+    print(f'  20-step loop       : {t_loop * 1e3:9.2f} ms')
+    print(f'  predict_collisions : {t_vec * 1e3:9.2f} ms')
+    print(f'  speedup            : {t_loop / t_vec:9.1f}x')
+
+
+def bench_metrics(args):
+    recorded = get_recorded_frames(args.frames, args.npcs)
+    fitness = check_metrics(args.frames, args.npcs)
+    print(f'{args.frames} frames x {args.npcs} npcs, fitness {fitness}, '
+          f'results identical')
+
+    def run_loop():
+        return evaluate_loop(recorded), result_records_loop(recorded)
+
+    def run_pipeline():
+        buf = FrameBuffer(args.npcs)
+        accumulator = MetricsAccumulator()
+        for frame in recorded:
+            index = buf.append(frame['timestamp'], frame['frame'], frame['min_dis'],
+                               frame['unsmooth_acc'], frame['walker_in_road'],
+                               frame['ego_ss'], frame['npc_vehicles_ss'])
+            accumulator.update(frame['min_dis'], frame['unsmooth_acc'],
+                               frame['walker_in_road'],
+                               predict_frame_collisions(buf, index))
+        return get_frame_records(get_trace_columns(buf, get_segment_metrics(buf)))
+
+    t_loop = timeit(run_loop, repeat=1)
+    t_pipeline = timeit(run_pipeline, repeat=3)
+    print(f'  evaluate + save_result loops : {t_loop * 1e3:9.2f} ms')
+    print(f'  FrameBuffer pipeline         : {t_pipeline * 1e3:9.2f} ms')
+    print(f'  speedup                      : {t_loop / t_pipeline:9.1f}x')
+
+
+def bench_result(args):
+    rng = np.random.default_rng(0)
+    buf = FrameBuffer(args.npcs)
+    for f in range(args.frames):
+        ego = _FakeSnapshot((f * 0.5, 0, 0.1), (10, 0, 0), (0, 0, 0))
+        npcs = [_FakeSnapshot(rng.uniform(-30, 30, 3) * (1, 1, 0),
+                              rng.uniform(-10, 10, 3) * (1, 1, 0),
+                              rng.uniform(-2, 2, 3) * (1, 1, 0))
+                for _ in range(args.npcs)]
+        index = buf.append(1000 + f * 0.05, f, 5.0, 0.5, 0, ego, npcs)
+        predict_frame_collisions(buf, index)
+
+    def result_template():
+        return {'unsafe': False, 'start_time': 0, 'video_path': '',
+                'interaction': None, 'Odometer': None}
+
+    print(f'{args.frames} frames x {args.npcs} npcs')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for result_format in ('json', 'npz'):
+            path = os.path.join(tmp_dir, result_format)
+            os.makedirs(path)
+            t_write = timeit(lambda: write_result(result_template(), buf, path,
+                                                  result_format=result_format))
+            t_load = timeit(lambda: load_result(path))
+            size = sum(os.path.getsize(os.path.join(path, name))
+                       for name in os.listdir(path))
+            print(f'  {result_format:4s}: {size / 1024:9.1f} KiB, '
+                  f'write {t_write * 1e3:8.2f} ms, load {t_load * 1e3:8.2f} ms')
+
+
+def get_ego_vehicle(world: carla.World):
+    for actor in world.get_actors().filter('vehicle.*'):
+        if actor.attributes.get('role_name') in ['hero', 'ego_vehicle']:
+            return actor, False
+    ego_bp = world.get_blueprint_library().filter('vehicle.tesla.model3')[0]
+    ego_bp.set_attribute('role_name', 'ego_vehicle')
+    ego_tf = world.get_map().get_spawn_points()[0]
+    return world.spawn_actor(ego_bp, ego_tf), True
+
+
+def tick_intervals(world: carla.World, ticks):
+    # python work of a tick is emulated by a 10 ms numpy load
+    work = np.random.default_rng(0).random((400, 400))
+    intervals = []
+    last = time.perf_counter()
+    for _ in range(ticks):
+        world.tick()
+        work @ work
+        now = time.perf_counter()
+        intervals.append(now - last)
+        last = now
+    return np.array(intervals[10:]) * 1e3
+
+
+def set_synchronous(world: carla.World, synchronous):
+    settings = world.get_settings()
+    settings.synchronous_mode = synchronous
+    settings.fixed_delta_seconds = 0.05
+    world.apply_settings(settings)
+
+
+def bench_recorder(args):
+    world = connect(args)
+    ego_vehicle, spawned = get_ego_vehicle(world)
+    server_version = carla.Client(args.sim_host,
+                                  args.sim_port).get_server_version()
+    origin_settings = world.get_settings()
+    print(f'{args.ticks} ticks, interval ms: mean / std / p99 / max, server fps')
+    try:
+        for profile in args.profiles.split(','):
+            recorder = None
+            if profile in RECORDING_PROFILES:
+                cameras, resolution = RECORDING_PROFILES[profile]
+                # cameras are spawned while the world still ticks on its own
+                set_synchronous(world, False)
+                recorder = ScenarioRecorder(world, ego_vehicle, tempfile.mkdtemp(),
+                                            resolution=resolution,
+                                            server_version=server_version,
+                                            cameras=cameras)
+                recorder.spawn_cams()
+            set_synchronous(world, True)
+            if recorder:
+                recorder.start_recording()
+            intervals = tick_intervals(world, args.ticks)
+            if recorder:
+                recorder.stop_recording()
+            print(f'  {profile:8s}: {intervals.mean():7.2f} / '
+                  f'{intervals.std():7.2f} / {np.percentile(intervals, 99):7.2f} / '
+                  f'{intervals.max():7.2f}, {1e3 / intervals.mean():6.1f} fps')
+            if recorder:
+                encoder = recorder.encoder
+                print(f'            frames: {encoder.submitted_frames} submitted, '
+                      f'{encoder.encoded_frames} encoded, '
+                      f'{encoder.dropped_frames} dropped')
+                set_synchronous(world, False)
+                recorder.rm_cams()
+    finally:
+        world.apply_settings(origin_settings)
+        if spawned:
+            ego_vehicle.destroy()
+
+
+def parse_xodr_tree(xodr: str) -> XodrTables:
+    # the former SceneSegment.phrase_xodr, whole tree then findall per road
+    root = ET.fromstring(xodr)
+    tables = XodrTables()
+    for road in root.findall('road'):
+        road_id = int(road.get('id'))
+        if road.get('junction') not in (None, '-1'):
+            tables.road_junction[road_id] = int(road.get('junction'))
+        lanes = []
+        for side in ('left', 'right'):
+            group = road.find(f'.//laneSection/{side}')
+            lanes.append(len([lane for lane in (group if group is not None else [])
+                              if lane.tag == 'lane' and lane.get('type') == 'driving']))
+        tables.road_lanes[road_id] = tuple(lanes)
+        tables.section_lanes[road_id] = [
+            (float(sec.get('s', 0)),
+             len(sec.findall("left/lane[@type='driving']")),
+             len(sec.findall("right/lane[@type='driving']")))
+            for sec in road.findall('lanes/laneSection')]
+    for junction in root.findall('junction'):
+        tables.junction_incoming[int(junction.get('id'))] = tuple(sorted(
+            set(int(c.get('incomingRoad')) for c in junction.findall('.//connection'))))
+    return tables
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def get_xodr_sources(args):
+    if args.xodr_dir:
+        for name in sorted(os.listdir(args.xodr_dir)):
+            if name.endswith('.xodr'):
+                with open(os.path.join(args.xodr_dir, name), encoding='utf-8') as f:
+                    yield name[:-5], f.read()
+        return
+    client = carla.Client(args.sim_host, args.sim_port)
+    client.set_timeout(60.0)
+    towns = args.towns.split(',') if args.towns else \
+        [name.split('/')[-1] for name in client.get_available_maps()]
+    for town in towns:
+        world = client.get_world()
+        if not world.get_map().name.endswith(town):
+            world = client.load_world(town)
+        yield town, world.get_map().to_opendrive()
+
+
+def bench_xodr(args):
+    print('town: size, roads / junctions, tree / iterparse / cached load ms, '
+          'tree / iterparse peak MiB')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for town, xodr in get_xodr_sources(args):
+            tables = parse_xodr(xodr)
+            assert tables == parse_xodr_tree(xodr), f'{town}: tables differ'
+            path = os.path.join(tmp_dir, f'{town}.npz')
+            tables.save(path)
+            assert XodrTables.load(path) == tables, f'{town}: npz round trip'
+
+            t_tree = timeit(lambda: parse_xodr_tree(xodr), repeat=3)
+            t_iter = timeit(lambda: parse_xodr(xodr), repeat=3)
+            t_load = timeit(lambda: XodrTables.load(path))
+            m_tree = peak_memory(lambda: parse_xodr_tree(xodr))
+            m_iter = peak_memory(lambda: parse_xodr(xodr))
+            print(f'  {town:14s}: {len(xodr) / 2**20:6.1f} MiB, '
+                  f'{len(tables.road_lanes):5d} / {len(tables.junction_incoming):4d}, '
+                  f'{t_tree * 1e3:8.1f} / {t_iter * 1e3:8.1f} / {t_load * 1e3:6.2f} ms, '
+                  f'{m_tree / 2**20:6.1f} / {m_iter / 2**20:6.1f} MiB')
+
+
+def get_route_segments(world: carla.World, start: carla.Location, count,
+                       length=30, width=30):
+    segments = []
+    wp = world.get_map().get_waypoint(start)
+    for _ in range(count):
+        segments.append(Segment(wp.transform.location, wp.transform.rotation,
+                                length, width))
+        next_wps = wp.next(length)
+        if not next_wps:
+            break
+        wp = next_wps[0]
+    return segments
+
+
+def spin_tracking(ego_vehicle: carla.Vehicle, segments, seconds):
+    # the former SceneSegment.listening_thread: poll and check every segment
+    calls = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pos = ego_vehicle.get_location()
+        calls += 1
+        [SegmentTracker.check_if_loc_in_segment(pos, seg) for seg in segments]
+    return calls
+
+
+def bench_tracking(args):
+    routes, went_back = check_tracking(args.routes)
+    print(f'{routes} replayed routes: states as the former loop, which went '
+          f'back to an earlier segment on {went_back} of them')
+
+    world = connect(args)
+    ego_vehicle, spawned = get_ego_vehicle(world)
+    try:
+        segments = get_route_segments(world, ego_vehicle.get_location(),
+                                      args.segments)
+        print(f'{len(segments)} segments, {args.seconds} s each, '
+              f'world ticking on its own')
+
+        cpu = time.process_time()
+        calls = spin_tracking(ego_vehicle, segments, args.seconds)
+        cpu = time.process_time() - cpu
+        print(f'  spinning thread: {cpu / args.seconds * 100:6.1f} % cpu, '
+              f'{calls / args.seconds:8.1f} get_location/s')
+
+        tracker = SegmentTracker()
+        tracker.reset(segments)
+        updates = []
+
+        def on_tick(world_ss: carla.WorldSnapshot):
+            ego_ss = world_ss.find(ego_vehicle.id)
+            if ego_ss is not None:
+                tracker.update(ego_ss.get_transform().location)
+                updates.append(world_ss.frame)
+
+        cpu = time.process_time()
+        callback_id = world.on_tick(on_tick)
+        time.sleep(args.seconds)
+        world.remove_on_tick(callback_id)
+        cpu = time.process_time() - cpu
+        print(f'  on_tick tracker: {cpu / args.seconds * 100:6.1f} % cpu, '
+              f'{0:8.1f} get_location/s, {len(updates) / args.seconds:6.1f} updates/s, '
+              f'curr segment {tracker.curr_seg_index}')
+    finally:
+        if spawned:
+            ego_vehicle.destroy()
+
+
+def get_synthetic_segments(count, rng: random.Random, length=30, width=30):
+    # a winding route, 15 to 25 m between segments
+    segments = []
+    x, y, yaw = 0.0, 0.0, 0.0
+    for _ in range(count):
+        segments.append(Segment(carla.Location(x, y, 0), carla.Rotation(0, yaw, 0),
+                                length, width))
+        yaw += rng.uniform(-15, 15)
+        step = rng.uniform(15, 25)
+        x += step * math.cos(math.radians(yaw))
+        y += step * math.sin(math.radians(yaw))
+    return segments
+
+
+def bench_segments(args):
+    rng = random.Random(0)
+    for count in [int(c) for c in args.segments.split(',')]:
+        segments = get_synthetic_segments(count, rng)
+        geometry = SegmentGeometry(segments)
+        points = [carla.Location(seg.location.x + rng.uniform(-20, 20),
+                                 seg.location.y + rng.uniform(-20, 20), 0)
+                  for seg in rng.choices(segments, k=args.points)]
+        xy = np.array([(p.x, p.y) for p in points])
+
+        def run_loop():
+            return [[SegmentTracker.check_if_loc_in_segment(p, seg)
+                     for seg in segments] for p in points]
+
+        def run_prune_loop():
+            segs_temp = list(segments)
+            for index in range(1, len(segments)):
+                if segs_temp[index - 1] == None:
+                    continue
+                if segments[index].location.distance(
+                        segments[index - 1].location) < 20:
+                    segs_temp[index] = None
+            return [i for i, seg in enumerate(segs_temp) if seg != None]
+
+        assert np.array_equal(np.array(run_loop()), geometry.contains(xy))
+        assert run_prune_loop() == geometry.get_spaced_indices(20).tolist()
+        t_loop = timeit(run_loop, repeat=1)
+        t_batch = timeit(lambda: geometry.contains(xy))
+        t_one = timeit(lambda: [geometry.containing(p) for p in points[:200]]) / 200
+        t_prune_loop = timeit(run_prune_loop)
+        t_prune = timeit(lambda: SegmentGeometry(segments).get_spaced_indices(20))
+        print(f'{count} segments, {args.points} points, results identical')
+        print(f'  per-segment loop    : {t_loop / args.points * 1e6:9.1f} us / point')
+        print(f'  batch contains      : {t_batch / args.points * 1e6:9.1f} us / point')
+        print(f'  containing (1 point): {t_one * 1e6:9.1f} us')
+        print(f'  pruning loop / array: {t_prune_loop * 1e3:9.2f} / {t_prune * 1e3:6.2f} ms')
+
+
+def bench_agents(args):
+    from agents.navigation.behavior_agent import BehaviorAgent
+
+    world = connect(args)
+    carla_map = world.get_map()
+    ego_vehicle, spawned = get_ego_vehicle(world)
+    rng = random.Random(0)
+    dests = [tf.location for tf in rng.choices(carla_map.get_spawn_points(),
+                                               k=args.npcs)]
+    try:
+        def spawn_agents(get_kwargs):
+            # what spawn_a_vehicle_handler does per npc, minus the spawn
+            latencies = []
+            for dest in dests:
+                start = time.perf_counter()
+                agent = BehaviorAgent(ego_vehicle, behavior='normal', **get_kwargs())
+                agent.set_destination(dest)
+                latencies.append(time.perf_counter() - start)
+            return np.array(latencies) * 1e3
+
+        t_build = timeit(lambda: get_route_planner(carla_map), repeat=1)
+        print(f'{args.npcs} agents, per npc ms: mean / max '
+              f'(shared graph built once in {t_build * 1e3:.0f} ms)')
+        for name, get_kwargs in (
+                ('own planner', lambda: {}),
+                ('shared', lambda: {'map_inst': carla_map,
+                                    'grp_inst': get_route_planner(carla_map)})):
+            latencies = spawn_agents(get_kwargs)
+            print(f'  {name:12s}: {latencies.mean():8.1f} / {latencies.max():8.1f}')
+        # the same destinations again, served by the route cache
+        latencies = spawn_agents(lambda: {'map_inst': carla_map,
+                                          'grp_inst': get_route_planner(carla_map)})
+        print(f'  {"shared again":12s}: {latencies.mean():8.1f} / {latencies.max():8.1f}')
+        for planner, stats in get_route_cache_stats().items():
+            print(f'  route cache {planner}: {stats["hits"]} hits, '
+                  f'{stats["misses"]} misses')
+    finally:
+        if spawned:
+            ego_vehicle.destroy()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--sim-host", default="172.17.0.1", type=str)
+    parser.add_argument("-p", "--sim-port", default=5000, type=int)
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p_cw = sub.add_parser('crosswalk', help='walker_in_road containment')
+    p_cw.add_argument('--town', default='Town10HD', type=str)
+    p_cw.add_argument('--points', default=2000, type=int)
+    p_cw.add_argument('--batch', default=6, type=int)
+    p_cw.set_defaults(func=bench_crosswalk)
+
+    p_col = sub.add_parser('collision', help='predicted collisions of a segment')
+    p_col.add_argument('--frames', default=600, type=int)
+    p_col.add_argument('--npcs', default=8, type=int)
+    p_col.set_defaults(func=bench_collision)
+
+    p_met = sub.add_parser('metrics', help='fitness and result records, former loops vs FrameBuffer')
+    p_met.add_argument('--frames', default=600, type=int)
+    p_met.add_argument('--npcs', default=8, type=int)
+    p_met.set_defaults(func=bench_metrics)
+
+    p_res = sub.add_parser('result', help='result.json vs npz trace of a segment')
+    p_res.add_argument('--frames', default=2400, type=int)
+    p_res.add_argument('--npcs', default=8, type=int)
+    p_res.set_defaults(func=bench_result)
+
+    p_rec = sub.add_parser('recorder', help='tick jitter and fps per recording profile')
+    p_rec.add_argument('--town', default=None, type=str)
+    p_rec.add_argument('--ticks', default=400, type=int)
+    p_rec.add_argument('--profiles', default='off,top,preview,quad', type=str)
+    p_rec.set_defaults(func=bench_recorder)
+
+    p_xodr = sub.add_parser('xodr', help='OpenDRIVE tables, tree vs iterparse vs cache')
+    p_xodr.add_argument('--towns', default=None, type=str,
+                        help='comma separated, all maps of the server by default')
+    p_xodr.add_argument('--xodr-dir', default=None, type=str,
+                        help='read .xodr files instead of the server maps')
+    p_xodr.set_defaults(func=bench_xodr)
+
+    p_trk = sub.add_parser('tracking', help='ego to segment tracking, spinning vs on_tick')
+    p_trk.add_argument('--town', default=None, type=str)
+    p_trk.add_argument('--segments', default=200, type=int)
+    p_trk.add_argument('--seconds', default=10, type=float)
+    p_trk.add_argument('--routes', default=300, type=int,
+                       help='random routes replayed through both trackers')
+    p_trk.set_defaults(func=bench_tracking)
+
+    p_seg = sub.add_parser('segments', help='segment containment, per segment vs arrays')
+    p_seg.add_argument('--segments', default='100,300,800', type=str)
+    p_seg.add_argument('--points', default=2000, type=int)
+    p_seg.set_defaults(func=bench_segments)
+
+    p_agt = sub.add_parser('agents', help='BehaviorAgent creation, own vs shared route planner')
+    p_agt.add_argument('--town', default=None, type=str)
+    p_agt.add_argument('--npcs', default=10, type=int)
+    p_agt.set_defaults(func=bench_agents)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import copy
+import threading
+from typing import Dict, List
+
+import carla
+
+from MS_fuzz.ms_utils import get_crosswalk_list, CrosswalkIndex
+
+
+class MapCatalog(object):
+    '''
+        Static data of a loaded world that does not change until the next
+        `load_world`: the map, blueprints by category, crosswalk polygons
+        and spawn points.
+
+        Do not build it directly, use `get_map_catalog(world)` so that every
+        `Simulator`, `LocalScenario`, `SceneSegment` and `UnsafeDetector` of
+        the process shares the same instance.
+    '''
+
+    def __init__(self, world: carla.World):
+        # the episode id changes every time a world is (re)loaded
+        self.world_id = world.id
+        self.carla_map: carla.Map = world.get_map()
+        self.map_name: str = self.carla_map.name.split('/')[-1]
+
+        self.world_blueprint: carla.BlueprintLibrary = world.get_blueprint_library()
+        self.vehicle_blueprint: carla.BlueprintLibrary = self.world_blueprint.filter(
+            'vehicle')
+        self.walker_blueprint: carla.BlueprintLibrary = self.world_blueprint.filter(
+            'walker')
+
+        # base_type -> blueprints, e.g. 'car', 'truck', 'van', 'motorcycle'
+        self.vehicle_bps_by_type: Dict[str, List[carla.ActorBlueprint]] = {}
+        for bp in self.vehicle_blueprint:
+            if not bp.has_attribute('base_type'):
+                continue
+            base_type = bp.get_attribute('base_type').as_str()
+            self.vehicle_bps_by_type.setdefault(base_type, []).append(bp)
+
+        self.crosswalk_list: List[List[carla.Location]] = get_crosswalk_list(
+            self.carla_map.get_crosswalks())
+        self.crosswalk_index = CrosswalkIndex(self.crosswalk_list)
+        self.spawn_points: List[carla.Transform] = self.carla_map.get_spawn_points()
+
+    def get_vehicle_bps(self, base_type: str) -> List[carla.ActorBlueprint]:
+        return self.vehicle_bps_by_type.get(base_type, [])
+
+    def find_blueprint(self, bp_id: str) -> carla.ActorBlueprint:
+        # `BlueprintLibrary.find` returns a copy, safe to set attributes on
+        return self.world_blueprint.find(bp_id)
+
+
+_catalog_lock = threading.Lock()
+_catalog: MapCatalog = None
+
+
+def get_map_catalog(world: carla.World) -> MapCatalog:
+    '''
+        Return the catalog of the currently loaded world, building it on the
+        first call after a world load.
+    '''
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None or _catalog.world_id != world.id:
+            _catalog = MapCatalog(world)
+        return _catalog
+
+
+def invalidate_map_catalog():
+    '''
+        Drop the cached catalog, call it after `client.load_world()`.
+    '''
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
+
+
+_planner_lock = threading.Lock()
+# (map name, sampling resolution) -> GlobalRoutePlanner, kept across world
+# reloads, the road graph only depends on the map
+_route_planners: Dict[tuple, object] = {}
+
+
+def get_route_planner(carla_map: carla.Map, sampling_resolution=2.0,
+                      cache_size=4096):
+    '''
+        A GlobalRoutePlanner of `carla_map` for `BasicAgent(grp_inst=...)`,
+        the graph is built once per map and process and its path searches
+        are memoized, see CachedRoutePlanner.
+
+        Every call returns its own shallow copy: the graph and the route
+        cache are shared and only read by `trace_route`, the turn decision
+        state is per agent as with a planner of its own.
+    '''
+    from MS_fuzz.ms_utils.route_cache import CachedRoutePlanner
+
+    key = (carla_map.name.split('/')[-1], sampling_resolution)
+    with _planner_lock:
+        grp = _route_planners.get(key)
+        if grp is None:
+            grp = CachedRoutePlanner(carla_map, sampling_resolution, cache_size)
+            _route_planners[key] = grp
+    return copy.copy(grp)
+
+
+def get_route_cache_stats() -> Dict[str, dict]:
+    '''
+        Route cache statistics per '<map>@<sampling resolution>'.
+    '''
+    with _planner_lock:
+        planners = list(_route_planners.items())
+    return {f'{map_name}@{resolution}': grp.route_cache.get_stats()
+            for (map_name, resolution), grp in planners}
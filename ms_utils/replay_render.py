@@ -0,0 +1,127 @@
+'''
+    Render the videos of unsafe segments from the CARLA recorder logs
+    written with Config.recorder_profile = 'replay'.
+
+    usage:
+        python -m MS_fuzz.ms_utils.replay_render <result folder> [--all]
+            [--profile quad] [--overwrite]
+
+    <result folder> is a run folder (holding Scenario_*) or a single
+    Scenario_* folder, the video is written next to its result.json.
+'''
+import argparse
+import json
+import os
+import re
+import tempfile
+
+import carla
+
+from MS_fuzz.common.camera_agent_imageio import ScenarioRecorder, RECORDING_PROFILES
+
+
+def find_scenarios(path):
+    if os.path.isfile(os.path.join(path, 'result.json')):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if os.path.isfile(os.path.join(path, name, 'result.json')))
+
+
+def get_log_duration(client: carla.Client, log_path):
+    info = client.show_recorder_file_info(log_path, False)
+    match = re.search(r'Duration:\s*([\d.]+)', info)
+    return float(match.group(1)) if match else None
+
+
+def set_synchronous(world: carla.World, synchronous, delta=0.05):
+    settings = world.get_settings()
+    settings.synchronous_mode = synchronous
+    settings.fixed_delta_seconds = delta
+    world.apply_settings(settings)
+
+
+def find_ego_vehicle(world: carla.World):
+    for actor in world.get_actors().filter('vehicle.*'):
+        if actor.attributes.get('role_name') in ['hero', 'ego_vehicle']:
+            return actor
+    return None
+
+
+def render_log(client: carla.Client, log_path, video_path, profile='quad',
+               delta=0.05):
+    duration = get_log_duration(client, log_path)
+    if not duration:
+        print(f'  cannot read {log_path}')
+        return False
+
+    world = client.get_world()
+    origin_settings = world.get_settings()
+    set_synchronous(world, False)
+    # hold the replay while the cameras are spawned
+    client.set_replayer_time_factor(0.001)
+    client.replay_file(log_path, 0, 0, 0)
+    world = client.get_world()
+    world.wait_for_tick()
+    world.wait_for_tick()
+
+    recorder = None
+    try:
+        ego_vehicle = find_ego_vehicle(world)
+        if ego_vehicle is None:
+            print(f'  no ego vehicle in {log_path}')
+            return False
+        cameras, resolution = RECORDING_PROFILES[profile]
+        recorder = ScenarioRecorder(world, ego_vehicle, tempfile.mkdtemp(),
+                                    resolution=resolution,
+                                    server_version=client.get_server_version(),
+                                    cameras=cameras)
+        recorder.spawn_cams()
+
+        set_synchronous(world, True, delta)
+        client.set_replayer_time_factor(1.0)
+        recorder.start_recording(save_path=video_path)
+        for _ in range(int(duration / delta) + 1):
+            world.tick()
+        recorder.stop_recording()
+    finally:
+        client.stop_replayer(False)
+        set_synchronous(world, False)
+        if recorder:
+            recorder.rm_cams()
+        world.apply_settings(origin_settings)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--sim-host", default="172.17.0.1", type=str)
+    parser.add_argument("-p", "--sim-port", default=5000, type=int)
+    parser.add_argument('result_path', type=str)
+    parser.add_argument('--all', action='store_true',
+                        help='render safe segments too')
+    parser.add_argument('--profile', default='quad', type=str,
+                        choices=list(RECORDING_PROFILES))
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    client = carla.Client(args.sim_host, args.sim_port)
+    client.set_timeout(60.0)
+
+    for sce_path in find_scenarios(args.result_path):
+        with open(os.path.join(sce_path, 'result.json'), 'r') as f:
+            result = json.load(f)
+        log_path = result.get('carla_log')
+        if not log_path or log_path == 'deleted':
+            continue
+        if not result['unsafe'] and not args.all:
+            continue
+        video_path = os.path.join(sce_path, 'replay.mp4')
+        if os.path.isfile(video_path) and not args.overwrite:
+            continue
+        print(f'{sce_path}: {result["unsafe_type"]}')
+        if render_log(client, log_path, video_path, args.profile):
+            print(f'  saved {video_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+
+import networkx as nx
+
+from agents.navigation.global_route_planner import GlobalRoutePlanner
+
+
+class RouteCache(object):
+    '''
+        LRU of the A* node paths of a route graph, keyed by the
+        (start edge, end edge) the origin and destination localize to.
+    '''
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.routes: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            route = self.routes.get(key)
+            if route is None:
+                self.misses += 1
+                return None
+            self.routes.move_to_end(key)
+            self.hits += 1
+            return route
+
+    def put(self, key, route):
+        with self.lock:
+            self.routes[key] = route
+            self.routes.move_to_end(key)
+            while len(self.routes) > self.maxsize:
+                self.routes.popitem(last=False)
+                self.evictions += 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.routes),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0,
+            }
+
+
+class CachedRoutePlanner(GlobalRoutePlanner):
+    '''
+        GlobalRoutePlanner whose path search goes through a RouteCache.
+        `trace_route` is unchanged, only the graph search between the two
+        localized edges is memoized, so traces are identical.
+    '''
+
+    def __init__(self, wmap, sampling_resolution, cache_size=4096):
+        super().__init__(wmap, sampling_resolution)
+        self.route_cache = RouteCache(cache_size)
+
+    def _path_search(self, origin, destination):
+        start, end = self._localize(origin), self._localize(destination)
+        if start is None or end is None:
+            # not on a graph edge, fails as the plain planner does
+            return super()._path_search(origin, destination)
+
+        key = (start, end)
+        route = self.route_cache.get(key)
+        if route is None:
+            route = nx.astar_path(
+                self._graph, source=start[0], target=end[0],
+                heuristic=self._distance_heuristic, weight='length')
+            route.append(end[1])
+            route = tuple(route)
+            self.route_cache.put(key, route)
+        return list(route)
@@ -0,0 +1,412 @@
+'''
+    Equivalence checks of the rewritten hot paths against the former
+    implementations, kept here as reference. They run on synthetic data and
+    need the carla module but no CARLA server.
+
+    usage:
+        python -m MS_fuzz.ms_utils.selfcheck [collision metrics tracking]
+
+    Every check asserts, the command exits non zero on the first mismatch.
+'''
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import carla
+
+from MS_fuzz.ms_utils import predict_collision, predict_collisions
+from MS_fuzz.common.frame_buffer import FrameBuffer
+from MS_fuzz.common.metrics import predict_frame_collisions
+from MS_fuzz.common.evaluate import Evaluate_Object
+from MS_fuzz.common.result_saver import write_result, load_result
+from MS_fuzz.ga_engine.segment_tracker import SegmentTracker
+
+
+class _FakeSnapshot(object):
+    def __init__(self, pos, vel, acc, rot=(0, 0, 0)):
+        self.transform = carla.Transform(carla.Location(*pos),
+                                         carla.Rotation(*rot))
+        self.velocity = carla.Vector3D(*vel)
+        self.acceleration = carla.Vector3D(*acc)
+
+    def get_transform(self):
+        return self.transform
+
+    def get_velocity(self):
+        return self.velocity
+
+    def get_acceleration(self):
+        return self.acceleration
+
+
+def predict_collision_loop(actor1, actor2, prediction_time=1,
+                           time_step=0.05, collision_distance=2.0):
+    # the former step-by-step implementation, kept as reference
+    position1 = actor1.get_transform().location
+    velocity1 = actor1.get_velocity()
+    acceleration1 = actor1.get_acceleration()
+    position2 = actor2.get_transform().location
+    velocity2 = actor2.get_velocity()
+    acceleration2 = actor2.get_acceleration()
+    for t in np.arange(0, prediction_time, time_step):
+        future_pos1 = carla.Location(
+            x=position1.x + (velocity1.x * t) + 0.5 * acceleration1.x * t**2,
+            y=position1.y + (velocity1.y * t) + 0.5 * acceleration1.y * t**2,
+            z=position1.z + (velocity1.z * t) + 0.5 * acceleration1.z * t**2)
+        future_pos2 = carla.Location(
+            x=position2.x + (velocity2.x * t) + 0.5 * acceleration2.x * t**2,
+            y=position2.y + (velocity2.y * t) + 0.5 * acceleration2.y * t**2,
+            z=position2.z + (velocity2.z * t) + 0.5 * acceleration2.z * t**2)
+        dist = math.sqrt((future_pos1.x - future_pos2.x)**2
+                         + (future_pos1.y - future_pos2.y)**2
+                         + (future_pos1.z - future_pos2.z)**2)
+        if dist < collision_distance:
+            return True, t
+    return False, None
+
+
+def get_collision_data(frames, npcs, seed=0):
+    '''
+        Ego around the origin and npcs within 15 m, speeds up to 15 m/s.
+        return: (ego_kinematics, npc_kinematics, ego_ss, npc_ss), the
+            kinematics as (pos, vel, acc) arrays, the snapshots per frame
+    '''
+    rng = np.random.default_rng(seed)
+    shape = (frames, npcs, 3)
+    ego_pos = rng.uniform(-1, 1, (frames, 1, 3)) * (5, 5, 0.1)
+    ego_vel = rng.uniform(-15, 15, (frames, 1, 3)) * (1, 1, 0)
+    ego_acc = rng.uniform(-5, 5, (frames, 1, 3)) * (1, 1, 0)
+    npc_pos = rng.uniform(-15, 15, shape) * (1, 1, 0.01)
+    npc_vel = rng.uniform(-15, 15, shape) * (1, 1, 0)
+    npc_acc = rng.uniform(-5, 5, shape) * (1, 1, 0)
+
+    ego_ss = [_FakeSnapshot(ego_pos[f, 0], ego_vel[f, 0], ego_acc[f, 0])
+              for f in range(frames)]
+    npc_ss = [[_FakeSnapshot(npc_pos[f, n], npc_vel[f, n], npc_acc[f, n])
+               for n in range(npcs)] for f in range(frames)]
+    return (ego_pos, ego_vel, ego_acc), (npc_pos, npc_vel, npc_acc), ego_ss, npc_ss
+
+
+def check_collision(frames=600, npcs=8):
+    '''
+        predict_collisions over all pairs at once and the predict_collision
+        wrapper give the loop's results, collision flag and time.
+        return: the number of predicted collisions
+    '''
+    ego, npc, ego_ss, npc_ss = get_collision_data(frames, npcs)
+    collide, t = predict_collisions(*npc, *ego)
+    for f in range(frames):
+        for n in range(npcs):
+            e_collide, e_t = predict_collision_loop(npc_ss[f][n], ego_ss[f])
+            assert e_collide == collide[f, n], (f, n)
+            assert not e_collide or e_t == t[f, n], (f, n)
+            assert (e_collide, e_t) == predict_collision(npc_ss[f][n], ego_ss[f]), (f, n)
+    return int(collide.sum())
+
+
+def get_recorded_frames(frames, npcs, seed=0):
+    '''
+        A segment in the former frame_recorded layout: the ego driving along
+        x, npcs around it, some of them missing from some snapshots.
+    '''
+    rng = np.random.default_rng(seed)
+    recorded = []
+    for f in range(frames):
+        ego_ss = _FakeSnapshot((f * 0.5, rng.uniform(-0.2, 0.2), 0.1),
+                               rng.uniform(-1, 1, 3) * (2, 1, 0) + (10, 0, 0),
+                               rng.uniform(-8, 8, 3) * (1, 1, 0),
+                               rng.uniform(-5, 5, 3) * (0.1, 30, 0.1))
+        npc_ss = [_FakeSnapshot(rng.uniform(-15, 15, 3) * (1, 1, 0) + (f * 0.5, 0, 0),
+                                rng.uniform(-10, 10, 3) * (1, 1, 0),
+                                rng.uniform(-3, 3, 3) * (1, 1, 0))
+                  if rng.random() > 0.1 else None
+                  for _ in range(npcs)]
+        ego_acc_x = ego_ss.get_acceleration().x
+        recorded.append({
+            'timestamp': 1000 + f * 0.05,
+            'frame': 5000 + f,
+            'min_dis': float(rng.uniform(0.5, 30)),
+            'unsmooth_acc': 0 if abs(ego_acc_x) < 4 else abs(ego_acc_x) - 4,
+            'walker_in_road': int(rng.integers(0, 3)),
+            'npc_vehicles_ss': npc_ss,
+            'ego_ss': ego_ss,
+        })
+    return recorded
+
+
+def evaluate_loop(frame_recorded):
+    # the former Evaluate_Object.evaluate, kept as reference
+    f_distance = frame_recorded[0]['min_dis']
+    f_unsmooth_acc = frame_recorded[0]['unsmooth_acc']
+    walker_in_road_count = 0
+    vehicle_may_collide = 0
+    for frame in frame_recorded:
+        if frame['min_dis'] < f_distance:
+            f_distance = frame['min_dis']
+        if frame['unsmooth_acc'] > f_unsmooth_acc:
+            f_unsmooth_acc = frame['unsmooth_acc']
+        walker_in_road_count += frame['walker_in_road']
+        ego_ss = frame['ego_ss']
+        for vehicle_ss in frame['npc_vehicles_ss']:
+            if vehicle_ss is None:
+                continue
+            collision, _ = predict_collision_loop(vehicle_ss, ego_ss)
+            if collision:
+                vehicle_may_collide += 1
+    return (f_distance, f_unsmooth_acc,
+            walker_in_road_count / len(frame_recorded),
+            vehicle_may_collide / len(frame_recorded))
+
+
+def result_records_loop(frames_record):
+    # the per-frame part of the former ResultSaver.save_result, as reference
+    ego_pos_l = []
+    run_distance = 0.0
+    interaction_per_frame = []
+    will_collide_frame_cnt = 0
+    pre_frame = None
+    for frame in frames_record:
+        ego_ss = frame['ego_ss']
+        npcs_ss = frame['npc_vehicles_ss']
+        ego_pos_l.append({
+            'timestamp': frame['timestamp'],
+            'frame_num': frame['frame'],
+            'x': ego_ss.get_transform().location.x,
+            'y': ego_ss.get_transform().location.y,
+            'z': ego_ss.get_transform().location.z,
+            'yaw': ego_ss.get_transform().rotation.yaw,
+            'pitch': ego_ss.get_transform().rotation.pitch,
+            'roll': ego_ss.get_transform().rotation.roll,
+            'speed': ego_ss.get_velocity().length(),
+            'run_distance': round(run_distance, 2)
+        })
+        if pre_frame:
+            pre_ego_ss = pre_frame['ego_ss']
+            run_distance += abs(ego_ss.get_transform().location.distance(
+                pre_ego_ss.get_transform().location))
+
+        pre_colli_cunt = 0
+        this_frame_has_colli = False
+        npcs_pos = []
+        for npc_ss in npcs_ss:
+            if npc_ss == None:
+                continue
+            will_collide, _ = predict_collision_loop(ego_ss, npc_ss)
+            pre_colli_cunt += 1 if will_collide else 0
+            if will_collide:
+                this_frame_has_colli = True
+            npc_loc = npc_ss.get_transform().location
+            npcs_pos.append({
+                'x': npc_loc.x,
+                'y': npc_loc.y,
+                'z': npc_loc.z,
+                'will_collide': will_collide
+            })
+        will_collide_frame_cnt += 1 if this_frame_has_colli else 0
+        interaction_per_frame.append({
+            'timestamp': frame['timestamp'],
+            'frame_num': frame['frame'],
+            'interaction_rate': pre_colli_cunt / len(npcs_ss) if npcs_ss else 0,
+            'npcs_pos': npcs_pos
+        })
+        pre_frame = frame
+    return {
+        'Odometer': {
+            'total_distance': round(run_distance, 2),
+            'pos_per_frame': ego_pos_l
+        },
+        'interaction': {
+            'interact_frame_rate': will_collide_frame_cnt / len(frames_record),
+            'per_frame': interaction_per_frame
+        },
+    }
+
+
+def check_metrics(frames=400, npcs=6):
+    '''
+        One recorded segment through the former evaluate / save_result loops
+        and through the FrameBuffer pipeline of LocalScenario (per tick
+        collision prediction and MetricsAccumulator, then write_result): the
+        same fitness values and the same result.json records, for both
+        result formats.
+        return: the fitness values
+    '''
+    recorded = get_recorded_frames(frames, npcs)
+
+    buf = FrameBuffer(npcs)
+    evaluate_obj = Evaluate_Object(
+        SimpleNamespace(fitness=SimpleNamespace(values=())),
+        SimpleNamespace(fitness=SimpleNamespace(values=())))
+    for frame in recorded:
+        # what LocalScenario.evaluate_snapshot_record does per tick
+        index = buf.append(frame['timestamp'], frame['frame'], frame['min_dis'],
+                           frame['unsmooth_acc'], frame['walker_in_road'],
+                           frame['ego_ss'], frame['npc_vehicles_ss'])
+        will_collide = predict_frame_collisions(buf, index)
+        evaluate_obj.record_frame(frame['min_dis'], frame['unsmooth_acc'],
+                                  frame['walker_in_road'], will_collide)
+    evaluate_obj.evaluate()
+
+    f_distance, f_smooth, f_crossing_time, f_interaction_rate = evaluate_loop(recorded)
+    fitness = (evaluate_obj.f_distance, evaluate_obj.f_smooth,
+               evaluate_obj.f_crossing_time, evaluate_obj.f_interaction_rate)
+    assert fitness == (f_distance, f_smooth, f_crossing_time, f_interaction_rate), fitness
+    assert evaluate_obj.walker_ind.fitness.values == \
+        (f_distance, f_smooth, 0, f_crossing_time)
+    assert evaluate_obj.vehicle_ind.fitness.values == \
+        (f_distance, f_smooth, 0, f_interaction_rate)
+
+    # result.json holds what json makes of the records
+    expected = json.loads(json.dumps(result_records_loop(recorded)))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for result_format in ('json', 'npz'):
+            path = os.path.join(tmp_dir, result_format)
+            os.makedirs(path)
+            write_result({'video_path': None}, buf.frozen_copy(), path,
+                         result_format=result_format)
+            result = load_result(path)
+            for key in ('Odometer', 'interaction'):
+                assert result[key] == expected[key], (result_format, key)
+    return fitness
+
+
+def track_loop(segments, positions):
+    '''
+        The former SceneSegment.listening_thread, one pass of its loop per
+        position as when it polls faster than the world ticks.
+        return: (curr_seg_index, finished_index, belongs_to_two_index) after
+            each position
+    '''
+    curr_seg_index = -1
+    finished_index = -1
+    belongs_to_two_index = (True, False)
+    last_in_index = curr_seg_index - 1
+    states = []
+    for pos in positions:
+        if finished_index == len(segments) - 1:
+            # the thread has returned
+            curr_seg_index = len(segments) - 1
+        elif curr_seg_index < 0 and \
+                not SegmentTracker.check_if_loc_in_segment(pos, segments[0]):
+            finished_index = -1
+        else:
+            if curr_seg_index < 0:
+                curr_seg_index = 0
+                last_in_index = curr_seg_index
+            already_in_list = [index for index, seg in enumerate(segments)
+                               if SegmentTracker.check_if_loc_in_segment(pos, seg)]
+            if already_in_list != []:
+                curr_seg_index = already_in_list[0]
+                if curr_seg_index != last_in_index:
+                    finished_index = last_in_index
+                    last_in_index = curr_seg_index
+                if len(already_in_list) > 1:
+                    belongs_to_two_index = (True, True)
+                else:
+                    belongs_to_two_index = (True, False)
+            else:
+                belongs_to_two_index = (False, False)
+                if last_in_index == curr_seg_index:
+                    finished_index = curr_seg_index
+        states.append((curr_seg_index, finished_index, belongs_to_two_index))
+    return states
+
+
+def get_route(rng: random.Random, length=30, width=30):
+    '''
+        Segments along a winding road, 8 to 60 m apart so that neighbours
+        overlap more or less, and an ego path along it with lateral noise,
+        starting before the first segment and ending past the last one,
+        sampled 1 to 10 times per segment.
+        return: (segments, positions)
+    '''
+    spacing = rng.choice([(8, 14), (20, 40), (20, 60)])
+    segments = []
+    x, y, yaw = 0.0, 0.0, 0.0
+    for _ in range(rng.randrange(1, 40)):
+        segments.append(SimpleNamespace(location=carla.Location(x, y, 0),
+                                        rotation=carla.Rotation(0, yaw, 0),
+                                        length=length, width=width))
+        yaw += rng.uniform(-25, 25)
+        step = rng.uniform(*spacing)
+        x += step * math.cos(math.radians(yaw))
+        y += step * math.sin(math.radians(yaw))
+    centers = [(seg.location.x, seg.location.y) for seg in segments] + [(x, y)]
+    # a few positions per segment too, as a fast ego between two ticks
+    steps = rng.choice([1, 2, 10])
+    positions = [carla.Location(-50, -50, 0)] * 3
+    for (x0, y0), (x1, y1) in zip(centers, centers[1:]):
+        for step in range(steps):
+            f = step / steps
+            positions.append(carla.Location(x0 + (x1 - x0) * f + rng.uniform(-2, 2),
+                                            y0 + (y1 - y0) * f + rng.uniform(-2, 2), 0))
+    positions += [carla.Location(x + 500, y, 0)] * 3
+    return segments, positions
+
+
+def check_tracking(routes=300):
+    '''
+        SegmentTracker.update against the former loop on random routes.
+
+        The tracker's cursor only moves forward. The former loop scanned from
+        segment 0, so when the ego re-entered an earlier segment it overlaps
+        with, it went back to it: `(curr, finished)` became e.g. (3, 4) where
+        the tracker keeps (4, 3), and the Simulator saw segment 4 as
+        finished. Otherwise both give the same states:
+        - routes where the former loop never goes back are identical
+        - on the others both agree up to the first time it goes back
+        - the tracker's curr_seg_index and finished_index never decrease
+        return: (routes, routes where the former loop went back)
+    '''
+    rng = random.Random(0)
+    went_back = 0
+    for route in range(routes):
+        segments, positions = get_route(rng)
+        expected = track_loop(segments, positions)
+        tracker = SegmentTracker()
+        tracker.reset(segments)
+        states = []
+        for pos in positions:
+            tracker.update(pos)
+            states.append((tracker.curr_seg_index, tracker.finished_index,
+                           tracker.belongs_to_two_index))
+
+        back = [i for i in range(1, len(expected))
+                if expected[i][0] < expected[i - 1][0]]
+        if back:
+            went_back += 1
+            assert states[:back[0]] == expected[:back[0]], route
+        else:
+            assert states == expected, route
+        for (curr, finished, _), (next_curr, next_finished, _) in zip(states, states[1:]):
+            assert curr <= next_curr and finished <= next_finished, route
+    return routes, went_back
+
+
+CHECKS = {
+    'collision': check_collision,
+    'metrics': check_metrics,
+    'tracking': check_tracking,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checks', nargs='*',
+                        help=f'of {", ".join(CHECKS)}, all by default')
+    args = parser.parse_args()
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error(f'unknown check {name}')
+    for name in args.checks or CHECKS:
+        result = CHECKS[name]()
+        print(f'{name:10s}: ok ({result})')
+
+
+if __name__ == '__main__':
+    main()
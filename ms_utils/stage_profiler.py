@@ -0,0 +1,209 @@
+'''
+    Where the wall time of a frame goes: monotonic timers around the stages
+    of the simulation loop, each feeding a log-bucketed histogram (HDR
+    style, a fixed relative precision from nanoseconds to minutes in a
+    few hundred counters).
+
+    One process-wide profiler, disabled unless the Simulator enables it
+    (Config.profile_stages):
+
+        with get_stage_profiler().stage('npc_refresh'):
+            scenario.npc_refresh()
+
+    The histograms of each scenario are dumped next to its result
+    (`dump()`), the totals are summarized at shutdown (`summary()`).
+'''
+import json
+import os
+import threading
+import time
+from typing import Dict
+
+# 2**SUB_BITS buckets per power of two, values within ~6% of their bucket
+SUB_BITS = 4
+SUB_COUNT = 1 << SUB_BITS
+# up to 2**42 ns, over an hour
+BUCKET_COUNT = (42 - SUB_BITS + 1) * SUB_COUNT
+
+
+def bucket_index(value_ns: int) -> int:
+    if value_ns < SUB_COUNT:
+        return max(value_ns, 0)
+    shift = value_ns.bit_length() - SUB_BITS - 1
+    index = (shift + 1) * SUB_COUNT + (value_ns >> shift) - SUB_COUNT
+    return min(index, BUCKET_COUNT - 1)
+
+
+def bucket_upper(index: int) -> int:
+    '''
+        return: the highest value (ns) counted in bucket `index`
+    '''
+    if index < SUB_COUNT:
+        return index
+    shift = index // SUB_COUNT - 1
+    return ((index % SUB_COUNT + SUB_COUNT + 1) << shift) - 1
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def add(self, value_ns: int):
+        self.counts[bucket_index(value_ns)] += 1
+        self.count += 1
+        self.total += value_ns
+        if self.min is None or value_ns < self.min:
+            self.min = value_ns
+        if value_ns > self.max:
+            self.max = value_ns
+
+    def merge(self, other: 'Histogram'):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent) -> int:
+        '''
+            return: the highest value (ns) of the bucket holding the
+                `percent` percentile, at most the recorded maximum
+        '''
+        if self.count == 0:
+            return 0
+        rank = max(1, int(round(percent / 100 * self.count)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_upper(index), self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'total_s': self.total / 1e9,
+            'mean_ms': self.total / self.count / 1e6 if self.count else 0,
+            'min_ms': (self.min or 0) / 1e6,
+            'p50_ms': self.percentile(50) / 1e6,
+            'p90_ms': self.percentile(90) / 1e6,
+            'p99_ms': self.percentile(99) / 1e6,
+            'p999_ms': self.percentile(99.9) / 1e6,
+            'max_ms': self.max / 1e6,
+            # [highest value of the bucket (ns), count], non empty buckets
+            'buckets': [[bucket_upper(index), count]
+                        for index, count in enumerate(self.counts) if count],
+        }
+
+
+class StageTimer(object):
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler: 'StageProfiler', name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter_ns() - self.start)
+        return False
+
+
+class NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class StageProfiler(object):
+    '''
+        Histograms of the stage timings of the current scenario, merged
+        into the totals of the run by `dump()`.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms: Dict[str, Histogram] = {}
+        self.totals: Dict[str, Histogram] = {}
+
+    def set_enabled(self, enabled: bool):
+        self.enabled = enabled
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_TIMER
+        return StageTimer(self, name)
+
+    def record(self, name, elapsed_ns: int):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(elapsed_ns)
+
+    def dump(self, path=None) -> dict:
+        '''
+            Write the histograms of the scenario to `path` (json) and start
+            the next scenario's.
+            return: the dumped stages
+        '''
+        with self.lock:
+            histograms, self.histograms = self.histograms, {}
+            for name, histogram in histograms.items():
+                self.totals.setdefault(name, Histogram()).merge(histogram)
+        stages = {name: histogram.to_dict()
+                  for name, histogram in histograms.items()}
+        if path and stages:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(stages, f, indent=1)
+        return stages
+
+    def summary(self) -> Dict[str, dict]:
+        '''
+            return: the stages of the whole run, the current scenario included
+        '''
+        with self.lock:
+            totals = {}
+            for histograms in [self.totals, self.histograms]:
+                for name, histogram in histograms.items():
+                    totals.setdefault(name, Histogram()).merge(histogram)
+        return {name: histogram.to_dict() for name, histogram in totals.items()}
+
+    def format_summary(self) -> str:
+        stages = self.summary()
+        lines = [f'{"stage":<20} {"count":>8} {"mean":>9} {"p50":>9} '
+                 f'{"p99":>9} {"max":>9} {"total":>9}']
+        for name, stage in sorted(stages.items(),
+                                  key=lambda item: -item[1]['total_s']):
+            lines.append(f'{name:<20} {stage["count"]:>8} '
+                         f'{stage["mean_ms"]:>7.2f}ms {stage["p50_ms"]:>7.2f}ms '
+                         f'{stage["p99_ms"]:>7.2f}ms {stage["max_ms"]:>7.2f}ms '
+                         f'{stage["total_s"]:>8.1f}s')
+        return '\n'.join(lines)
+
+
+_stage_profiler = StageProfiler(enabled=False)
+
+
+def get_stage_profiler() -> StageProfiler:
+    return _stage_profiler
@@ -0,0 +1,160 @@
+import io
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+class XodrTables(object):
+    '''
+        Road and junction tables of an OpenDRIVE map, keyed by integer ids:
+        - road_lanes: road -> (left, right) driving lane counts of the road,
+          taken from its first <left> / <right> lane group
+        - section_lanes: road -> [(s, left, right)] for every laneSection
+        - road_junction: road -> junction, for roads inside a junction
+        - junction_incoming: junction -> incoming roads, sorted
+
+        Build it with `parse_xodr()` (one streaming pass, no tree kept) and
+        store it with `save()` / `load()`.
+    '''
+
+    def __init__(self):
+        self.road_lanes: Dict[int, Tuple[int, int]] = {}
+        self.section_lanes: Dict[int, List[Tuple[float, int, int]]] = {}
+        self.road_junction: Dict[int, int] = {}
+        self.junction_incoming: Dict[int, Tuple[int, ...]] = {}
+
+    def __eq__(self, other):
+        return isinstance(other, XodrTables) and \
+            self.road_lanes == other.road_lanes and \
+            self.section_lanes == other.section_lanes and \
+            self.road_junction == other.road_junction and \
+            self.junction_incoming == other.junction_incoming
+
+    def get_lane_num(self, road_id: int) -> int:
+        left, right = self.road_lanes[road_id]
+        return left + right
+
+    def is_one_way(self, road_id: int) -> bool:
+        left, right = self.road_lanes[road_id]
+        return left == 0 or right == 0
+
+    def get_junction_dir_count(self, junction_id: int) -> int:
+        return len(self.junction_incoming[junction_id])
+
+    def save(self, path):
+        '''
+            Flat int/float columns in a .npz, see `load()`.
+        '''
+        road_ids = np.array(list(self.road_lanes), dtype=np.int64)
+        road_lanes = np.array([self.road_lanes[r] for r in road_ids],
+                              dtype=np.int32).reshape(-1, 2)
+        sections = [(road, s, left, right)
+                    for road, secs in self.section_lanes.items()
+                    for s, left, right in secs]
+        junction_roads = np.array(list(self.road_junction.items()),
+                                  dtype=np.int64).reshape(-1, 2)
+        junction_ids = np.array(list(self.junction_incoming), dtype=np.int64)
+        incoming = [(junction, road)
+                    for junction, roads in self.junction_incoming.items()
+                    for road in roads]
+        np.savez(path,
+                 road_ids=road_ids,
+                 road_lanes=road_lanes,
+                 section_roads=np.array([sec[0] for sec in sections], dtype=np.int64),
+                 section_s=np.array([sec[1] for sec in sections], dtype=np.float64),
+                 section_lanes=np.array([sec[2:] for sec in sections],
+                                        dtype=np.int32).reshape(-1, 2),
+                 junction_roads=junction_roads,
+                 junction_ids=junction_ids,
+                 junction_incoming=np.array(incoming, dtype=np.int64).reshape(-1, 2))
+
+    @classmethod
+    def load(cls, path) -> 'XodrTables':
+        tables = cls()
+        with np.load(path) as data:
+            for road, lanes in zip(data['road_ids'].tolist(),
+                                   data['road_lanes'].tolist()):
+                tables.road_lanes[road] = tuple(lanes)
+                tables.section_lanes[road] = []
+            for road, s, lanes in zip(data['section_roads'].tolist(),
+                                      data['section_s'].tolist(),
+                                      data['section_lanes'].tolist()):
+                tables.section_lanes[road].append((s, lanes[0], lanes[1]))
+            tables.road_junction = dict(
+                (road, junction) for road, junction in data['junction_roads'].tolist())
+            incoming = {junction: [] for junction in data['junction_ids'].tolist()}
+            for junction, road in data['junction_incoming'].tolist():
+                incoming[junction].append(road)
+            tables.junction_incoming = {junction: tuple(roads)
+                                        for junction, roads in incoming.items()}
+        return tables
+
+
+def parse_xodr(xodr: str) -> XodrTables:
+    '''
+        Build the XodrTables of an OpenDRIVE string (`carla.Map.to_opendrive()`)
+        in one iterparse pass, elements are dropped once read.
+    '''
+    tables = XodrTables()
+    # tags of the open elements, path[1] is a top-level <road>/<junction>
+    path = []
+    road_id = None
+    road_lanes = None
+    section = None
+    group = None
+    junction_id = None
+    incoming = None
+
+    for event, elem in ET.iterparse(io.BytesIO(xodr.encode()),
+                                    events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            path.append(tag)
+            depth = len(path)
+            if depth == 2 and tag == 'road':
+                road_id = int(elem.get('id'))
+                junction = elem.get('junction')
+                if junction is not None and junction != '-1':
+                    tables.road_junction[road_id] = int(junction)
+                # [left, right], None until the first group of that side
+                road_lanes = [None, None]
+                tables.section_lanes[road_id] = []
+            elif depth == 2 and tag == 'junction':
+                junction_id = int(elem.get('id'))
+                incoming = set()
+            elif road_id is not None and tag == 'laneSection':
+                section = [float(elem.get('s', 0)), 0, 0]
+            elif section is not None and tag in ('left', 'right') \
+                    and path[-2] == 'laneSection':
+                group = 1 if tag == 'left' else 2
+                if road_lanes[group - 1] is None:
+                    road_lanes[group - 1] = section
+            elif junction_id is not None and tag == 'connection':
+                incoming.add(int(elem.get('incomingRoad')))
+            continue
+
+        # end
+        path.pop()
+        if group is not None and tag == 'lane' and path[-1] in ('left', 'right'):
+            if elem.get('type') == 'driving':
+                section[group] += 1
+        elif group is not None and tag in ('left', 'right'):
+            if road_lanes[group - 1] is section:
+                # keep the count of the first group even when the section
+                # goes on with another side
+                road_lanes[group - 1] = section[group]
+            group = None
+        elif tag == 'laneSection' and section is not None:
+            tables.section_lanes[road_id].append(tuple(section))
+            section = None
+        elif len(path) == 1 and tag == 'road':
+            tables.road_lanes[road_id] = (road_lanes[0] or 0,
+                                          road_lanes[1] or 0)
+            road_id = None
+            elem.clear()
+        elif len(path) == 1 and tag == 'junction':
+            tables.junction_incoming[junction_id] = tuple(sorted(incoming))
+            junction_id = None
+            elem.clear()
+    return tables
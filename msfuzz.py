@@ -44,6 +44,7 @@ class MS_FUZZ(object):
 
         self.eva_req_queue = multiprocessing.Queue()
         self.eva_res_queue = multiprocessing.Queue()
+        self.coverage_queue = multiprocessing.Queue()
 
         self.sim_stop_queue = multiprocessing.Queue()
 
@@ -115,7 +116,8 @@ class MS_FUZZ(object):
                              self.eva_req_queue,
                              self.eva_res_queue,
                              logger,
-                             self.ga_path)
+                             self.ga_path,
+                             coverage_queue=self.coverage_queue)
 
         def sigint_handler(signum, frame):
             logger.warning("GA_LIB Process SIGINT received. Saving...")
@@ -131,7 +133,8 @@ class MS_FUZZ(object):
     def sim_progress_handler(self, stop_queue: multiprocessing.Queue):
         sim = Simulator(self.conf,
                         self.eva_req_queue,
-                        self.eva_res_queue)
+                        self.eva_res_queue,
+                        coverage_queue=self.coverage_queue)
 
         def terminate_listener_handler():
             while True: